@@ -0,0 +1,394 @@
+"""
+Micro-benchmarks for the storage backend. These are not run as part of the
+test suite; run them by hand, e.g.
+
+    python -c "from mandala.benchmarks import bench_call_lookups; bench_call_lookups()"
+"""
+from .common_imports import *
+from .utils import dataframe_to_prettytable, serialize, deserialize, get_content_hash, HASH_VERSIONS
+from .storage_utils import DBAdapter, SQLiteCallStorage, SchemaManager
+
+
+def _timeit(f: Callable, n: int) -> float:
+    """
+    Return the mean time of `n` calls to `f()`, in milliseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def _fill_calls_table(db: DBAdapter, num_calls: int, num_ops: int = 10):
+    """
+    Populate the `calls` table with `num_calls` synthetic calls, each with
+    one input and one output.
+    """
+    rows = []
+    for i in range(num_calls):
+        call_hid, call_cid = f"call_hid_{i}", f"call_cid_{i}"
+        op_name = f"op_{i % num_ops}"
+        rows.append((call_hid, "x", "in", call_cid, f"ref_cid_{i}", f"ref_hid_{i}", op_name, None, None))
+        rows.append((call_hid, "output_0", "out", call_cid, f"ref_cid_{i+1}", f"ref_hid_{i+1}", op_name, None, None))
+    with db.conn() as conn:
+        conn.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def bench_call_lookups(sizes: Tuple[int, ...] = (1_000, 10_000, 100_000),
+                       num_lookups: int = 200,
+                       ) -> pd.DataFrame:
+    """
+    Measure the latency of the lookups in the `calls` table that are on the
+    hot path of memoization and provenance queries, as a function of the size
+    of the table, with and without the secondary indexes added by the schema
+    migrations.
+    """
+    results = []
+    for size in sizes:
+        for indexed in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                db = DBAdapter(db_path=os.path.join(tmpdir, "bench.db"))
+                calls = SQLiteCallStorage(db=db, table_name="calls")
+                if indexed:
+                    SchemaManager(db=db).migrate()
+                _fill_calls_table(db=db, num_calls=size)
+                idxs = [random.randrange(size) for _ in range(num_lookups)]
+                it = itertools.cycle(idxs)
+                lookups = {
+                    "exists_content": lambda: calls.exists_content(f"call_cid_{next(it)}"),
+                    "get_data_content": lambda: calls.get_data_content(f"call_cid_{next(it)}"),
+                    "exists_ref_hid": lambda: calls.exists_ref_hid(f"ref_hid_{next(it)}"),
+                    "get_creator_hids": lambda: calls.get_creator_hids([f"ref_hid_{next(it) + 1}"]),
+                    "get_consumer_hids": lambda: calls.get_consumer_hids([f"ref_hid_{next(it)}"]),
+                    "from_op": lambda: calls.execute_df("SELECT call_history_id FROM calls WHERE op='op_0'"),
+                }
+                for name, f in lookups.items():
+                    results.append({
+                        "rows": 2 * size,
+                        "indexed": indexed,
+                        "lookup": name,
+                        "latency_ms": _timeit(f, n=num_lookups if name != "from_op" else 5),
+                    })
+    df = pd.DataFrame(results)
+    df = df.pivot_table(index=["lookup", "rows"], columns="indexed", values="latency_ms").reset_index()
+    df.columns = ["lookup", "rows", "no_index_ms", "index_ms"]
+    df["speedup"] = df["no_index_ms"] / df["index_ms"]
+    print(dataframe_to_prettytable(df.round(3)))
+    return df
+
+
+def bench_commit(num_calls: int = 10_000) -> Dict[str, float]:
+    """
+    Measure the throughput of `Storage.commit` for a batch of `num_calls`
+    new calls to a file-backed storage.
+    """
+    from .storage import Storage
+    from .model import op
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = Storage(db_path=os.path.join(tmpdir, "bench.db"))
+        with storage:
+            for i in range(num_calls):
+                inc(i)
+        stats = storage.last_commit_stats
+        storage.close()
+    print(dataframe_to_prettytable(pd.DataFrame([stats]).round(3)))
+    return stats
+
+
+def bench_codecs(num_values: int = 20, num_reads: int = 5) -> pd.DataFrame:
+    """
+    Compare the compression codecs for atoms on typical values (numeric
+    arrays and data frames): the size of the database, and the time to commit
+    and to read back the values (with a cold cache).
+    """
+    from .storage import Storage
+    from .storage_utils import CODECS
+
+    rng = np.random.default_rng(0)
+    values = {}
+    for i in range(num_values):
+        if i % 2 == 0:
+            values[f"array_{i}"] = rng.integers(0, 100, size=100_000).astype(np.float64)
+        else:
+            values[f"df_{i}"] = pd.DataFrame({
+                "a": rng.integers(0, 10, size=20_000),
+                "b": rng.choice(["x", "y", "z"], size=20_000),
+                "c": rng.normal(size=20_000).round(2),
+            })
+    results = []
+    for codec in CODECS:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, "bench.db")
+            storage = Storage(db_path=db_path, codec=codec)
+            start = time.perf_counter()
+            with storage:
+                for key, value in values.items():
+                    storage.atoms[key] = serialize(value)
+            commit_s = time.perf_counter() - start
+
+            def read_all():
+                storage.atoms.clear()
+                for key in values:
+                    deserialize(storage.atoms[key])
+            read_ms = _timeit(read_all, n=num_reads)
+            storage.close() # checkpoints the WAL into the database file
+            db_MB = os.path.getsize(db_path) / 1024 / 1024
+        results.append({"codec": codec, "db_MB": db_MB, "commit_s": commit_s, "read_all_ms": read_ms})
+    df = pd.DataFrame(results)
+    df["ratio"] = df.loc[df["codec"] == "none", "db_MB"].item() / df["db_MB"]
+    print(dataframe_to_prettytable(df.round(3)))
+    return df
+
+
+def bench_serialize(num_iters: int = 1000) -> pd.DataFrame:
+    """
+    Compare `serialize`/`deserialize` against the plain `joblib` round trip
+    they replaced, on typical atoms.
+    """
+    def joblib_dumps(obj: Any) -> bytes:
+        buffer = io.BytesIO()
+        joblib.dump(obj, buffer)
+        return buffer.getvalue()
+
+    values = {
+        "int": 42,
+        "float": 3.14,
+        "str": "hello world",
+        "array_1k": np.random.default_rng(0).normal(size=1_000),
+        "array_1M": np.random.default_rng(0).normal(size=1_000_000),
+        "df_100k": pd.DataFrame({"a": np.arange(100_000), "b": np.random.default_rng(0).normal(size=100_000)}),
+    }
+    results = []
+    for name, value in values.items():
+        n = num_iters if not name.endswith(("M", "100k")) else max(num_iters // 100, 1)
+        data, legacy_data = serialize(value), joblib_dumps(value)
+        results.append({
+            "value": name,
+            "joblib_dump_ms": _timeit(lambda: joblib_dumps(value), n=n),
+            "serialize_ms": _timeit(lambda: serialize(value), n=n),
+            "joblib_load_ms": _timeit(lambda: joblib.load(io.BytesIO(legacy_data)), n=n),
+            "deserialize_ms": _timeit(lambda: deserialize(data), n=n),
+            "joblib_bytes": len(legacy_data),
+            "bytes": len(data),
+        })
+    df = pd.DataFrame(results)
+    print(dataframe_to_prettytable(df.round(4)))
+    return df
+
+
+def bench_hashing(num_iters: int = 1000) -> pd.DataFrame:
+    """
+    Compare the available content hash versions (version 0 is `joblib.hash`)
+    on typical inputs: the small tuples of hids used for call IDs, scalars,
+    and large arrays and data frames.
+    """
+    from .config import Config
+
+    rng = np.random.default_rng(0)
+    hid = "0123456789abcdef0123456789abcdef"
+    values = {
+        "call_id_tuple": ({"x": hid, "y": hid}, "op_name", 0),
+        "int": 42,
+        "str": "hello world",
+        "array_1k": rng.normal(size=1_000),
+        "array_10M": rng.normal(size=10_000_000),
+        "df_1M": pd.DataFrame({"a": np.arange(1_000_000), "b": rng.normal(size=1_000_000)}),
+    }
+    versions = [v for v in HASH_VERSIONS if v != 2 or Config.has_xxhash]
+    results = []
+    for name, value in values.items():
+        n = num_iters if not name.endswith("M") else max(num_iters // 200, 1)
+        row = {"value": name}
+        for version in versions:
+            row[f"v{version}_ms"] = _timeit(lambda: get_content_hash(value, version=version), n=n)
+        row["speedup"] = row["v0_ms"] / row["v1_ms"]
+        results.append(row)
+    df = pd.DataFrame(results)
+    print(dataframe_to_prettytable(df.round(4)))
+    return df
+
+
+def bench_call_overhead(num_calls: int = 2_000) -> Dict[str, float]:
+    """
+    Measure the per-call overhead of `@op`s that do (almost) no work, for new
+    calls and for calls that hit the memoization cache, in microseconds.
+    """
+    from .storage import Storage
+    from .model import op
+
+    @op
+    def add(x: int, y: int = 1) -> int:
+        return x + y
+
+    storage = Storage()
+    res = {}
+    with storage:
+        start = time.perf_counter()
+        for i in range(num_calls):
+            add(i)
+        res["new_call_us"] = (time.perf_counter() - start) / num_calls * 1e6
+    with storage:
+        start = time.perf_counter()
+        for i in range(num_calls):
+            add(i)
+        res["memoized_call_us"] = (time.perf_counter() - start) / num_calls * 1e6
+    print(dataframe_to_prettytable(pd.DataFrame([res]).round(2)))
+    return res
+
+
+def bench_mget_call(num_calls: int = 5_000, list_size: int = 5) -> Dict[str, float]:
+    """
+    Measure the time and number of SQL queries it takes to load `num_calls`
+    calls (each returning a list) with `Storage.mget_call` from a fresh
+    storage.
+    """
+    from .storage import Storage
+    from .model import op, MList
+
+    @op
+    def make_list(x: int) -> MList[int]:
+        return [x + i for i in range(list_size)]
+
+    res = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        storage = Storage(db_path=db_path)
+        with storage:
+            for i in range(num_calls):
+                make_list(i)
+        hids = storage.call_storage.execute_df(
+            "SELECT DISTINCT call_history_id FROM calls WHERE op = 'make_list'"
+        )["call_history_id"].tolist()
+        for lazy in (True, False):
+            storage = Storage(db_path=db_path)
+            num_queries = 0
+            def count_query(statement: str):
+                nonlocal num_queries
+                num_queries += 1
+            storage.conn().set_trace_callback(count_query)
+            start = time.perf_counter()
+            storage.mget_call(hids, in_memory=lazy)
+            res[f"{'lazy' if lazy else 'eager'}_s"] = time.perf_counter() - start
+            res[f"{'lazy' if lazy else 'eager'}_queries"] = num_queries
+            storage.close()
+    print(dataframe_to_prettytable(pd.DataFrame([res]).round(3)))
+    return res
+
+
+def bench_unwrap(num_values: int = 200, size: int = 10_000, num_reads: int = 5) -> pd.DataFrame:
+    """
+    Measure repeated `Storage.unwrap` of the same (lazily loaded) array refs,
+    without and with the object cache in each of its modes.
+    """
+    from .storage import Storage
+    from .model import op
+
+    @op
+    def make_array(x: int) -> np.ndarray:
+        return np.full(size, x, dtype=np.float64)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        storage = Storage(db_path=db_path)
+        with storage:
+            hids = [make_array(i).hid for i in range(num_values)]
+        storage.close()
+        configs = {"none": {}, **{mode: {"object_cache": 2 ** 30, "object_cache_mode": mode}
+                                  for mode in ("copy", "readonly", "shared")}}
+        for name, kwargs in configs.items():
+            storage = Storage(db_path=db_path, **kwargs)
+            refs = [storage.load_ref(hid, in_memory=True) for hid in hids]
+            start = time.perf_counter()
+            storage.unwrap(refs)
+            first_ms = (time.perf_counter() - start) * 1000
+            results.append({
+                "object_cache": name,
+                "first_unwrap_ms": first_ms,
+                "repeat_unwrap_ms": _timeit(lambda: storage.unwrap(refs), n=num_reads),
+            })
+            storage.close()
+    df = pd.DataFrame(results)
+    print(dataframe_to_prettytable(df.round(3)))
+    return df
+
+
+def bench_map(num_calls: int = 200, seconds_per_call: float = 0.005, max_workers: int = 8) -> pd.DataFrame:
+    """
+    Compare calling an op in a loop against `Storage.map` with a thread pool,
+    for new calls and for calls that are all memoized already.
+    """
+    from .storage import Storage
+    from .model import op
+
+    @op
+    def slow_inc(x: int) -> int:
+        time.sleep(seconds_per_call)
+        return x + 1
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for method in ("loop", "map"):
+            storage = Storage(db_path=os.path.join(tmpdir, f"{method}.db"))
+            inputs = [{"x": i} for i in range(num_calls)]
+
+            def run():
+                with storage:
+                    if method == "loop":
+                        [slow_inc(**kwargs) for kwargs in inputs]
+                    else:
+                        storage.map(slow_inc, inputs, executor="thread", max_workers=max_workers)
+
+            start = time.perf_counter()
+            run()
+            new_s = time.perf_counter() - start
+            storage.clear_cache()
+            start = time.perf_counter()
+            run()
+            results.append({"method": method, "new_s": new_s, "memoized_s": time.perf_counter() - start})
+            storage.close()
+    df = pd.DataFrame(results)
+    print(dataframe_to_prettytable(df.round(3)))
+    return df
+
+
+def bench_threads(num_calls: int = 64, seconds_per_call: float = 0.01,
+                  thread_counts: Tuple[int, ...] = (1, 2, 4, 8)) -> pd.DataFrame:
+    """
+    Measure the throughput of new calls to an I/O-bound op made from several
+    threads sharing one storage, each in its own `with storage:` block.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .storage import Storage
+    from .model import op
+
+    @op
+    def slow_inc(x: int) -> int:
+        time.sleep(seconds_per_call)
+        return x + 1
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_threads in thread_counts:
+            storage = Storage(db_path=os.path.join(tmpdir, f"threads_{num_threads}.db"))
+
+            def work(t: int):
+                with storage:
+                    for i in range(t, num_calls, num_threads):
+                        slow_inc(i)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                list(pool.map(work, range(num_threads)))
+            elapsed = time.perf_counter() - start
+            results.append({"threads": num_threads, "seconds": elapsed, "calls_per_second": num_calls / elapsed})
+            storage.close()
+    df = pd.DataFrame(results)
+    df["speedup"] = df["calls_per_second"] / df["calls_per_second"].iloc[0]
+    print(dataframe_to_prettytable(df.round(3)))
+    return df
@@ -32,6 +32,27 @@ class Config:
     except ImportError:
         has_rich = False
     
+    try:
+        import lz4.frame
+
+        has_lz4 = True
+    except ImportError:
+        has_lz4 = False
+
+    try:
+        import zstandard
+
+        has_zstd = True
+    except ImportError:
+        has_zstd = False
+
+    try:
+        import xxhash
+
+        has_xxhash = True
+    except ImportError:
+        has_xxhash = False
+
     try:
         import prettytable
 
@@ -39,6 +60,13 @@ class Config:
     except ImportError:
         has_prettytable = False
 
+    try:
+        import cloudpickle
+
+        has_cloudpickle = True
+    except ImportError:
+        has_cloudpickle = False
+
 
 if Config.has_torch:
     import torch
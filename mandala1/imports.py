@@ -1,5 +1,5 @@
 from .storage import Storage, noop
-from .model import op, Ignore, NewArgDefault, wrap_atom, ValuePointer
+from .model import op, Ignore, NewArgDefault, wrap_atom, ValuePointer, FilePointer
 from .tps import MList, MDict
 from .deps.tracers.dec_impl import track
 
@@ -1,5 +1,6 @@
 import textwrap
 import functools
+import contextvars
 from collections import deque
 from .common_imports import *
 from .common_imports import sess
@@ -9,7 +10,7 @@ from .config import *
 from .utils import (
     parse_output_name,
 )
-from .utils import serialize, deserialize, get_content_hash
+from .utils import serialize, deserialize, get_content_hash, hash_file, HASH_VERSION_JOBLIB
 
 ################################################################################
 ### model
@@ -121,6 +122,30 @@ class ValuePointer:
         obj_repr = repr(self.obj)
         return f"ValuePointer({self.id!r}, {obj_repr})"
 
+
+
+class FilePointer:
+    """
+    Pass a path to a file to an op, identifying the file by its *contents*.
+
+    A path wrapped in a `FilePointer` will:
+    - be identified via the hash of the file's contents when hashing. Within
+    a storage context, the hash is cached in the storage by the path, size,
+    modification time and inode of the file, so unchanged files are not
+    re-read;
+    - be saved in the storage as the path (not the contents of the file);
+    - be replaced by the `path` when passed to a memoized function.
+
+    This is useful for ops taking large data files (e.g. parquet or npz
+    files) by path.
+    """
+    def __init__(self, path: Union[str, Path], content_hash: Optional[str] = None):
+        self.path = path
+        self.content_hash = content_hash
+
+    def __repr__(self) -> str:
+        return f"FilePointer({self.path!r})"
+
     
 T = TypeVar("T")
 def Ignore(value: T = None) -> T:
@@ -129,9 +154,11 @@ def Ignore(value: T = None) -> T:
 def NewArgDefault(value: T = None) -> T:
     return _NewArgDefault(value)
 
-def unwrap_special_value(obj: ValuePointer | _Ignore | Any) -> Any:
+def unwrap_special_value(obj: ValuePointer | FilePointer | _Ignore | Any) -> Any:
     if isinstance(obj, ValuePointer):
         return obj.obj
+    elif isinstance(obj, FilePointer):
+        return obj.path
     elif isinstance(obj, _Ignore):
         return obj.value
     else:
@@ -140,6 +167,63 @@ def unwrap_special_value(obj: ValuePointer | _Ignore | Any) -> Any:
 ################################################################################
 ### ops and calls
 ################################################################################
+class CallPlan:
+    """
+    The information about an op's function that is needed on every call and
+    that does not change between calls: the signature, the variadic
+    parameters, the defaults, and the parsed `Type`s of the annotations.
+
+    For a batched op, the plan describes the call on a single element (see
+    `element_signature`), and `batched_param` is the name of the parameter
+    that takes the list of elements.
+    """
+    def __init__(self, sig: inspect.Signature, batched: bool = False):
+        self.batched_param: Optional[str] = None
+        if batched:
+            sig = CallPlan.element_signature(sig)
+            self.batched_param = next(iter(sig.parameters))
+        self.sig = sig
+        params = sig.parameters
+        self.var_positional = next((p for p in params.values() if p.kind == p.VAR_POSITIONAL), None)
+        self.var_keyword = next((p for p in params.values() if p.kind == p.VAR_KEYWORD), None)
+        self.default_values = {k: p.default for k, p in params.items() if p.default is not inspect.Parameter.empty}
+        self._types: Dict[Any, Type] = {}
+
+    def get_type(self, annotation: Any) -> Type:
+        """
+        Memoized `Type.from_annotation`.
+        """
+        try:
+            return self._types[annotation]
+        except KeyError:
+            tp = Type.from_annotation(annotation=annotation)
+            self._types[annotation] = tp
+            return tp
+        except TypeError: # unhashable annotation
+            return Type.from_annotation(annotation=annotation)
+
+    @staticmethod
+    def element_signature(sig: inspect.Signature) -> inspect.Signature:
+        """
+        Given the signature of a batched function, which takes a list of
+        elements as its first argument and returns a list of results, return
+        the signature of the function on a single element.
+        """
+        params = list(sig.parameters.values())
+        if len(params) == 0 or any(p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD, p.POSITIONAL_ONLY) for p in params):
+            raise ValueError("Batched ops must take the list of elements as their first argument, "
+                             "and can't have variadic or positional-only parameters")
+
+        def element_annotation(annotation: Any) -> Any:
+            if getattr(annotation, "__origin__", None) in (list, tuple, MList) and annotation.__args__:
+                return annotation.__args__[0]
+            return inspect.Parameter.empty
+
+        params[0] = params[0].replace(annotation=element_annotation(params[0].annotation))
+        return sig.replace(parameters=params,
+                           return_annotation=element_annotation(sig.return_annotation))
+
+
 class Op:
     def __init__(
         self,
@@ -149,6 +233,9 @@ class Op:
         output_names: Optional[List[str]] = None,
         version: Optional[int] = 0,
         ignore_args: Optional[Tuple[str,...]] = None, # ignore these arguments when hashing
+        codec: Optional[str] = None, # compression codec for the outputs
+        batched: bool = False, # whether `f` maps a list of elements to a list of results
+        batch_size: Optional[int] = None, # max. number of elements to pass to `f` at once
         __structural__: bool = False,
         __allow_side_effects__: bool = False,
     ) -> None:
@@ -157,11 +244,21 @@ class Op:
         self.version = version
         self.output_names = output_names
         self.ignore_args = ignore_args
+        self.codec = codec
+        self.batched = batched
+        self.batch_size = batch_size
+        # whether `f` is an `async def` function, see `Storage.acall`
+        self.is_async = f is not None and inspect.iscoroutinefunction(f)
         self.__structural__ = __structural__
         self.__allow_side_effects__ = __allow_side_effects__
         self.f = f
+        self._call_plan = None
         #! make sure there's no overlap between the input and output names
         if f is not None:
+            if batched: # fail early if the function can't be batched
+                if self.is_async:
+                    raise ValueError("Batched ops can't be async")
+                CallPlan.element_signature(inspect.signature(f))
             input_names = list(inspect.signature(f).parameters.keys())
             if output_names is not None:
                 assert not any(name in output_names for name in input_names), (
@@ -181,6 +278,24 @@ class Op:
     def id(self) -> str:
         return self.name
 
+    @property
+    def call_plan(self) -> CallPlan:
+        """
+        The `CallPlan` of this op's function, compiled on first use.
+        """
+        # ops unpickled from older storages don't have the attribute
+        plan = getattr(self, "_call_plan", None)
+        if plan is None:
+            plan = CallPlan(inspect.signature(self.f), batched=getattr(self, "batched", False))
+            self._call_plan = plan
+        return plan
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the plan is cheap to recompute, and may not be picklable
+        state = self.__dict__.copy()
+        state.pop("_call_plan", None)
+        return state
+
     def _get_hashable_inputs(self, inputs: Dict[str, Ref]) -> Dict[str, Any]:
         return {k: v for k, v in inputs.items() if not isinstance(v.obj, _Ignore)}
 
@@ -196,7 +311,7 @@ class Op:
         obj = ({k: v.hid for k, v in hashable_inputs.items()}, self.name, self.version)
         if semantic_version is not None:
             obj = obj + (semantic_version,)
-        return get_content_hash(obj)
+        return _content_hash(obj)
 
     def get_call_content_id(self, inputs: Dict[str, Ref],
                             semantic_version: Optional[str] = None) -> str:
@@ -204,7 +319,7 @@ class Op:
         obj = ({k: v.cid for k, v in hashable_inputs.items()}, self.name, self.version)
         if semantic_version is not None:
             obj = obj + (semantic_version,)
-        return get_content_hash(obj)
+        return _content_hash(obj)
     
     def get_pre_call_id(self, inputs: Dict[str, Ref]) -> str:
         """
@@ -213,12 +328,12 @@ class Op:
         versions.
         """
         hashable_inputs = self._get_hashable_inputs(inputs)
-        return get_content_hash((self.name, {k: v.cid for k, v in hashable_inputs.items()}))
+        return _content_hash((self.name, {k: v.cid for k, v in hashable_inputs.items()}))
 
     def get_output_history_ids(
         self, call_history_id: str, output_names: List[str]
     ) -> Dict[str, str]:
-        return {k: get_content_hash((call_history_id, k)) for k in output_names}
+        return {k: _content_hash((call_history_id, k)) for k in output_names}
 
     def get_ordered_outputs(self, output_dict: Dict[str, Any]) -> Tuple[Any, ...]:
         if (
@@ -238,6 +353,9 @@ class Op:
             nout=self.nout,
             output_names=self.output_names,
             version=self.version,
+            codec=getattr(self, "codec", None),
+            batched=getattr(self, "batched", False),
+            batch_size=getattr(self, "batch_size", None),
             __structural__=self.__structural__,
         )
 
@@ -286,6 +404,36 @@ class Call:
         )
 
 
+# the storage whose methods are hashing values, which may be called outside
+# of its context (see `Storage.hashing`)
+_hashing_storage: contextvars.ContextVar = contextvars.ContextVar("mandala_hashing_storage", default=None)
+
+
+def _get_hashing_storage() -> Optional["Storage"]:
+    """
+    The storage doing the hashing, or else the storage of the current context
+    (if any).
+    """
+    storage = _hashing_storage.get()
+    if storage is None and Context.current_context is not None:
+        storage = Context.current_context.storage
+    return storage
+
+
+def _content_hash(obj: Any, use_cache: bool = False) -> str:
+    """
+    Content hash using the hash version of the storage returned by
+    `_get_hashing_storage`. If `use_cache`, the storage's hash cache (if any)
+    is used too.
+    """
+    storage = _get_hashing_storage()
+    version = getattr(storage, "hash_version", HASH_VERSION_JOBLIB)
+    cache = getattr(storage, "hash_cache", None) if use_cache else None
+    if cache is not None:
+        return cache.get(obj, hasher=lambda x: get_content_hash(x, version=version))
+    return get_content_hash(obj, version=version)
+
+
 def wrap_atom(obj: Any, history_id: Optional[str] = None) -> AtomRef:
     """
     Wrap a Python object in an AtomRef. If the object is already a Ref, return
@@ -303,11 +451,19 @@ def wrap_atom(obj: Any, history_id: Optional[str] = None) -> AtomRef:
         return obj
     if isinstance(obj, ValuePointer):
         # we never directly hash the object, but rather the id
-        uid = get_content_hash(obj.id) 
+        uid = _content_hash(obj.id) 
         return AtomRef(cid=uid, hid=uid, in_memory=True, obj=ValuePointer(id=obj.id, obj=None))
-    uid = get_content_hash(obj)
+    if isinstance(obj, FilePointer):
+        storage = _get_hashing_storage()
+        file_hash = storage.get_file_hash(obj.path) if storage is not None else hash_file(obj.path)
+        obj = FilePointer(path=obj.path, content_hash=file_hash)
+        uid = _content_hash((FilePointer.__name__, file_hash))
+        if history_id is None:
+            history_id = _content_hash(uid)
+        return AtomRef(cid=uid, hid=history_id, in_memory=True, obj=obj)
+    uid = _content_hash(obj, use_cache=True)
     if history_id is None:
-        history_id = get_content_hash(uid)
+        history_id = _content_hash(uid)
     return AtomRef(cid=uid, hid=history_id, in_memory=True, obj=obj)
 
 
@@ -409,16 +565,16 @@ def __make_list__(**items: Any) -> MList[Any]:
     # items must be a dict with keys "elts_0", "elts_1", etc.
     elts = [items[f"elts_{i}"] for i in range(len(items))]
     return ListRef(
-        cid=get_content_hash([elt.cid for elt in elts]),
-        hid=get_content_hash([elt.hid for elt in elts]),
+        cid=_content_hash([elt.cid for elt in elts]),
+        hid=_content_hash([elt.hid for elt in elts]),
         in_memory=True,
         obj=elts,
     )
 
 def __make_dict__(**kwargs: Any) -> dict:
     return DictRef(
-        cid=get_content_hash(sorted([(k, v.cid) for k, v in kwargs.items()])),
-        hid=get_content_hash(sorted([(k, v.hid) for k, v in kwargs.items()])),
+        cid=_content_hash(sorted([(k, v.cid) for k, v in kwargs.items()])),
+        hid=_content_hash(sorted([(k, v.hid) for k, v in kwargs.items()])),
         in_memory=True,
         obj=kwargs,
     )
@@ -428,8 +584,8 @@ def __make_dict__(**kwargs: Any) -> dict:
 def __make_set__(**kwargs: Any) -> MSet[Any]:
     elts = [kwargs[f"elts_{i}"] for i in range(len(kwargs))]
     return SetRef(
-        cid=get_content_hash(sorted([elt.cid for elt in elts])),
-        hid=get_content_hash(sorted([elt.hid for elt in elts])),
+        cid=_content_hash(sorted([elt.cid for elt in elts])),
+        hid=_content_hash(sorted([elt.hid for elt in elts])),
         in_memory=True,
         obj=set(elts),
     )
@@ -465,6 +621,9 @@ def op(
     output_names: Union[Optional[List[str]], Callable] = None,
     nout: Union[Literal["var", "auto"], int] = "auto",
     ignore_args: Optional[Tuple[str,...]] = None,
+    codec: Optional[str] = None,
+    batched: bool = False,
+    batch_size: Optional[int] = None,
     __structural__: bool = False,
     __allow_side_effects__: bool = False,
 ):
@@ -475,6 +634,16 @@ def op(
     should be ignored when hashing the function. This is useful when the
     function has arguments that are not relevant to the output, like a batch
     size.
+    - `codec` is the compression codec (e.g. "zlib", "lzma") to store the
+    outputs of the function with, overriding the codec of the storage.
+    - `async def` functions are supported: calling the op in a storage context
+    returns a coroutine, see `Storage.acall`.
+    - `batched=True` is for vectorized functions that take a list of elements
+    as their first argument and return a list with one result per element.
+    Each element is memoized as a separate call (as if the function took a
+    single element), and the function is only called on the elements that
+    are not memoized yet, at most `batch_size` at a time. Calling the op
+    returns a list with the outputs for each element.
     """
     def decorator(f: Callable, output_names = None) -> 'f': # some IDE magic to make it recognize that @op(f) has the same type as f
         res = Op(
@@ -483,6 +652,9 @@ def op(
             output_names=output_names,
             nout=nout,
             ignore_args=ignore_args,
+            codec=codec,
+            batched=batched,
+            batch_size=batch_size,
             __structural__=__structural__,
             __allow_side_effects__=__allow_side_effects__,
         )
@@ -494,9 +666,27 @@ def op(
         return lambda f: decorator(f, output_names)
 
 
-class Context:
+# the context of the innermost `with storage:` block. Each thread (and each
+# asyncio task) has its own value, so that blocks in different threads don't
+# interfere.
+_current_context: contextvars.ContextVar = contextvars.ContextVar("mandala_current_context", default=None)
+
+
+class _ContextMeta(type):
+    """
+    Makes `Context.current_context` read and write the context variable.
+    """
+    @property
+    def current_context(cls) -> Optional["Context"]:
+        return _current_context.get()
+
+    @current_context.setter
+    def current_context(cls, context: Optional["Context"]) -> None:
+        _current_context.set(context)
+
+
+class Context(metaclass=_ContextMeta):
 
-    current_context: Optional["Context"] = None
     _profiling_stats: Dict[str, float] = {
         'total_time': 0.0,
         'get_call_time': 0.0,
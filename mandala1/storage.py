@@ -2,15 +2,29 @@ from .common_imports import *
 from tqdm import tqdm
 import datetime
 from .model import *
+from .config import Config
 import sqlite3
-from .model import __make_list__, __list_getitem__, __make_dict__, __dict_getitem__, _Ignore, _NewArgDefault, ValuePointer
+import json
+import importlib
+import threading
+import contextlib
+import functools
+import contextvars
+from typing import NamedTuple
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from .model import __make_list__, __list_getitem__, __make_dict__, __dict_getitem__, _Ignore, _NewArgDefault, ValuePointer, FilePointer
+from .model import _hashing_storage
 from .utils import dataframe_to_prettytable, parse_returns, _conservative_equality_check, boundargs_to_args_kwargs
+from .utils import HASH_VERSION_JOBLIB, HASH_VERSIONS, get_content_hash, HashCache, hash_file
 from .viz import _get_colorized_diff
 from .deps.versioner import Versioner, CodeState
 from .deps.utils import get_dep_key_from_func, extract_func_obj
 from .deps.tracers import DecTracer, SysTracer, TracerABC
 from .deps.tracers.dec_impl import track
 
+if Config.has_cloudpickle:
+    import cloudpickle
+
 from .storage_utils import (
     DBAdapter,
     InMemCallStorage,
@@ -19,15 +33,90 @@ from .storage_utils import (
     SQLiteDictStorage,
     CachedCallStorage,
     JoblibDictStorage,
+    SchemaManager,
+    GarbageCollector,
+    ExistenceFilters,
+    BoundedCache,
+    ObjectCache,
+    CallLeases,
     transaction
 )
 
 
+def _call_pickled(payload: bytes) -> Any:
+    """
+    Run a function shipped to a worker process by `Storage.map`. The function
+    and its arguments are pickled with `cloudpickle`, so that ops defined in
+    closures work too.
+    """
+    f, args, kwargs = cloudpickle.loads(payload)
+    return f(*args, **kwargs)
+
+
+def _call_by_name(module: str, qualname: str, args: tuple, kwargs: Dict[str, Any]) -> Any:
+    """
+    Run the function of the op with the given import path in a worker process
+    of `Storage.map`, when `cloudpickle` is not available. (The function
+    itself can't be pickled by reference, because the module attribute is the
+    op wrapping it.)
+    """
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    f = obj.f if isinstance(obj, Op) else obj
+    return f(*args, **kwargs)
+
+
+def _hashes(method: Callable) -> Callable:
+    """
+    Decorates the methods of `Storage` that hash values, so that they use the
+    storage's hash version even outside of a `with storage:` block.
+    """
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self: "Storage", *args, **kwargs):
+            with self.hashing():
+                return await method(self, *args, **kwargs)
+    else:
+        @functools.wraps(method)
+        def wrapper(self: "Storage", *args, **kwargs):
+            with self.hashing():
+                return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _ContextState(NamedTuple):
+    """
+    The state of a `Storage` that belongs to the `with storage:` blocks of a
+    thread (or asyncio task), see `Storage._context_state`.
+    """
+    mode_stack: Tuple[str, ...] = ()
+    next_mode: str = 'run'
+    cached_versioner: Optional[Versioner] = None
+    code_state: Optional[CodeState] = None
+
+
 class Storage:
     def __init__(self, 
                  db_path: str = ":memory:", 
                  overflow_dir: Optional[str] = None,
                  overflow_threshold_MB: Optional[Union[int, float]] = 50.0,
+                 sqlite_pragmas: Optional[Dict[str, Any]] = None, # e.g. {"synchronous": "NORMAL"}
+                 codec: str = "none", # compression codec for atoms, see `storage_utils.CODECS`
+                 overflow_mmap: Optional[str] = None, # e.g. "r" to memory-map numpy arrays in the overflow storage
+                 hash_version: Optional[int] = None, # content hash version for new storages, see `utils.HASH_VERSIONS`
+                 hash_cache: Optional[str] = None, # "frozen" or "sample" to cache the hashes of inputs, see `utils.HashCache`
+                 bloom_filter: bool = False, # whether to use Bloom filters to skip lookups of new calls/refs, see `storage_utils.ExistenceFilters`
+                 cache_limits: Optional[Dict[str, int]] = None, # max bytes for the "atoms", "shapes" and/or "calls" caches
+                 eviction_policy: str = "lru", # how to evict from bounded caches, see `storage_utils.EVICTION_POLICIES`
+                 object_cache: Optional[int] = None, # max bytes of deserialized atoms to cache, see `storage_utils.ObjectCache`
+                 object_cache_mode: str = "copy", # how to protect cached objects from modification
+                 commit_every_n_calls: Optional[int] = None, # commit automatically inside `with storage:` blocks, see `maybe_autocommit`
+                 commit_every_seconds: Optional[float] = None,
+                 commit_max_dirty_bytes: Optional[int] = None,
+                 background_commits: bool = False, # write automatic commits from a background thread
+                 dedup_calls: bool = False, # compute each new call once across threads and processes (but not in `map` or batched ops), see `CallLeases`
+                 lease_timeout: float = 60.0, # seconds without a heartbeat after which a lease can be taken over
                  #! versioning config. this is too much...
                  deps_path: Optional[Union[str, Path]] = None,
                  tracer_impl: Optional[type] = None,
@@ -39,16 +128,25 @@ class Storage:
                  deps_package: Optional[str] = None,
                  track_globals: bool = True,
                  ):
-        self.db = DBAdapter(db_path=db_path)
-
+        self.db = DBAdapter(db_path=db_path, pragmas=sqlite_pragmas)
+        self._sqlite_pragmas = sqlite_pragmas
+
+        cache_limits = {} if cache_limits is None else cache_limits
+        unknown_caches = set(cache_limits) - {"atoms", "shapes", "calls"}
+        if unknown_caches:
+            raise ValueError(f"Cache limits can only be set for atoms, shapes and calls, got {unknown_caches}")
+        self.cache_limits = cache_limits
+        self.eviction_policy = eviction_policy
         self.call_storage = SQLiteCallStorage(db=self.db, table_name="calls")
-        self.calls = CachedCallStorage(persistent=self.call_storage)
-        self.call_cache = self.calls.cache
+        self.calls = CachedCallStorage(persistent=self.call_storage,
+                                       max_bytes=cache_limits.get("calls"), policy=eviction_policy)
 
         self.overflow_dir = overflow_dir
         self.overflow_threshold_MB = overflow_threshold_MB
+        self.codec = codec
+        self.overflow_mmap = overflow_mmap
         if self.overflow_dir is not None:
-            self.overflow_storage = JoblibDictStorage(root=self.overflow_dir)
+            self.overflow_storage = JoblibDictStorage(root=self.overflow_dir, codec=codec, db=self.db)
         else:
             self.overflow_storage = None
 
@@ -59,11 +157,20 @@ class Storage:
         self.atoms = CachedDictStorage(
             persistent=SQLiteDictStorage(self.db, table="atoms", 
                                          overflow_storage=self.overflow_storage,
-                                         overflow_threshold_MB=self.overflow_threshold_MB
-                                         )
+                                         overflow_threshold_MB=self.overflow_threshold_MB,
+                                         codec=codec,
+                                         overflow_arrays=True,
+                                         ),
+            max_bytes=cache_limits.get("atoms"), policy=eviction_policy,
         )
         self.shapes = CachedDictStorage(
-            persistent=SQLiteDictStorage(self.db, table="shapes")
+            persistent=SQLiteDictStorage(self.db, table="shapes"),
+            max_bytes=cache_limits.get("shapes"), policy=eviction_policy,
+        )
+        # deserialized atoms: {cid -> object}
+        self.objects = (
+            ObjectCache(max_bytes=object_cache, policy=eviction_policy, mode=object_cache_mode)
+            if object_cache is not None else None
         )
         self.ops = CachedDictStorage(
             persistent=SQLiteDictStorage(self.db, table="ops")
@@ -72,6 +179,19 @@ class Storage:
         self.sources = CachedDictStorage(
             persistent=SQLiteDictStorage(self.db, table="sources")
         )
+        # bring existing databases up to date with the current schema (indexes
+        # etc.) now that all tables are guaranteed to exist
+        self.schema = SchemaManager(db=self.db)
+        self.schema.migrate()
+        self.hash_version = self._init_hash_version(hash_version)
+        self.hash_cache = HashCache(verify=hash_cache) if hash_cache is not None else None
+        if bloom_filter:
+            self.filters = ExistenceFilters(db=self.db)
+            self.calls.hid_filter = self.filters["call_hids"]
+            self.calls.cid_filter = self.filters["call_cids"]
+            self.shapes.key_filter = self.filters["shape_hids"]
+        else:
+            self.filters = None
         if not self.sources.exists(key='versioner'):
             current_versioner = None
         else:
@@ -117,23 +237,69 @@ class Storage:
         else:
             self._versioned = False
         
-        self.cached_versioner = None
-        self.code_state = None
+        # the stack of modes etc. of the `with storage:` blocks, kept in a
+        # context variable so that threads using the storage don't interfere
+        self._context_state = contextvars.ContextVar(f"mandala_storage_{id(self)}", default=_ContextState())
+        # guards the caches against concurrent use by several threads. It's
+        # not held while running the functions of ops.
+        self._lock = threading.RLock()
         self.suspended_trace_obj = None
 
         # a list of functions to call when the storage is exited
         # each function should have a single argument, the storage object
         self._exit_hooks = []
-        # stack of modes
-        self._mode_stack = []
-        self._next_mode = 'run'
         self._allow_new_calls = True
+        # statistics about the latest call to `commit()`
+        self.last_commit_stats: Optional[Dict[str, float]] = None
+
+        # automatic commits
+        if background_commits and self.db.in_memory:
+            raise ValueError("Background commits need a database file, since in-memory databases "
+                             "are not shared between connections")
+        self.commit_every_n_calls = commit_every_n_calls
+        self.commit_every_seconds = commit_every_seconds
+        self.commit_max_dirty_bytes = commit_max_dirty_bytes
+        self.background_commits = background_commits
+        self._autocommit = any(x is not None for x in (commit_every_n_calls, commit_every_seconds,
+                                                       commit_max_dirty_bytes))
+        self._calls_since_commit = 0
+        self._last_commit_time = time.monotonic()
+        self.num_autocommits = 0
+        # deduplication of calls in flight: the new calls being computed by
+        # threads (and async tasks) of this process, and leases for other
+        # processes. Calls to async ops are always deduplicated in-process.
+        self.dedup_calls = dedup_calls
+        self.lease_timeout = lease_timeout
+        self._inflight: Dict[str, Future] = {}
+        self.leases = (
+            CallLeases(db=self.db, timeout=lease_timeout)
+            if dedup_calls and not self.db.in_memory else None
+        )
+        # the background commit in flight (if any), and the data it writes
+        self._flush_executor: Optional[ThreadPoolExecutor] = None
+        self._flush: Optional[Tuple[Future, Dict[str, Any]]] = None
     
     def dump_config(self) -> dict[str, Any]:
         return {
             "db_path": self.db.db_path,
             "overflow_dir": self.overflow_dir,
             "overflow_threshold_MB": self.overflow_threshold_MB,
+            "sqlite_pragmas": self._sqlite_pragmas,
+            "codec": self.codec,
+            "overflow_mmap": self.overflow_mmap,
+            "hash_version": self.hash_version,
+            "hash_cache": self.hash_cache.verify if self.hash_cache is not None else None,
+            "bloom_filter": self.filters is not None,
+            "cache_limits": self.cache_limits,
+            "eviction_policy": self.eviction_policy,
+            "object_cache": self.objects.cache.max_bytes if self.objects is not None else None,
+            "object_cache_mode": self.objects.mode if self.objects is not None else "copy",
+            "commit_every_n_calls": self.commit_every_n_calls,
+            "commit_every_seconds": self.commit_every_seconds,
+            "commit_max_dirty_bytes": self.commit_max_dirty_bytes,
+            "background_commits": self.background_commits,
+            "dedup_calls": self.dedup_calls,
+            "lease_timeout": self.lease_timeout,
             "deps_path": self._deps_path,
             "tracer_impl": self._tracer_impl,
             "strict_tracing": self._strict_tracing,
@@ -148,6 +314,116 @@ class Storage:
     def conn(self) -> sqlite3.Connection:
         return self.db.conn()
 
+    def _update_context_state(self, **kwargs):
+        self._context_state.set(self._context_state.get()._replace(**kwargs))
+
+    @property
+    def _mode_stack(self) -> Tuple[str, ...]:
+        return self._context_state.get().mode_stack
+
+    @property
+    def _next_mode(self) -> str:
+        return self._context_state.get().next_mode
+
+    @_next_mode.setter
+    def _next_mode(self, mode: str):
+        self._update_context_state(next_mode=mode)
+
+    @property
+    def cached_versioner(self) -> Optional[Versioner]:
+        return self._context_state.get().cached_versioner
+
+    @cached_versioner.setter
+    def cached_versioner(self, versioner: Optional[Versioner]):
+        self._update_context_state(cached_versioner=versioner)
+
+    @property
+    def code_state(self) -> Optional[CodeState]:
+        return self._context_state.get().code_state
+
+    @code_state.setter
+    def code_state(self, code_state: Optional[CodeState]):
+        self._update_context_state(code_state=code_state)
+
+    @contextlib.contextmanager
+    def hashing(self):
+        """
+        Hash values with this storage's hash version and hash cache, whether
+        or not inside a `with storage:` block.
+        """
+        token = _hashing_storage.set(self)
+        try:
+            yield
+        finally:
+            _hashing_storage.reset(token)
+
+    def _init_hash_version(self, hash_version: Optional[int]) -> int:
+        """
+        Return the version of the content hash recorded in the storage, or
+        record `hash_version` (by default, the `joblib` hash) if there is none.
+        """
+        with self.conn() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'hash_version'").fetchone()
+            if row is not None:
+                stored = int(row[0])
+                if hash_version is not None and hash_version != stored:
+                    raise ValueError(
+                        f"This storage uses hash version {stored}, but hash version {hash_version} was requested"
+                    )
+                return stored
+            if hash_version is None:
+                hash_version = HASH_VERSION_JOBLIB
+            if hash_version not in HASH_VERSIONS:
+                raise ValueError(f"Unknown hash version {hash_version}; known versions are {HASH_VERSIONS}")
+            if hash_version != HASH_VERSION_JOBLIB and conn.execute("SELECT 1 FROM calls LIMIT 1").fetchone() is not None:
+                # storages from before the version was recorded use joblib
+                raise ValueError("Cannot change the hash version of a storage that already has calls")
+            get_content_hash(None, version=hash_version) # fail early if unavailable
+            conn.execute("INSERT INTO meta (key, value) VALUES ('hash_version', ?)", (str(hash_version),))
+        return hash_version
+
+    def get_file_hash(self, path: Union[str, Path]) -> str:
+        """
+        Return the hash of the contents of the file at `path` (see
+        `utils.hash_file`). Hashes are cached in the `file_hashes` table by
+        the absolute path, size, modification time and inode of the file, so
+        that unchanged files are never re-read.
+        """
+        abs_path = os.path.abspath(path)
+        st = os.stat(abs_path)
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self.conn() as conn:
+            row = conn.execute(
+                "SELECT size, mtime_ns, inode, hash FROM file_hashes WHERE path = ?", (abs_path,)
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return row[3]
+        file_hash = hash_file(abs_path)
+        st_after = os.stat(abs_path)
+        if (st_after.st_size, st_after.st_mtime_ns, st_after.st_ino) == key:
+            # only cache the hash if the file did not change while hashing it
+            with self.conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)",
+                    (abs_path, *key, file_hash),
+                )
+        return file_hash
+
+    def close(self):
+        """
+        Close the connections to the database held by this storage, after
+        waiting for any background commit to finish.
+        """
+        with self._lock:
+            if self._flush is not None:
+                self._finish_flush()
+            if self._flush_executor is not None:
+                self._flush_executor.shutdown()
+                self._flush_executor = None
+            if self.leases is not None:
+                self.leases.close()
+            self.db.close()
+
     def vacuum(self):
         with self.conn() as conn:
             conn.execute("VACUUM")
@@ -166,39 +442,69 @@ class Storage:
     ############################################################################
     ### managing the caches
     ############################################################################
+    @property
+    def call_cache(self) -> InMemCallStorage:
+        # not an attribute, since `clear_cache` replaces the cache object
+        return self.calls.cache
+
     def clear_cache(self, allow_uncommitted: bool = False):
         self.atoms.clear(allow_uncommited=allow_uncommitted)
         self.shapes.clear(allow_uncommited=allow_uncommitted)
         self.ops.clear(allow_uncommited=allow_uncommitted)
         self.calls.clear(allow_uncommited=allow_uncommitted)
+        if self.objects is not None:
+            self.objects.clear()
         print("Cleared all caches.")
 
     def cache_info(self) -> str:
         """
-        Display information about the contents of the cache in a pretty table.
+        Display information about the contents of the cache in a pretty table,
+        including the (estimated) memory usage and, for bounded caches, the
+        budget and the evictions so far.
 
-        TODO: make a verbose version w/ a breakdown by op, and some data on
-        memory usage.
+        TODO: make a verbose version w/ a breakdown by op.
         """
+        caches = {'atoms': self.atoms, 'shapes': self.shapes, 'ops': self.ops}
+        bounded = {k: v.cache for k, v in caches.items() if isinstance(v.cache, BoundedCache)}
         df = pd.DataFrame({
             'present': [len(self.atoms.cache), len(self.shapes.cache), len(self.ops.cache), len(self.calls.cache)],
-            'dirty': [len(self.atoms.dirty_keys), len(self.shapes.dirty_keys), len(self.ops.dirty_keys), len(self.calls.dirty_hids)]
+            'dirty': [len(self.atoms.dirty_keys), len(self.shapes.dirty_keys), len(self.ops.dirty_keys), len(self.calls.dirty_hids)],
+            'MB': [v.estimated_size() / 1024 ** 2 for v in (*caches.values(), self.calls)],
+            'max_MB': [bounded[k].max_bytes / 1024 ** 2 if k in bounded else None for k in caches]
+                      + [self.calls.max_bytes / 1024 ** 2 if self.calls.max_bytes is not None else None],
+            'evictions': [bounded[k].num_evictions if k in bounded else 0 for k in caches] + [self.calls.num_evictions],
+            'evicted_MB': [bounded[k].evicted_bytes / 1024 ** 2 if k in bounded else 0 for k in caches]
+                          + [self.calls.evicted_bytes / 1024 ** 2],
         }, index=['atoms', 'shapes', 'ops', 'calls']).reset_index().rename(columns={'index': 'cache'})
-        print(dataframe_to_prettytable(df))
+        print(dataframe_to_prettytable(df.round(3)))
+        if self.objects is not None:
+            print(dataframe_to_prettytable(pd.DataFrame([{"cache": "objects", **self.objects.stats()}]).round(3)))
+        if self.filters is not None:
+            print(dataframe_to_prettytable(self.filters.stats().round(4)))
+
+    def rebuild_bloom_filters(self):
+        """
+        Rebuild the Bloom filters from the tables, e.g. after the database was
+        written to by an older version of this package.
+        """
+        if self.filters is None:
+            raise ValueError("This storage does not use Bloom filters; pass `bloom_filter=True`")
+        self.filters.rebuild()
 
+    # NOTE: the preloaded values are added to the (possibly bounded) caches,
+    # so that dirty values are kept, and budgets are respected
     def preload_calls(self):
         df = self.call_storage.get_df()
-        self.call_cache.df = df
-        self.call_cache.call_hids = set(df.index.levels[0].unique())
+        self.calls.load_df(df)
     
     def preload_shapes(self):
-        self.shapes.cache = self.shapes.persistent.load_all()
+        self.shapes.cache.update(self.shapes.persistent.load_all())
     
     def preload_ops(self):
-        self.ops.cache = self.ops.persistent.load_all()
+        self.ops.cache.update(self.ops.persistent.load_all())
 
     def preload_atoms(self):
-        self.atoms.cache = self.atoms.persistent.load_all()
+        self.atoms.cache.update(self.atoms.persistent.load_all())
     
     def preload(self, lazy: bool = True):
         self.preload_calls()
@@ -207,14 +513,178 @@ class Storage:
         if not lazy:
             self.preload_atoms()
 
-    def commit(self):
-        with self.conn() as conn:
-            self.atoms.commit(conn=conn)
-            self.shapes.commit(conn=conn)
-            self.ops.commit(conn=conn)
-            if self.versioned:
-                self.sources.persistent.set(key='versioner', value=self.sources.cache['versioner'], conn=conn)
-            self.calls.commit(conn=conn)
+    def commit(self, conn: Optional[sqlite3.Connection] = None):
+        """
+        Write all new atoms, shapes, ops and calls to the database in a single
+        transaction, using one batched insert per table.
+        """
+        with self._lock:
+            # the background commit must go first, and we can't wait for it
+            # while holding the write lock of the database
+            if self._flush is not None:
+                self._finish_flush()
+            self._commit(conn=conn)
+            self._calls_since_commit = 0
+            self._last_commit_time = time.monotonic()
+            if self.leases is not None:
+                self.leases.release_committed(self.calls.dirty_hids)
+
+    @transaction
+    def _commit(self, conn: Optional[sqlite3.Connection] = None):
+        start = time.perf_counter()
+        if self.filters is not None: # pick up the commits of other processes
+            self.filters.sync(conn=conn)
+        # keep track of the cids of shapes for garbage collection
+        conn.executemany(
+            "INSERT OR REPLACE INTO shape_cids (hid, cid) VALUES (?, ?)",
+            [(hid, self.shapes.cache[hid].cid) for hid in self.shapes.dirty_keys],
+        )
+        num_rows = {
+            "atoms": self.atoms.commit(conn=conn),
+            "shapes": self.shapes.commit(conn=conn),
+            "ops": self.ops.commit(conn=conn),
+        }
+        if self.versioned:
+            self.sources.persistent.set(key='versioner', value=self.sources.cache['versioner'], conn=conn)
+        num_rows["calls"] = self.calls.commit(conn=conn)
+        total_rows = sum(num_rows.values())
+        if total_rows > 0:
+            # lets the Bloom filters (of this and other storages) detect new writes
+            commit_count = ExistenceFilters.bump_commit_count(conn)
+            if self.filters is not None:
+                self.filters.commit_count = commit_count
+                self.filters.save(conn=conn)
+        elapsed = time.perf_counter() - start
+        self.last_commit_stats = {
+            **num_rows,
+            "seconds": elapsed,
+            "rows_per_second": total_rows / elapsed if elapsed > 0 else float("inf"),
+        }
+        # only be chatty about commits that take a noticeable amount of time
+        log = logger.info if elapsed > 1.0 else logger.debug
+        log(f"Committed {total_rows} rows ({num_rows}) in {elapsed:.2f}s "
+            f"({self.last_commit_stats['rows_per_second']:.0f} rows/s).")
+
+    ############################################################################
+    ### automatic commits
+    ############################################################################
+    def _autocommit_due(self) -> bool:
+        if self._calls_since_commit == 0:
+            return False
+        if self.commit_every_n_calls is not None and self._calls_since_commit >= self.commit_every_n_calls:
+            return True
+        if self.commit_max_dirty_bytes is not None and self.atoms.dirty_bytes >= self.commit_max_dirty_bytes:
+            return True
+        if (self.commit_every_seconds is not None and
+            time.monotonic() - self._last_commit_time >= self.commit_every_seconds):
+            return True
+        return False
+
+    def maybe_autocommit(self):
+        """
+        Commit if one of the `commit_every_n_calls`, `commit_every_seconds` or
+        `commit_max_dirty_bytes` thresholds was reached since the last commit.
+        This is called after every call in "run" mode, so that a long-running
+        `with storage:` block doesn't hold all of its results in RAM until the
+        end, or lose them all if the process dies.
+
+        Committed atoms are dropped from the cache, and will be loaded back
+        from the database if needed. With `background_commits`, the data is
+        written by a background thread while the computation goes on; there is
+        at most one such commit in flight at any time.
+        """
+        if self._flush is not None and self._flush[0].done():
+            self._finish_flush()
+        if not self._autocommit_due():
+            return
+        if self.background_commits:
+            if self._flush is not None:
+                # the previous batch is still being written; keep going unless
+                # we are way over the memory budget
+                if (self.commit_max_dirty_bytes is None or
+                    self.atoms.dirty_bytes < 2 * self.commit_max_dirty_bytes):
+                    return
+                self._finish_flush()
+            self._start_flush()
+        else:
+            atom_keys = list(self.atoms.dirty_keys)
+            self.commit()
+            self._drop_committed_atoms(atom_keys)
+        self.num_autocommits += 1
+
+    def _drop_committed_atoms(self, keys: Iterable[str]):
+        for key in keys:
+            if key not in self.atoms.dirty_keys:
+                self.atoms.cache.pop(key, None)
+
+    def _start_flush(self):
+        """
+        Take a snapshot of the dirty data and write it in the background. The
+        data stays dirty (and in the caches) until the write is finished by
+        `_finish_flush()`.
+        """
+        batch = {
+            "atoms": self.atoms.dirty_items(),
+            "shapes": self.shapes.dirty_items(),
+            "ops": self.ops.dirty_items(),
+            "calls": self.calls.dirty_data(),
+        }
+        if self._flush_executor is None:
+            self._flush_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mandala-commit")
+        future = self._flush_executor.submit(self._write_batch, batch)
+        self._flush = (future, batch)
+        self._calls_since_commit = 0
+        self._last_commit_time = time.monotonic()
+
+    @transaction
+    def _write_batch(self, batch: Dict[str, Any], conn: Optional[sqlite3.Connection] = None
+                     ) -> Tuple[Dict[str, int], int, Optional[int]]:
+        """
+        Write a snapshot taken by `_start_flush()` in a single transaction,
+        without touching the caches (this runs in the background thread).
+        Return the number of rows per table, and the commit count before and
+        after this commit (or `None` if nothing was written).
+        """
+        shape_items, _ = batch["shapes"]
+        conn.executemany(
+            "INSERT OR REPLACE INTO shape_cids (hid, cid) VALUES (?, ?)",
+            [(hid, shape.cid) for hid, shape in shape_items.items()],
+        )
+        num_rows = {
+            "atoms": self.atoms.write(*batch["atoms"], conn=conn),
+            "shapes": self.shapes.write(*batch["shapes"], conn=conn),
+            "ops": self.ops.write(*batch["ops"], conn=conn),
+            "calls": self.calls.write(batch["calls"], conn=conn),
+        }
+        prev_count = ExistenceFilters.get_commit_count(conn)
+        commit_count = None
+        if sum(num_rows.values()) > 0:
+            commit_count = ExistenceFilters.bump_commit_count(conn)
+        return num_rows, prev_count, commit_count
+
+    def _finish_flush(self):
+        """
+        Wait for the background commit in flight, and mark its data as
+        committed. If it failed, the error is raised here, and the data stays
+        dirty to be written by the next commit.
+        """
+        future, batch = self._flush
+        self._flush = None
+        num_rows, prev_count, commit_count = future.result()
+        self.atoms.mark_committed(batch["atoms"][0])
+        self.shapes.mark_committed(batch["shapes"][0])
+        self.ops.mark_committed(batch["ops"][0])
+        self.calls.mark_committed(batch["calls"])
+        self._drop_committed_atoms(batch["atoms"][0])
+        if self.leases is not None:
+            self.leases.release_committed(self.calls.dirty_hids)
+        # if another process committed since the filters were synced, leave
+        # them behind so that the next sync picks up its commits
+        if self.filters is not None and commit_count is not None and prev_count == self.filters.commit_count:
+            self.filters.commit_count = commit_count
+            with self.conn() as conn:
+                self.filters.save(conn=conn)
+        logger.debug(f"Committed {sum(num_rows.values())} rows ({num_rows}) in the background.")
 
 
     def __repr__(self):
@@ -242,26 +712,29 @@ class Storage:
     ############################################################################
     ### refs interface
     ############################################################################
-    def save_ref(self, ref: Ref):
+    def save_ref(self, ref: Ref, codec: Optional[str] = None):
         """
         NOTE: the given ref may not be in memory, but may still be a new history
         ID, if there was previously another ref with the same content ID but
         different history ID.
+
+        `codec` overrides the storage's compression codec for the atoms of
+        this ref.
         """
         if ref.hid in self.shapes:  # ensure idempotence
             return
         if isinstance(ref, AtomRef):
             if ref.in_memory: #! ONLY save the atom if it is in memory
-                self.atoms[ref.cid] = serialize(ref.obj)
+                self.atoms.set(ref.cid, serialize(ref.obj), codec=codec)
             self.shapes[ref.hid] = ref.detached()
         elif isinstance(ref, ListRef):
             self.shapes[ref.hid] = ref.shape()
             for i, elt in enumerate(ref):
-                self.save_ref(elt)
+                self.save_ref(elt, codec=codec)
         elif isinstance(ref, DictRef):
             self.shapes[ref.hid] = ref.shape()
             for k, v in ref.items():
-                self.save_ref(v)
+                self.save_ref(v, codec=codec)
                 # self.save_ref(k)
         else:
             raise NotImplementedError
@@ -273,25 +746,55 @@ class Storage:
 
         TODO: add option to disable automatic caching of atoms.
         """
+        self.prefetch_refs([hid], in_memory=in_memory)
+        return self._load_ref(hid, in_memory=in_memory)
+
+    def _load_ref(self, hid: str, in_memory: bool) -> Ref:
         shape = self.shapes[hid]
         if isinstance(shape, AtomRef):
             if in_memory:
                 return shape.shallow_copy()
             else:
-                return shape.attached(obj=deserialize(self.atoms[shape.cid]))
+                return shape.attached(obj=self._load_atom(shape.cid))
         elif isinstance(shape, ListRef):
             obj = []
             for i, elt in enumerate(shape):
-                obj.append(self.load_ref(elt.hid, in_memory=in_memory))
-            return shape.attached(obj=shape.obj)
+                obj.append(self._load_ref(elt.hid, in_memory=in_memory))
+            return shape.attached(obj=obj)
         elif isinstance(shape, DictRef):
             obj = {}
             for k, v in shape.items():
-                obj[k] = self.load_ref(v.hid, in_memory=in_memory)
+                obj[k] = self._load_ref(v.hid, in_memory=in_memory)
             return shape.attached(obj=obj)
         else:
             raise NotImplementedError
 
+    def prefetch_refs(self, hids: Iterable[str], in_memory: bool):
+        """
+        Load the shapes of the refs with the given hids and of the refs nested
+        in them into the cache, one level of nesting at a time with batched
+        queries, together with the atoms unless `in_memory`. Missing hids are
+        skipped.
+        """
+        frontier = list(dict.fromkeys(hids))
+        cids = []
+        while len(frontier) > 0:
+            self.shapes.prefetch(frontier)
+            next_frontier = []
+            for hid in frontier:
+                shape = self.shapes.cache.get(hid)
+                if isinstance(shape, AtomRef):
+                    cids.append(shape.cid)
+                elif isinstance(shape, ListRef):
+                    next_frontier.extend(elt.hid for elt in shape)
+                elif isinstance(shape, DictRef):
+                    next_frontier.extend(v.hid for v in shape.values())
+            frontier = list(dict.fromkeys(next_frontier))
+        if not in_memory:
+            if self.objects is not None:
+                cids = [cid for cid in cids if cid not in self.objects]
+            self.atoms.prefetch(cids)
+
     def _drop_ref_hid(self, hid: str, verify: bool = False):
         """
         Internal only function to drop a ref by its hid when it is not connected
@@ -300,6 +803,8 @@ class Storage:
         if verify:
             assert not self.call_storage.exists_ref_hid(hid)
         self.shapes.drop(hid)
+        with self.conn() as conn:
+            conn.execute("DELETE FROM shape_cids WHERE hid = ?", (hid,))
 
     def _drop_ref(self, cid: str, verify: bool = False):
         """
@@ -307,23 +812,45 @@ class Storage:
         to any calls and is not in the `shapes` table.
         """
         if verify:
-            assert cid not in [shape.cid for shape in self.shapes.persistent.values()]
+            with self.conn() as conn:
+                assert conn.execute("SELECT 1 FROM shape_cids WHERE cid = ? LIMIT 1", (cid,)).fetchone() is None
         self.atoms.drop(cid)
 
     def cleanup_refs(self):
         """
         Remove all refs that are not connected to any calls.
         """
-        ### first, remove hids that are not connected to any calls
-        orphans = self.get_orphans()
-        logger.info(f"Cleaning up {len(orphans)} orphaned refs.")
-        for hid in orphans:
-            self._drop_ref_hid(hid)
-        ### next, remove cids that are not connected to any refs
-        unreferenced_cids = self.get_unreferenced_cids()
-        logger.info(f"Cleaning up {len(unreferenced_cids)} unreferenced cids.")
-        for cid in unreferenced_cids:
-            self._drop_ref(cid)
+        report = self.gc()
+        logger.info(f"Cleaned up {report['orphaned_shapes']} orphaned refs and "
+                    f"{report['unreferenced_atoms'] + report['unreferenced_overflow']} unreferenced cids.")
+
+    def gc(self, dry_run: bool = False, time_budget: Optional[float] = None,
+           batch_size: int = 1000) -> Dict[str, Any]:
+        """
+        Garbage-collect the refs that are not connected to any calls, and the
+        atoms (including in the overflow storage) that are no longer used by
+        any refs. See `GarbageCollector` for details.
+
+        - `dry_run`: only report what would be deleted, and how many bytes this
+        would reclaim;
+        - `time_budget`: stop after (roughly) this many seconds. Calling `gc`
+        again continues the collection; the report has `complete=False` if
+        the collection was interrupted;
+        - `batch_size`: how many keys to delete per transaction.
+        """
+        if self.in_context():
+            raise NotImplementedError("Method not supported while in a context.")
+        collector = GarbageCollector(db=self.db, atoms=self.atoms, shapes=self.shapes, objects=self.objects)
+        report = collector.collect(dry_run=dry_run, time_budget=time_budget, batch_size=batch_size)
+        if dry_run:
+            df = pd.DataFrame({
+                "kind": ["orphaned shapes", "unreferenced atoms", "unreferenced overflow atoms"],
+                "count": [report["orphaned_shapes"], report["unreferenced_atoms"], report["unreferenced_overflow"]],
+                "MB": [report[f"{k}_bytes"] / 1024 / 1024 for k in ("orphaned_shapes", "unreferenced_atoms", "unreferenced_overflow")],
+            })
+            print(dataframe_to_prettytable(df.round(3)))
+            print(f"Total reclaimable: {report['reclaimable_bytes'] / 1024 / 1024:.3f} MB")
+        return report
 
     ############################################################################
     ### calls interface
@@ -344,10 +871,15 @@ class Storage:
             logger.debug(f"Caching new op {call.op.name}.")
             self.ops[call.op.name] = call.op.detached()
         # (convert the iterator to a list to avoid double iteration)
-        io_refs = list(itertools.chain(call.inputs.values(), call.outputs.values()))
-        for v in io_refs:
+        for v in call.inputs.values():
             self.save_ref(v)
+        # ops may choose a codec for their outputs (ops loaded from older
+        # storages don't have the attribute)
+        codec = getattr(call.op, "codec", None)
+        for v in call.outputs.values():
+            self.save_ref(v, codec=codec)
         self.calls.save(call)
+        self._calls_since_commit += 1
     
     def mget_call(self, hids: List[str], in_memory: bool) -> List[Call]:
 
@@ -373,23 +905,34 @@ class Storage:
         db_datas = self.call_storage.mget_data(call_hids=db_part)
         call_datas = merge_lists(cache_datas, db_datas, mask)
 
+        # load all the refs of all the calls with a few batched queries
+        self.prefetch_refs(
+            [hid for call_data in call_datas
+             for hid in itertools.chain(call_data["input_hids"].values(), call_data["output_hids"].values())],
+            in_memory=in_memory,
+        )
         calls = []
         for call_data in call_datas:
-            calls.append(self._get_call_from_data(call_data, in_memory=in_memory))
+            calls.append(self._get_call_from_data(call_data, in_memory=in_memory, prefetch=False))
         return calls
     
-    def _get_call_from_data(self, call_data: Dict[str, Any], in_memory: bool) -> Call:
+    def _get_call_from_data(self, call_data: Dict[str, Any], in_memory: bool, prefetch: bool = True) -> Call:
+        if prefetch:
+            self.prefetch_refs(
+                itertools.chain(call_data["input_hids"].values(), call_data["output_hids"].values()),
+                in_memory=in_memory,
+            )
         op_name = call_data["op_name"]
         call = Call(
             op=self.ops[op_name],
             cid=call_data["cid"],
             hid=call_data["hid"],
             inputs={
-                k: self.load_ref(v, in_memory=in_memory)
+                k: self._load_ref(v, in_memory=in_memory)
                 for k, v in call_data["input_hids"].items()
             },
             outputs={
-                k: self.load_ref(v, in_memory=in_memory)
+                k: self._load_ref(v, in_memory=in_memory)
                 for k, v in call_data["output_hids"].items()
             },
             semantic_version=call_data.get("semantic_version", None),
@@ -422,15 +965,12 @@ class Storage:
             )
             hids |= dependent_call_hids
         num_dropped_cache = 0
-        num_dropped_persistent = 0
         for hid in hids:
             if self.call_cache.exists(hid):
-                self.call_cache.drop(hid)
+                self.calls.drop(hid)
                 num_dropped_cache += 1
-        for hid in hids:
-            if self.call_storage.exists(hid, conn=conn):
-                self.call_storage.drop(hid, conn=conn)
-                num_dropped_persistent += 1
+        num_dropped_persistent = self.call_storage.mdrop(hids, conn=conn)
+        self.calls.clear_missing()
         logger.info(f"Dropped {num_dropped_persistent} calls (and {num_dropped_cache} from cache).")
 
     ############################################################################
@@ -465,10 +1005,12 @@ class Storage:
         """
         if self.in_context():
             raise NotImplementedError("Method not supported while in a context.")
-        all_hids = set(self.shapes.persistent.keys())
-        df = self.call_storage.get_df()
-        hids_in_calls = df["ref_history_id"].unique()
-        return all_hids - set(hids_in_calls)
+        with self.conn() as conn:
+            rows = conn.execute(
+                "SELECT s.key FROM shapes AS s WHERE NOT EXISTS "
+                "(SELECT 1 FROM calls AS c WHERE c.ref_history_id = s.key)"
+            ).fetchall()
+        return {row[0] for row in rows}
 
     def get_unreferenced_cids(self) -> Set[str]:
         """
@@ -476,23 +1018,60 @@ class Storage:
         """
         if self.in_context():
             raise NotImplementedError("Method not supported while in a context.")
-        all_cids = set(self.atoms.persistent.keys())
-        df = self.call_storage.get_df()
-        cids_in_calls = df["ref_content_id"].unique()
-        cids_in_shapes = [shape.cid for shape in self.shapes.persistent.values()]
-        return (all_cids - set(cids_in_calls)) - set(cids_in_shapes)
+        condition = (
+            "NOT EXISTS (SELECT 1 FROM calls AS c WHERE c.ref_content_id = {cid}) "
+            "AND NOT EXISTS (SELECT 1 FROM shape_cids AS sc WHERE sc.cid = {cid})"
+        )
+        with self.conn() as conn:
+            rows = conn.execute(
+                f"SELECT a.key FROM atoms AS a WHERE {condition.format(cid='a.key')}"
+            ).fetchall()
+            res = {row[0] for row in rows}
+            if self.overflow_storage is not None:
+                rows = conn.execute(
+                    f"SELECT m.key FROM {self.overflow_storage.manifest_table} AS m "
+                    f"WHERE {condition.format(cid='m.key')}"
+                ).fetchall()
+                res |= {row[0] for row in rows}
+        return res
 
     ############################################################################
     ###
     ############################################################################
+    def _load_atom(self, cid: str, cache: bool = True) -> Any:
+        """
+        Load the object of the atom with the given content ID. With
+        `overflow_mmap`, numpy arrays in the overflow storage are returned as
+        (read-only, for mode "r") memory maps instead of being read into
+        memory, and are not cached in `self.atoms`.
+
+        If there is an object cache, the deserialized object is cached there
+        instead of the serialized value in `self.atoms`. Nothing is cached if
+        `cache` is False.
+        """
+        if self.objects is not None and cid in self.objects:
+            return self.objects.get(cid)
+        if (self.overflow_mmap is not None and cid not in self.atoms.cache
+                and self.overflow_storage is not None and self.overflow_storage.exists(cid)):
+            obj = self.overflow_storage.get(cid, mmap_mode=self.overflow_mmap)
+            if isinstance(obj, np.ndarray):
+                return obj
+            # overflow values written before arrays were stored as such
+            return deserialize(obj)
+        if cache and self.objects is None:
+            return deserialize(self.atoms[cid])
+        data = self.atoms.cache[cid] if cid in self.atoms.cache else self.atoms.persistent.get(cid)
+        obj = deserialize(data)
+        if cache:
+            if cid not in self.atoms.dirty_keys: # move it to the object cache
+                self.atoms.cache.pop(cid, None)
+            return self.objects.put(cid, obj)
+        return obj
+
     def _unwrap_atom(self, obj: Any, cache: bool = True) -> Any:
-        # TODO: implement `cache = False` in `load_ref`
         assert isinstance(obj, AtomRef)
         if not obj.in_memory:
-            ref = self.load_ref(hid=obj.hid, in_memory=False)
-            if cache:
-                self.atoms[obj.cid] = serialize(ref.obj)
-            return ref.obj
+            return self._load_atom(obj.cid, cache=cache)
         else:
             return obj.obj
 
@@ -505,11 +1084,11 @@ class Storage:
                 return ref.attached(obj=ref.obj)
         else:
             if inplace:
-                ref.obj = deserialize(self.atoms[ref.cid])
+                ref.obj = self._load_atom(ref.cid)
                 ref.in_memory = True
                 return None
             else:
-                return ref.attached(obj=deserialize(self.atoms[ref.cid]))
+                return ref.attached(obj=self._load_atom(ref.cid))
 
     def unwrap(self, obj: Any, cache: bool = True) -> Any:
         """
@@ -520,7 +1099,8 @@ class Storage:
         NOTE: will trigger a load from the storage backend when some of the
         objects are not in memory.
         """
-        return recurse_on_ref_collections(self._unwrap_atom, obj, **{"cache": cache})
+        with self._lock:
+            return recurse_on_ref_collections(self._unwrap_atom, obj, **{"cache": cache})
 
     def attach(self, obj: T, inplace: bool = False) -> Optional[T]:
         """
@@ -571,6 +1151,7 @@ class Storage:
         else:
             raise NotImplementedError
 
+    @_hashes
     def construct(self, tp: Type, val: Any) -> Tuple[Ref, List[Call]]:
         """
         Given a target type and a value, construct a `Ref` of the target type,
@@ -636,6 +1217,7 @@ class Storage:
         else:
             raise NotImplementedError
     
+    @_hashes
     def lookup_call(
         self,
         op: Op,
@@ -664,22 +1246,59 @@ class Storage:
             else:
                 logger.debug(f"Found semantic version {lookup_outcome[1]} for {op.name}.")
                 _, semantic_version = lookup_outcome
-        ### first, look up by history ID
+        ### look up by history ID, or else by content ID (in one query)
         call_hid = op.get_call_history_id(
             inputs=inputs,
             semantic_version=semantic_version,
         )
-        if self.calls.exists(call_history_id=call_hid):
-            call_data = self.calls.get_data(call_history_id=call_hid)
+        if self.call_cache.exists(call_hid): # skip computing the content ID
             logger.debug(f"Found call to {op.name} with hid {call_hid}.")
-            return self._get_call_from_data(call_data, in_memory=True)
-        ### if this fails, look up by content ID, and apply the correct history IDs
+            return self._get_call_from_data(self.calls.get_data(call_hid), in_memory=True)
         call_cid = op.get_call_content_id(
             inputs=inputs, semantic_version=semantic_version
         )
-        if self.calls.exists_content(cid=call_cid):
-            logger.debug(f"Found call to {op.name} with cid {call_cid}.")
-            call_data = self.calls.get_data_content(cid=call_cid)
+        call_data = self.calls.lookup(call_history_id=call_hid, cid=call_cid)
+        if call_data is None:
+            logger.debug(f"Could not find a call to {op.name} with hid {call_hid} or cid {call_cid}.")
+            return None
+        return self._call_from_lookup(op=op, inputs=inputs, call_hid=call_hid, call_data=call_data)
+
+    @_hashes
+    def lookup_calls(self, op: Op, inputs: List[Dict[str, Ref]]) -> List[Optional[Call]]:
+        """
+        Batched version of `lookup_call` for an unversioned storage: look up
+        the calls to `op` on each of the given inputs with a single query.
+        """
+        ids = [
+            (op.get_call_history_id(inputs=inp, semantic_version=None),
+             op.get_call_content_id(inputs=inp, semantic_version=None))
+            for inp in inputs
+        ]
+        call_datas = self.calls.mlookup(ids)
+        # load all the refs of the found calls with a few batched queries
+        self.prefetch_refs(
+            [hid for call_data in call_datas if call_data is not None
+             for hid in itertools.chain(call_data["input_hids"].values(), call_data["output_hids"].values())],
+            in_memory=True,
+        )
+        return [
+            None if call_data is None else
+            self._call_from_lookup(op=op, inputs=inp, call_hid=call_hid, call_data=call_data)
+            for inp, (call_hid, _), call_data in zip(inputs, ids, call_datas)
+        ]
+
+    def _call_from_lookup(self, op: Op, inputs: Dict[str, Ref], call_hid: str,
+                          call_data: Dict[str, Any]) -> Call:
+        """
+        Make the call for the given history ID from the data found by a lookup
+        (which may belong to a call with the same content ID).
+        """
+        if call_data["hid"] == call_hid:
+            logger.debug(f"Found call to {op.name} with hid {call_hid}.")
+            return self._get_call_from_data(call_data, in_memory=True)
+        ### if this fails, use the call with the same content ID, and apply the correct history IDs
+        else:
+            logger.debug(f"Found call to {op.name} with cid {call_data['cid']}.")
             call_prototype = self._get_call_from_data(call_data, in_memory=True)
             #! very important: set the hids here on both the call and the inputs
             # and outputs
@@ -691,10 +1310,10 @@ class Storage:
             for k, v in call_prototype.inputs.items():
                 v.hid = inputs[k].hid
             return call_prototype
-        logger.debug(f"Could not find a call to {op.name} with hid {call_hid} or cid {call_cid}.")
-        return None
     
-    def get_defaults(self, f: Callable) -> Dict[str, Any]:
+    def get_defaults(self, f: Union[Callable, Op]) -> Dict[str, Any]:
+        if isinstance(f, Op):
+            return dict(f.call_plan.default_values)
         return {
             k: v.default
             for k, v in inspect.signature(f).parameters.items()
@@ -702,19 +1321,22 @@ class Storage:
         }
     
     def parse_args(self, sig: inspect.Signature, args, kwargs, apply_defaults: bool, 
-                   ignore_args: Optional[Tuple[str,...]] = None) -> Tuple[inspect.BoundArguments, Dict[str, Any], Dict[str, Any]]:
+                   ignore_args: Optional[Tuple[str,...]] = None,
+                   plan: Optional[CallPlan] = None,
+                   ) -> Tuple[inspect.BoundArguments, Dict[str, Any], Dict[str, Any]]:
         """
         Given the inputs passed to an @op call (could be wrapped or unwrapped),
         figure out the inputs we should pass to storage functions, their type
         annotations, and the inputs we should pass to function calls.
          
         Handles ignored values and/or new arg defaults that should be ignored.
+
+        If the `CallPlan` of the op's function is passed, the information about
+        the signature is taken from it instead of being recomputed.
         """
-        var_positional = [p for p in sig.parameters.values() if p.kind == p.VAR_POSITIONAL]
-        var_positional = var_positional[0] if len(var_positional) > 0 else None
-        var_keyword = [p for p in sig.parameters.values() if p.kind == p.VAR_KEYWORD]
-        var_keyword = var_keyword[0] if len(var_keyword) > 0 else None
-        default_values = {k: v.default for k, v in sig.parameters.items() if v.default is not inspect.Parameter.empty}
+        if plan is None:
+            plan = CallPlan(sig)
+        var_positional, var_keyword, default_values = plan.var_positional, plan.var_keyword, plan.default_values
         bound_arguments = sig.bind(*args, **kwargs)
         if apply_defaults:
             bound_arguments.apply_defaults()
@@ -770,6 +1392,7 @@ class Storage:
                     storage_annotations[k] = sig.parameters[k].annotation
         return bound_arguments, storage_inputs, storage_annotations
         
+    @_hashes
     def call_internal(
         self,
         op: Op,
@@ -789,120 +1412,275 @@ class Storage:
 
         must_version_call = self.versioned and not op.__structural__
 
-        wrapped_inputs = {}
-        input_calls = []
-        for k, v in storage_inputs.items():
-            wrapped_inputs[k], struct_calls = self.construct(tp=storage_tps[k], val=v)
-            input_calls.extend(struct_calls)
-        if len(input_calls) > 0:
-            if not op.__structural__: logger.debug(f"Collected {len(input_calls)} calls for inputs.")
+        with self._lock:
+            wrapped_inputs, input_calls = self._wrap_inputs(storage_inputs, storage_tps)
+            if len(input_calls) > 0:
+                if not op.__structural__: logger.debug(f"Collected {len(input_calls)} calls for inputs.")
 
-        if must_version_call:
-            suspended_trace_obj = self.cached_versioner.TracerCls.get_active_trace_obj()
-            self.cached_versioner.TracerCls.set_active_trace_obj(trace_obj=None)
-        else:
-            suspended_trace_obj = None
+            if must_version_call:
+                suspended_trace_obj = self.cached_versioner.TracerCls.get_active_trace_obj()
+                self.cached_versioner.TracerCls.set_active_trace_obj(trace_obj=None)
+            else:
+                suspended_trace_obj = None
 
-        ### check for the call
-        pre_call_id = op.get_pre_call_id(wrapped_inputs)
-        call_option = self.lookup_call(
-            op=op,
-            pre_call_uid=pre_call_id,
-            inputs=wrapped_inputs,
-            # code_state=self.guess_code_state() if must_version_call else None,
-            code_state = self.code_state if must_version_call else None,
-            versioner=self.cached_versioner if must_version_call else None,
-            must_version=must_version_call,
-        )
-        tracer_option = (
-            self.cached_versioner.make_tracer() if must_version_call and not op.__structural__ else None
-        )
+            ### check for the call
+            pre_call_id = op.get_pre_call_id(wrapped_inputs)
+            call_option = self.lookup_call(
+                op=op,
+                pre_call_uid=pre_call_id,
+                inputs=wrapped_inputs,
+                # code_state=self.guess_code_state() if must_version_call else None,
+                code_state = self.code_state if must_version_call else None,
+                versioner=self.cached_versioner if must_version_call else None,
+                must_version=must_version_call,
+            )
+            tracer_option = (
+                self.cached_versioner.make_tracer() if must_version_call and not op.__structural__ else None
+            )
 
-        call_exists = (call_option is not None)
-        if call_exists:
-            call_hid = call_option.hid
-            if not op.__structural__: logger.debug(f"Call to {op.name} with hid {call_hid} already exists.")
-            main_call = call_option
-            return main_call.outputs, main_call, input_calls
-        
-        if not self._allow_new_calls:
-            # caller should decide how to handle this
-            raise RuntimeError(f"Call to {op.name} does not exist and new calls are not allowed.")
-
-        ### execute the call if it doesn't exist
-        if not op.__structural__: 
-            # logger.debug(f"Call to {op.name} with hid {call_hid} does not exist; executing.")
-            input_hids = {k: v.hid for k, v in wrapped_inputs.items()}
-            logger.debug(f"HIDs of inputs: {input_hids}")
-        # call the function
-        f, sig = op.f, inspect.signature(op.f)
-        if op.__structural__:
-            returns = f(**wrapped_inputs)
-        else:
-            # # guard against side effects
-            # cids_before = {k: v.cid for k, v in wrapped_inputs.items()}
-            # raw_values = {k: self.unwrap(v) for k, v in wrapped_inputs.items()}
-            ### we must run the function
-            kwargs = {}
-            if kwarg_keys is not None:
-                for k in kwarg_keys:
-                    if k in bound_arguments.arguments:
-                        kwargs[k] = bound_arguments.arguments[k]
-                        del bound_arguments.arguments[k]
-                    else: # must be a var keyword
-                        # figure out the name of the var keyword
-                        var_keyword = [p for p in sig.parameters.values() if p.kind == p.VAR_KEYWORD]
-                        var_keyword = var_keyword[0] if len(var_keyword) > 0 else None
-                        assert var_keyword is not None
-                        varkwargs = bound_arguments.arguments[var_keyword.name]
-                        kwargs[k] = varkwargs[k]
-                        del varkwargs[k]
-            args, leftover_kwargs = bound_arguments.args, bound_arguments.kwargs
-            args = self.unwrap(args)
-            kwargs.update(leftover_kwargs)
-            kwargs = self.unwrap(kwargs)
-            # replace any ValuePointer instances with their underlying objects
-            kwargs = {k: v.obj if isinstance(v, ValuePointer) else v for k, v in kwargs.items()}  
-            args = tuple([v.obj if isinstance(v, ValuePointer) else v for v in args])
-
-            if tracer_option is not None:
-                tracer = tracer_option
-                with tracer:
-                    if isinstance(tracer, DecTracer):
-                        f = track(op.f)
-                        node = tracer.register_call(func=f)
-                    #! call the function
+            call_exists = (call_option is not None)
+            if call_exists:
+                call_hid = call_option.hid
+                if not op.__structural__: logger.debug(f"Call to {op.name} with hid {call_hid} already exists.")
+                main_call = call_option
+                return main_call.outputs, main_call, input_calls
+            
+            if not self._allow_new_calls:
+                # caller should decide how to handle this
+                raise RuntimeError(f"Call to {op.name} does not exist and new calls are not allowed.")
+
+            ### execute the call if it doesn't exist
+            if not op.__structural__: 
+                # logger.debug(f"Call to {op.name} with hid {call_hid} does not exist; executing.")
+                input_hids = {k: v.hid for k, v in wrapped_inputs.items()}
+                logger.debug(f"HIDs of inputs: {input_hids}")
+                # # guard against side effects
+                # cids_before = {k: v.cid for k, v in wrapped_inputs.items()}
+                # raw_values = {k: self.unwrap(v) for k, v in wrapped_inputs.items()}
+                args, kwargs = self._get_call_args(op, bound_arguments, kwarg_keys)
+
+        # unless another thread or process is computing the same call already
+        claimed_hid = None
+        if self.dedup_calls and not op.__structural__ and not must_version_call:
+            call_hid = op.get_call_history_id(wrapped_inputs, semantic_version=None)
+            computed = self._claim_call(op=op, inputs=wrapped_inputs, call_hid=call_hid)
+            if computed is not None:
+                return computed.outputs, computed, input_calls
+            claimed_hid = call_hid
+
+        # call the function without holding the lock, so that other threads
+        # can use the storage in the meantime (unless we must trace the call,
+        # which is not thread-safe)
+        f = op.f
+        try:
+            with self._lock if must_version_call else contextlib.nullcontext():
+                if op.__structural__:
+                    returns = f(**wrapped_inputs)
+                elif tracer_option is not None:
+                    tracer = tracer_option
+                    with tracer:
+                        if isinstance(tracer, DecTracer):
+                            f = track(op.f)
+                            node = tracer.register_call(func=f)
+                        #! call the function
+                        returns = f(*args, **kwargs)
+                        if isinstance(tracer, DecTracer):
+                            tracer.register_return(node=node)
+                else:
                     returns = f(*args, **kwargs)
-                    if isinstance(tracer, DecTracer):
-                        tracer.register_return(node=node)
-            else:
-                returns = f(*args, **kwargs)
-
-        if must_version_call:
-            # check the trace against the code state hypothesis
-            self.cached_versioner.apply_state_hypothesis(
-                hypothesis=self.code_state, trace_result=tracer_option.graph.nodes
+        except BaseException as e:
+            if claimed_hid is not None:
+                self._release_claim(claimed_hid, error=e)
+            raise
+
+        with self._lock:
+            if must_version_call:
+                # check the trace against the code state hypothesis
+                self.cached_versioner.apply_state_hypothesis(
+                    hypothesis=self.code_state, trace_result=tracer_option.graph.nodes
+                )
+                # update the global topology and code state
+                self.cached_versioner.update_global_topology(graph=tracer_option.graph)
+                self.code_state.add_globals_from(graph=tracer_option.graph)
+
+            content_version, semantic_version = (
+                self.cached_versioner.get_version_ids(
+                    pre_call_uid=pre_call_id,
+                    tracer_option=tracer_option,
+                    is_recompute=False,
+                )
+                if must_version_call
+                else (None, None)
             )
-            # update the global topology and code state
-            self.cached_versioner.update_global_topology(graph=tracer_option.graph)
-            self.code_state.add_globals_from(graph=tracer_option.graph)
 
-        content_version, semantic_version = (
-            self.cached_versioner.get_version_ids(
-                pre_call_uid=pre_call_id,
-                tracer_option=tracer_option,
-                is_recompute=False,
+            main_call, output_calls = self._wrap_outputs(
+                op=op, wrapped_inputs=wrapped_inputs, returns=returns,
+                semantic_version=semantic_version, content_version=content_version,
             )
-            if must_version_call
-            else (None, None)
-        )
+        if claimed_hid is not None:
+            self._release_claim(claimed_hid, call=main_call)
+        return main_call.outputs, main_call, input_calls + output_calls
 
-        # wrap the outputs
+    def _claim_call(self, op: Op, inputs: Dict[str, Ref], call_hid: str) -> Optional[Call]:
+        """
+        Claim the computation of a new call. Return `None` if it's ours to
+        compute, or else wait for the thread (or process) computing it, and
+        return the call it computed. If the computation fails, or the other
+        process dies, try again.
+        """
+        while True:
+            future = self._reserve_call(call_hid)
+            if future is None:
+                return self._take_claim(op=op, inputs=inputs, call_hid=call_hid)
+            logger.debug(f"Waiting for another thread to compute the call to {op.name} with hid {call_hid}.")
+            try:
+                return future.result()
+            except BaseException:
+                pass
+
+    async def _aclaim_call(self, op: Op, inputs: Dict[str, Ref], call_hid: str) -> Optional[Call]:
+        """
+        Like `_claim_call`, but await the thread or task computing the call,
+        and wait for the lease (if any) in a worker thread.
+        """
+        while True:
+            future = self._reserve_call(call_hid)
+            if future is None:
+                if self.leases is None:
+                    return self._take_claim(op=op, inputs=inputs, call_hid=call_hid)
+                return await asyncio.to_thread(self._take_claim, op, inputs, call_hid)
+            try:
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except BaseException:
+                if not future.done(): # this task was cancelled
+                    raise
+
+    def _reserve_call(self, call_hid: str) -> Optional[Future]:
+        """
+        Reserve the computation of a call among the threads of this process.
+        Return `None` if it's ours, or else the future of the thread that
+        reserved it.
+        """
+        with self._lock:
+            future = self._inflight.get(call_hid)
+            if future is None:
+                self._inflight[call_hid] = Future()
+            return future
+
+    def _take_claim(self, op: Op, inputs: Dict[str, Ref], call_hid: str) -> Optional[Call]:
+        """
+        Given a call reserved by `_reserve_call`, wait for its lease (if any),
+        and return `None` if it's ours to compute. Before waiting for another
+        process, our own computed calls are committed, so that their leases are
+        released.
+
+        Since the call may have been computed after it was looked up, it's
+        looked up again once claimed, bypassing the caches that could still
+        miss it (the missing calls and the Bloom filters). If it's found, the
+        claim is released and the call is returned.
+        """
+        try:
+            # don't hold the lock while waiting for the database
+            while self.leases is not None and not self.leases.acquire(call_hid):
+                # don't keep the leases of our computed calls while waiting,
+                # or two storages can end up waiting for each other forever
+                if len(self.leases.done) > 0:
+                    self.commit()
+                time.sleep(self.leases.poll_interval)
+            with self._lock:
+                if self.call_cache.exists(call_hid): # computed by another thread
+                    call = self._get_call_from_data(self.calls.get_data(call_hid), in_memory=True)
+                    committed = call_hid not in self.calls.dirty_hids
+                else: # or committed by another process
+                    call_data = self.calls.persistent.lookup(
+                        call_hid, op.get_call_content_id(inputs, semantic_version=None)
+                    )
+                    call = None if call_data is None else self._call_from_lookup(
+                        op=op, inputs=inputs, call_hid=call_hid, call_data=call_data
+                    )
+                    committed = True
+        except BaseException as e:
+            self._release_claim(call_hid, error=e)
+            raise
+        if call is not None:
+            self._release_claim(call_hid, call=call, committed=committed)
+        return call
+
+    def _release_claim(self, call_hid: str, call: Optional[Call] = None,
+                       error: Optional[BaseException] = None, committed: bool = False):
+        """
+        Hand the computed call (or the error) to the threads waiting for it.
+        The lease of a computed call is released when it's committed.
+        """
+        with self._lock:
+            future = self._inflight.pop(call_hid)
+            if self.leases is not None:
+                if call is None or committed:
+                    self.leases.release([call_hid])
+                else:
+                    self.leases.mark_done(call_hid)
+        if call is None:
+            future.set_exception(error)
+        else:
+            future.set_result(call)
+
+    def _wrap_inputs(self, storage_inputs: Dict[str, Any], storage_tps: Dict[str, Type]
+                     ) -> Tuple[Dict[str, Ref], List[Call]]:
+        """
+        Wrap the inputs of a call, returning the wrapped inputs and the
+        structural calls used to build them.
+        """
+        wrapped_inputs = {}
+        input_calls = []
+        for k, v in storage_inputs.items():
+            wrapped_inputs[k], struct_calls = self.construct(tp=storage_tps[k], val=v)
+            input_calls.extend(struct_calls)
+        return wrapped_inputs, input_calls
+
+    def _get_call_args(self, op: Op, bound_arguments: inspect.BoundArguments,
+                       kwarg_keys: Optional[Iterable[str]]) -> Tuple[tuple, Dict[str, Any]]:
+        """
+        Get the raw positional and keyword arguments to pass to the function of
+        the op. NOTE: this modifies `bound_arguments` in place.
+        """
+        kwargs = {}
+        if kwarg_keys is not None:
+            for k in kwarg_keys:
+                if k in bound_arguments.arguments:
+                    kwargs[k] = bound_arguments.arguments[k]
+                    del bound_arguments.arguments[k]
+                else: # must be a var keyword
+                    # figure out the name of the var keyword
+                    var_keyword = op.call_plan.var_keyword
+                    assert var_keyword is not None
+                    varkwargs = bound_arguments.arguments[var_keyword.name]
+                    kwargs[k] = varkwargs[k]
+                    del varkwargs[k]
+        args, leftover_kwargs = bound_arguments.args, bound_arguments.kwargs
+        args = self.unwrap(args)
+        kwargs.update(leftover_kwargs)
+        kwargs = self.unwrap(kwargs)
+        # replace any ValuePointer/FilePointer instances with their underlying objects
+        kwargs = {k: unwrap_special_value(v) if isinstance(v, (ValuePointer, FilePointer)) else v
+                  for k, v in kwargs.items()}
+        args = tuple([unwrap_special_value(v) if isinstance(v, (ValuePointer, FilePointer)) else v
+                      for v in args])
+        return args, kwargs
+
+    def _wrap_outputs(self, op: Op, wrapped_inputs: Dict[str, Ref], returns: Any,
+                      semantic_version: Optional[str] = None,
+                      content_version: Optional[str] = None,
+                      ) -> Tuple[Call, List[Call]]:
+        """
+        Wrap the values returned by the function of the op, returning the new
+        call and the structural calls used to build its outputs.
+        """
+        plan = op.call_plan
         outputs_dict, outputs_annotations = parse_returns(
-            sig=sig, returns=returns, nout=op.nout, output_names=op.output_names
+            sig=plan.sig, returns=returns, nout=op.nout, output_names=op.output_names
         )
         output_tps = {
-            k: Type.from_annotation(annotation=v)
+            k: plan.get_type(v)
             for k, v in outputs_annotations.items()
         }
         call_content_id = op.get_call_content_id(wrapped_inputs, semantic_version=semantic_version)
@@ -933,7 +1711,7 @@ class Storage:
             semantic_version=semantic_version,
             content_version=content_version,
         )
-        return main_call.outputs, main_call, input_calls + output_calls
+        return main_call, output_calls
 
     ############################################################################
     ### versioning
@@ -1122,10 +1900,10 @@ class Storage:
         - deletes the semantic version from the versioner;
         """
         ### delete all calls first (and their dependents)
-        # TODO: very inefficient, we should have a DB query for this
-        calls_df = self.calls.persistent.get_df(conn=conn)
-        calls_df = calls_df.query(f'semantic_version == "{semantic_version}"')
-        call_hids = calls_df.index.get_level_values('call_history_id').unique()
+        call_hids = [row[0] for row in conn.execute(
+            "SELECT DISTINCT call_history_id FROM calls WHERE semantic_version = ?",
+            (semantic_version,),
+        ).fetchall()]
         self.drop_calls(calls_or_hids=call_hids, delete_dependents=True, conn=conn)
         ### remove from versioner
         versioner = self.get_versioner(conn=conn)
@@ -1159,17 +1937,22 @@ class Storage:
         else:
             raise ValueError("Invalid input to `cf`")
 
+    @_hashes
     def call(
         self, op: Op, args, kwargs, config: Optional[dict] = None
     ) -> Union[Tuple[Ref, ...], Ref]:
+        if getattr(op, "is_async", False):
+            return self.acall(op, args, kwargs, config=config)
         config = {} if config is None else config
         kwarg_keys = set(kwargs.keys())
+        plan = op.call_plan
         bound_arguments, storage_inputs, storage_annotations = self.parse_args(
-            sig=inspect.signature(op.f),
+            sig=plan.sig,
             args=args,
             kwargs=kwargs,
             apply_defaults=True,
             ignore_args=op.ignore_args,
+            plan=plan,
         )
 
         if self.mode == "noop":
@@ -1181,9 +1964,11 @@ class Storage:
             args = tuple([self.unwrap(arg) for arg in args])
             kwargs = {k: self.unwrap(v) for k, v in kwargs.items()}
             return op.f(*args, **kwargs)
+        elif self.mode == "run" and getattr(op, "batched", False):
+            return self._call_batched(op, args, kwargs, save_calls=config.get("save_calls", False))
         elif self.mode == "run":
             storage_tps = {
-                k: Type.from_annotation(annotation=v) for k, v in storage_annotations.items()
+                k: plan.get_type(v) for k, v in storage_annotations.items()
             }
             res, main_call, calls = self.call_internal(
                 op=op,
@@ -1193,28 +1978,275 @@ class Storage:
                 kwarg_keys=kwarg_keys,
             )
             if config.get("save_calls", False):
-                self.save_call(main_call)
-                for call in calls:
-                    self.save_call(call)
+                with self._lock:
+                    self.save_call(main_call)
+                    for call in calls:
+                        self.save_call(call)
+                    if self._autocommit:
+                        self.maybe_autocommit()
             ord_outputs = op.get_ordered_outputs(main_call.outputs)
             if len(ord_outputs) == 1:
                 return ord_outputs[0]
             else:
                 return ord_outputs
+
+    @_hashes
+    async def acall(
+        self, op: Op, args, kwargs, config: Optional[dict] = None
+    ) -> Union[Tuple[Ref, ...], Ref]:
+        """
+        Call an `async def` op. The call is looked up synchronously, and only
+        a new call awaits the function, so that e.g. `asyncio.gather` over
+        many calls runs the new ones concurrently. Concurrent calls with the
+        same history ID (in any thread or event loop, and in other processes
+        with `dedup_calls`) await the same computation.
+
+        The new calls are wrapped and saved without awaiting anything in
+        between, so saves never interleave, and happen in the order in which
+        the calls finish.
+        """
+        config = {} if config is None else config
+        plan = op.call_plan
+        bound_arguments, storage_inputs, storage_annotations = self.parse_args(
+            sig=plan.sig, args=args, kwargs=kwargs, apply_defaults=True,
+            ignore_args=op.ignore_args, plan=plan,
+        )
+        if self.mode == "noop":
+            args, kwargs = boundargs_to_args_kwargs(bound_arguments)
+            args = tuple([self.unwrap(unwrap_special_value(arg)) for arg in args])
+            kwargs = {k: self.unwrap(unwrap_special_value(v)) for k, v in kwargs.items()}
+            return await op.f(*args, **kwargs)
+        if self.versioned:
+            raise NotImplementedError("Async ops are not supported by versioned storages")
+        storage_tps = {k: plan.get_type(v) for k, v in storage_annotations.items()}
+        with self._lock:
+            wrapped_inputs, input_calls = self._wrap_inputs(storage_inputs, storage_tps)
+            main_call = self.lookup_call(op=op, inputs=wrapped_inputs)
+        output_calls = []
+        if main_call is None:
+            if not self._allow_new_calls:
+                raise RuntimeError(f"Call to {op.name} does not exist and new calls are not allowed.")
+            call_hid = op.get_call_history_id(wrapped_inputs, semantic_version=None)
+            main_call = await self._aclaim_call(op=op, inputs=wrapped_inputs, call_hid=call_hid)
+            if main_call is None:
+                try:
+                    with self._lock:
+                        call_args, call_kwargs = self._get_call_args(op, bound_arguments, set(kwargs.keys()))
+                    returns = await op.f(*call_args, **call_kwargs)
+                    with self._lock:
+                        main_call, output_calls = self._wrap_outputs(op=op, wrapped_inputs=wrapped_inputs,
+                                                                     returns=returns)
+                except BaseException as e:
+                    self._release_claim(call_hid, error=e)
+                    raise
+                self._release_claim(call_hid, call=main_call)
+        if config.get("save_calls", False):
+            with self._lock:
+                for call in [main_call] + input_calls + output_calls:
+                    self.save_call(call)
+                if self._autocommit:
+                    self.maybe_autocommit()
+        return self._get_outputs(op, main_call)
+
+    @_hashes
+    def map(
+        self, op: Op, inputs: Iterable[Dict[str, Any]],
+        executor: Union[Literal["process", "thread"], Executor] = "process",
+        max_workers: Optional[int] = None,
+    ) -> List[Union[Tuple[Ref, ...], Ref]]:
+        """
+        Call `op` on each of the given dictionaries of keyword arguments, and
+        return the outputs in the same order, as the op would.
+
+        All the calls are looked up with a single query, and only the new ones
+        are computed in a `concurrent.futures` pool: "process" (functions and
+        arguments are shipped with `cloudpickle` if it's installed, or else
+        the op must be importable; results must be picklable), "thread", or
+        an existing `Executor`. The outputs are wrapped and saved
+        in this process as they come in, so the work done so far is kept if a
+        call fails. Identical calls are only computed once. Outside of a `with
+        storage:` block, the new calls are committed at the end.
+
+        Versioned storages fall back to calling the op sequentially, since the
+        dependencies of each call must be traced in this process.
+
+        The new calls are not claimed for `dedup_calls`, since waiting for
+        some while holding the claims on others could deadlock; a call being
+        computed elsewhere at the same time may be computed again.
+        """
+        inputs = list(inputs)
+        if self.mode != "run":
+            raise ValueError(f"`map` can only be used in 'run' mode, not {self.mode!r}")
+        if getattr(op, "batched", False):
+            raise ValueError(f"{op.name} is a batched op; call it on the list of elements instead")
+        if getattr(op, "is_async", False):
+            raise ValueError(f"{op.name} is an async op; use `asyncio.gather` over its calls instead")
+        if self.versioned:
+            return [self.call(op, (), kwargs, config={"save_calls": True}) for kwargs in inputs]
+        prepared, results, missing = self._lookup_many(op, inputs)
+
+        ### compute the new calls in the pool
+        if len(missing) > 0:
+            owns_pool = not isinstance(executor, Executor)
+            if executor == "process":
+                pool = ProcessPoolExecutor(max_workers=max_workers)
+            elif executor == "thread":
+                pool = ThreadPoolExecutor(max_workers=max_workers)
+            elif isinstance(executor, Executor):
+                pool = executor
+            else:
+                raise ValueError(f"Unknown executor {executor!r}; use 'process', 'thread' or an `Executor`")
+            use_processes = isinstance(pool, ProcessPoolExecutor)
+            if use_processes and not Config.has_cloudpickle and "<locals>" in op.f.__qualname__:
+                raise ValueError(f"Cannot send {op.name} to worker processes, since it is not defined at "
+                                 "the top level of a module; install `cloudpickle`, or use executor='thread'")
+            futures = {}
+            try:
+                for call_hid, positions in missing.items():
+                    bound_arguments, _, _, kwarg_keys = prepared[positions[0]]
+                    with self._lock:
+                        args, kwargs = self._get_call_args(op, bound_arguments, kwarg_keys)
+                    if use_processes and Config.has_cloudpickle:
+                        future = pool.submit(_call_pickled, cloudpickle.dumps((op.f, args, kwargs)))
+                    elif use_processes:
+                        future = pool.submit(_call_by_name, op.f.__module__, op.f.__qualname__, args, kwargs)
+                    else:
+                        # in the caller's context, so that the ops it calls are memoized
+                        future = pool.submit(contextvars.copy_context().run, op.f, *args, **kwargs)
+                    futures[future] = positions
+                for future in as_completed(futures):
+                    self._save_new_call(op, prepared, futures[future], future.result(), results)
+            finally:
+                for future in futures:
+                    future.cancel()
+                if owns_pool:
+                    pool.shutdown()
+        if not self._mode_stack:
+            self.commit()
+        return [self._get_outputs(op, call) for call in results]
+
+    def _call_batched(self, op: Op, args: tuple, kwargs: Dict[str, Any], save_calls: bool = False
+                      ) -> List[Union[Tuple[Ref, ...], Ref]]:
+        """
+        Call a batched op (see `op`) on a list of elements: look up the calls
+        on all the elements with one query, pass the missing elements to the
+        function in batches of at most `op.batch_size`, and return the outputs
+        for each element. The calls are saved if `save_calls`, like in `call`.
+        Like in `map`, the new calls are not claimed for `dedup_calls`.
+        """
+        if self.versioned:
+            raise NotImplementedError("Batched ops are not supported by versioned storages")
+        plan = op.call_plan
+        bound_arguments = plan.sig.bind(*args, **kwargs)
+        elements = bound_arguments.arguments[plan.batched_param]
+        if not isinstance(elements, (list, tuple)):
+            raise TypeError(f"The first argument of the batched op {op.name} must be a list or tuple, "
+                            f"got {type(elements)}")
+        inputs = [{**bound_arguments.arguments, plan.batched_param: element} for element in elements]
+        prepared, results, missing = self._lookup_many(op, inputs, save_calls=save_calls)
+        groups = list(missing.values())
+        batch_size = op.batch_size if op.batch_size is not None else max(len(groups), 1)
+        for start in range(0, len(groups), batch_size):
+            batch = groups[start:start + batch_size]
+            # all the elements share the other arguments
+            with self._lock:
+                call_args = [self._get_call_args(op, prepared[positions[0]][0], prepared[positions[0]][3])[1]
+                             for positions in batch]
+            returns = op.f(**{**call_args[0], plan.batched_param: [a[plan.batched_param] for a in call_args]})
+            if len(returns) != len(batch):
+                raise ValueError(f"The batched op {op.name} returned {len(returns)} results "
+                                 f"for {len(batch)} elements")
+            for positions, element_returns in zip(batch, returns):
+                self._save_new_call(op, prepared, positions, element_returns, results, save_calls=save_calls)
+        return [self._get_outputs(op, call) for call in results]
+
+    def _lookup_many(self, op: Op, inputs: List[Dict[str, Any]], save_calls: bool = True
+                     ) -> Tuple[List[tuple], List[Optional[Call]], Dict[str, List[int]]]:
+        """
+        Prepare many calls to `op`, given by their keyword arguments, look them
+        all up with a single query, and save the calls that were found (if
+        `save_calls`). Return
+        - for each call, the bound arguments, the wrapped inputs, the
+        structural calls for the inputs, and the keys of the keyword arguments;
+        - the calls that were found (or `None`);
+        - the positions of the missing calls, grouped by history ID, so that
+        identical calls are only computed once.
+        """
+        plan = op.call_plan
+        with self._lock:
+            prepared = []
+            for kwargs in inputs:
+                bound_arguments, storage_inputs, storage_annotations = self.parse_args(
+                    sig=plan.sig, args=(), kwargs=kwargs, apply_defaults=True,
+                    ignore_args=op.ignore_args, plan=plan,
+                )
+                storage_tps = {k: plan.get_type(v) for k, v in storage_annotations.items()}
+                wrapped_inputs, input_calls = self._wrap_inputs(storage_inputs, storage_tps)
+                prepared.append((bound_arguments, wrapped_inputs, input_calls, set(kwargs.keys())))
+            results = self.lookup_calls(op, [wrapped_inputs for _, wrapped_inputs, _, _ in prepared])
+            missing: Dict[str, List[int]] = defaultdict(list)
+            for i, call in enumerate(results):
+                if call is None:
+                    missing[op.get_call_history_id(prepared[i][1], semantic_version=None)].append(i)
+            if len(missing) > 0 and not self._allow_new_calls:
+                raise RuntimeError(f"Calls to {op.name} do not exist and new calls are not allowed.")
+            for i, call in enumerate(results):
+                if call is not None and save_calls:
+                    self.save_call(call)
+                    for struct_call in prepared[i][2]:
+                        self.save_call(struct_call)
+        return prepared, results, missing
+
+    def _save_new_call(self, op: Op, prepared: List[tuple], positions: List[int], returns: Any,
+                       results: List[Optional[Call]], save_calls: bool = True):
+        """
+        Wrap the values returned by the function for the (identical) calls at
+        the given positions of a `_lookup_many`, and save the new call (if
+        `save_calls`).
+        """
+        _, wrapped_inputs, input_calls, _ = prepared[positions[0]]
+        with self._lock:
+            main_call, output_calls = self._wrap_outputs(op=op, wrapped_inputs=wrapped_inputs, returns=returns)
+            for i in positions:
+                results[i] = main_call
+            if not save_calls:
+                return
+            for call in [main_call] + input_calls + output_calls:
+                self.save_call(call)
+            for i in positions:
+                if i != positions[0]:
+                    for struct_call in prepared[i][2]:
+                        self.save_call(struct_call)
+            if self._autocommit:
+                self.maybe_autocommit()
+
+    @staticmethod
+    def _get_outputs(op: Op, call: Call) -> Union[Tuple[Ref, ...], Ref]:
+        ord_outputs = op.get_ordered_outputs(call.outputs)
+        return ord_outputs[0] if len(ord_outputs) == 1 else ord_outputs
     
     def __call__(self, mode: Literal['run', 'noop'] = 'run') -> "Storage":
         self._next_mode = mode
         return self
 
     def __enter__(self) -> "Storage":
+        if not self._mode_stack and self.filters is not None:
+            with self._lock:
+                self.filters.sync()
         Context.current_context = Context(storage=self)
-        self._mode_stack.append(self._next_mode)
+        self._update_context_state(mode_stack=self._mode_stack + (self._next_mode,))
         if self.versioned:
             versioner, code_state = self.sync_code()
             self.cached_versioner = versioner
             self.code_state = code_state
         return self
 
+    async def __aenter__(self) -> "Storage":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        self.__exit__(exc_type, exc_value, traceback)
+
     # def __exit__(self, exc_type, exc_value, traceback) -> None:
     #     Context.current_context = None
     #     try:
@@ -1248,7 +2280,7 @@ class Storage:
                 for hook in self._exit_hooks:
                     hook(self)
 
-            _ = self._mode_stack.pop()
+            self._update_context_state(mode_stack=self._mode_stack[:-1])
             if self._mode_stack:
                 self._next_mode = self._mode_stack[-1]
             else:
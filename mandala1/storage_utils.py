@@ -1,24 +1,66 @@
 from .common_imports import *
 from tqdm import tqdm
 import uuid
-from .utils import serialize, deserialize
+import threading
+import socket
+import json
+import zlib
+import lzma
+import bz2
+import math
+import heapq
+from collections.abc import MutableMapping
+from .utils import serialize, deserialize, serialized_array_view
 from .model import Call
+from .config import Config
 import joblib
 import sqlite3
 from abc import ABC, abstractmethod
 
 
 class DBAdapter:
-    def __init__(self, db_path: str = ":memory:"):
+    """
+    Hands out connections to a SQLite database.
+
+    In-memory databases use a single connection for the lifetime of the
+    object. File-backed databases use one long-lived connection per thread
+    (and per process, so that connections are never shared across a `fork`),
+    which avoids paying the connection setup cost on every transaction, and
+    lets SQLite reuse the page cache and the prepared statements of each
+    connection across transactions.
+    """
+    # applied to every new connection; these only trade memory for speed, and
+    # don't affect durability. Pass e.g. `{"synchronous": "NORMAL"}` to trade
+    # durability of the last transactions on power loss for faster commits.
+    DEFAULT_PRAGMAS = {
+        "cache_size": -64_000, # in KiB, i.e. ~64MB of page cache
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+    def __init__(self, db_path: str = ":memory:",
+                 pragmas: Optional[Dict[str, Any]] = None,
+                 cached_statements: int = 256,
+                 ):
         self.db_path = db_path
+        self.pragmas = {**DBAdapter.DEFAULT_PRAGMAS, **(pragmas or {})}
+        # size of the per-connection cache of prepared statements
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
         if self.in_memory:
             # maintain a single connection throughout the lifetime of the object
             # avoid clashes with other in-memory databases
             self._id = str(uuid.uuid4())
             self._connection_address = f"file:{self._id}?mode=memory&cache=shared"
             self._conn = sqlite3.connect(
-                str(self._connection_address), isolation_level=None, uri=True
+                str(self._connection_address), isolation_level=None, uri=True,
+                cached_statements=self.cached_statements,
+                # shared by all threads; `Storage` serializes its use
+                check_same_thread=False,
             )
+            self._apply_pragmas(self._conn)
         if not self.in_memory:
             if not os.path.exists(db_path):
                 # create a database with incremental vacuuming
@@ -26,17 +68,46 @@ class DBAdapter:
                 conn.execute("PRAGMA journal_mode=WAL")
                 conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
                 conn.execute("PRAGMA incremental_vacuum_threshold = 1024;")
-                conn.close()
     
     @property
     def in_memory(self) -> bool:
         return self.db_path == ":memory:"
+
+    def _apply_pragmas(self, conn: sqlite3.Connection):
+        for k, v in self.pragmas.items():
+            conn.execute(f"PRAGMA {k} = {v}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # each connection is only used by the thread that created it, but may
+        # be closed from another one by `close()`
+        conn = sqlite3.connect(self.db_path, cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        self._apply_pragmas(conn)
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
     
     def conn(self) -> sqlite3.Connection:
         if self.in_memory:
             return self._conn
-        else:
-            return sqlite3.connect(self.db_path)
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            # first use from this thread, or we are in a forked child process
+            # and must not touch the parent's connection
+            self._local.conn = self._connect()
+            self._local.pid = pid
+        return self._local.conn
+
+    def close(self):
+        """
+        Close all the connections opened by this adapter. File-backed
+        databases will transparently reconnect on the next call to `conn()`.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
 
 def is_in_memory_db(conn):
     cursor = conn.execute("PRAGMA database_list")
@@ -47,25 +118,35 @@ def is_in_memory_db(conn):
 
 def transaction(method):  # transaction decorator for classes with a `conn` method
     """
-
+    Run the method in a `BEGIN IMMEDIATE` transaction on a connection from
+    `self.conn()`, retrying with exponential backoff if the database is busy.
+    If a `conn` is passed, or the connection is already in a transaction, the
+    call is folded into the enclosing transaction.
     """
     def wrapper(self, *args, **kwargs):
         if kwargs.get("conn") is not None:  # already in a transaction
             logging.debug("Folding into existing transaction")
             return method(self, *args, **kwargs)
+        kwargs.pop("conn", None)
 
         # 10 attempts with exponential backoff, max. time is ~17 minutes
         max_attempts = 10
         base_delay = 1.0 # in seconds
 
         for attempt in range(max_attempts):
+            # connections are long-lived, so we don't close them here
             conn = self.conn()
+            if conn.in_transaction:
+                logging.debug("Folding into existing transaction")
+                return method(self, *args, conn=conn, **kwargs)
             try:
                 conn.execute("BEGIN IMMEDIATE")
                 res = method(self, *args, conn=conn, **kwargs)
                 conn.commit()
                 return res
             except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.rollback()
                 delay = base_delay * (2 ** attempt)
                 logging.info(f'Transaction failed with error: {e}. Retrying in {delay:.2f} seconds...')
                 time.sleep(delay)
@@ -73,31 +154,131 @@ def transaction(method):  # transaction decorator for classes with a `conn` meth
             except Exception as e:
                 conn.rollback()
                 raise e
-            finally:
-                if not is_in_memory_db(conn):
-                    conn.close()
         raise sqlite3.OperationalError("Max retry attempts reached")
-        # else:  # open a connection
-        #     logging.debug(
-        #         f"Opening new transaction from {self.__class__.__name__}.{method.__name__}"
-        #     )
-        #     conn = self.conn()
-        #     try:
-        #         res = method(self, *args, conn=conn, **kwargs)
-        #         conn.commit()
-        #         return res
-        #     except Exception as e:
-        #         conn.rollback()
-        #         raise e
-        #     finally:
-        #         if not is_in_memory_db(conn):
-        #             conn.close()
-        #         else:
-        #             # in-memory databases are kept open
-        #             pass
     return wrapper
 
 
+################################################################################
+### schema versioning
+################################################################################
+class Migration:
+    """
+    A single step in the evolution of the database schema. Each step is a
+    list of SQL statements or callables taking a connection, applied in order
+    inside the same transaction as the bump of the schema version.
+
+    Steps must be safe to apply to a database that already has (parts of) the
+    target schema, e.g. use `CREATE INDEX IF NOT EXISTS`.
+    """
+    def __init__(self, version: int, description: str,
+                 steps: List[Union[str, Callable[[sqlite3.Connection], None]]]):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def __repr__(self) -> str:
+        return f"Migration({self.version}, {self.description!r})"
+
+    def apply(self, conn: sqlite3.Connection):
+        for step in self.steps:
+            if isinstance(step, str):
+                conn.execute(step)
+            else:
+                step(conn)
+
+
+MIGRATIONS = [
+    Migration(1, "secondary indexes on the `calls` table", [
+        # memo lookups by content ID
+        "CREATE INDEX IF NOT EXISTS calls_call_content_id ON calls (call_content_id)",
+        # creator/consumer queries, `exists_ref_hid`
+        "CREATE INDEX IF NOT EXISTS calls_ref_history_id ON calls (ref_history_id, direction)",
+        "CREATE INDEX IF NOT EXISTS calls_ref_content_id ON calls (ref_content_id)",
+        # `ComputationFrame.from_op`
+        "CREATE INDEX IF NOT EXISTS calls_op ON calls (op)",
+    ]),
+    Migration(2, "`shape_cids` table mapping shape hids to content IDs", [
+        "CREATE TABLE IF NOT EXISTS shape_cids (hid TEXT PRIMARY KEY, cid TEXT)",
+        "CREATE INDEX IF NOT EXISTS shape_cids_cid ON shape_cids (cid)",
+        lambda conn: _backfill_shape_cids(conn),
+    ]),
+    Migration(3, "`meta` table for storage-wide settings", [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    ]),
+    Migration(4, "`file_hashes` table caching the content hashes of files", [
+        "CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+        "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, hash TEXT NOT NULL)",
+    ]),
+    Migration(5, "`bloom_filters` table persisting the existence filters", [
+        "CREATE TABLE IF NOT EXISTS bloom_filters (name TEXT PRIMARY KEY, capacity INTEGER NOT NULL, "
+        "fp_rate REAL NOT NULL, num_items INTEGER NOT NULL, commit_count INTEGER NOT NULL, bits BLOB NOT NULL)",
+    ]),
+    Migration(6, "`call_leases` table for deduplicating calls in flight", [
+        "CREATE TABLE IF NOT EXISTS call_leases (call_hid TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+        "host TEXT NOT NULL, pid INTEGER NOT NULL, heartbeat REAL NOT NULL)",
+    ]),
+]
+
+
+def _backfill_shape_cids(conn: sqlite3.Connection, batch_size: int = 10_000):
+    cursor = conn.execute("SELECT key, value FROM shapes")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        conn.executemany(
+            "INSERT OR REPLACE INTO shape_cids (hid, cid) VALUES (?, ?)",
+            [(key, deserialize(decode_value(value)).cid) for key, value in rows],
+        )
+
+
+class SchemaManager:
+    """
+    Keeps track of the version of the schema of a database in the
+    `schema_version` table, and brings the database up to date by applying
+    the pending `MIGRATIONS` in order. Databases created before this table
+    existed are treated as being at version 0 and are upgraded in place.
+    """
+    def __init__(self, db: "DBAdapter", migrations: Optional[List[Migration]] = None):
+        self.db = db
+        self.migrations = MIGRATIONS if migrations is None else migrations
+        with self.conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, "
+                "description TEXT, applied_at TEXT)"
+            )
+
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn()
+
+    @property
+    def latest_version(self) -> int:
+        return max([m.version for m in self.migrations], default=0)
+
+    @transaction
+    def get_version(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        return 0 if row[0] is None else row[0]
+
+    @transaction
+    def migrate(self, conn: Optional[sqlite3.Connection] = None) -> List[Migration]:
+        """
+        Apply all migrations newer than the current version of the database,
+        and return the ones that were applied.
+        """
+        current = self.get_version(conn=conn)
+        pending = sorted([m for m in self.migrations if m.version > current],
+                         key=lambda m: m.version)
+        for migration in pending:
+            logger.debug(f"Migrating database schema to version {migration.version}: {migration.description}")
+            migration.apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, datetime('now'))",
+                (migration.version, migration.description),
+            )
+        return pending
+
+
 class DictStorage(ABC):
     @abstractmethod
     def get(self, key: str) -> Any:
@@ -132,41 +313,280 @@ class DictStorage(ABC):
         return len(self.keys())
 
 
+################################################################################
+### compression codecs
+################################################################################
+class Codec:
+    """
+    A compression codec for serialized values. Compressed values are prefixed
+    with a single header byte (the codec's `tag`, < 0x80), which is how they
+    are told apart on read from uncompressed values - these start with the tag
+    of their serializer (>= 0x80, see `utils.Serializer`).
+    """
+    def __init__(self, name: str, tag: Optional[int],
+                 compress: Callable[[bytes], bytes],
+                 decompress: Callable[[bytes], bytes],
+                 ):
+        self.name = name
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self) -> str:
+        return f"Codec({self.name})"
+
+
+CODECS: Dict[str, Codec] = {
+    "none": Codec("none", None, lambda data: data, lambda data: data),
+    "zlib": Codec("zlib", 0x01, lambda data: zlib.compress(data, 3), zlib.decompress),
+    "lzma": Codec("lzma", 0x02, lambda data: lzma.compress(data, preset=1), lzma.decompress),
+    "bz2": Codec("bz2", 0x03, lambda data: bz2.compress(data, 9), bz2.decompress),
+}
+if Config.has_lz4:
+    import lz4.frame
+
+    CODECS["lz4"] = Codec("lz4", 0x04, lz4.frame.compress, lz4.frame.decompress)
+if Config.has_zstd:
+    import zstandard
+
+    CODECS["zstd"] = Codec(
+        "zstd", 0x05,
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+CODECS_BY_TAG: Dict[int, Codec] = {c.tag: c for c in CODECS.values() if c.tag is not None}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        if name in ("lz4", "zstd"):
+            raise ValueError(f"Codec {name} requires the `{'lz4' if name == 'lz4' else 'zstandard'}` package")
+        raise ValueError(f"Unknown codec {name}; available codecs are {list(CODECS.keys())}")
+    return CODECS[name]
+
+
+def encode_value(data: bytes, codec: str, min_bytes: int = 0) -> bytes:
+    """
+    Compress the serialized value `data` with the given codec and prepend the
+    codec's header byte. Values smaller than `min_bytes`, and values that do
+    not get smaller when compressed, are returned as they are.
+    """
+    c = get_codec(codec)
+    if c.tag is None or len(data) < min_bytes:
+        return data
+    compressed = c.compress(data)
+    if len(compressed) + 1 >= len(data):
+        return data
+    return bytes([c.tag]) + compressed
+
+
+def decode_value(blob: bytes) -> bytes:
+    """
+    Inverse of `encode_value`.
+    """
+    if len(blob) == 0 or blob[0] >= 0x80:
+        return blob
+    if blob[0] not in CODECS_BY_TAG:
+        raise ValueError(f"Value is compressed with an unknown or unavailable codec (header byte {blob[0]:#04x})")
+    return CODECS_BY_TAG[blob[0]].decompress(blob[1:])
+
+
 class JoblibDictStorage(DictStorage):
     """
     A dictionary storage that uses joblib to store the data on disk.
+
+    Files are sharded into two levels of directories by the first characters
+    of the key, as in `{root}/ab/cd/abcd....joblib`, so that no directory
+    grows too large. If a `db` is given, a manifest table in it records the
+    path and size of each file, so that `exists`, `keys` and `get_size` don't
+    touch the filesystem. Files are written to a temporary file and renamed
+    into place, so readers never see partially written files.
+
+    Values are compressed with joblib's own compressors, which record the
+    compression method in the file header, so files written with different
+    codecs can be loaded side by side.
     """
-    def __init__(self, root: str):
+    # map our codecs to joblib's `compress` argument. joblib has no zstd
+    # compressor, so zstd falls back to zlib here
+    JOBLIB_COMPRESS = {
+        "none": 0,
+        "zlib": ("zlib", 3),
+        "lzma": ("lzma", 1),
+        "bz2": ("bz2", 9),
+        "lz4": ("lz4", 3),
+        "zstd": ("zlib", 3),
+    }
+
+    def __init__(self, root: str, codec: str = "none",
+                 db: Optional[DBAdapter] = None,
+                 manifest_table: str = "overflow_manifest",
+                 ):
         self.root = root
+        get_codec(codec)
+        self.codec = codec
+        self.db = db
+        self.manifest_table = manifest_table
         os.makedirs(root, exist_ok=True)
+        if self.db is not None:
+            with self.conn() as conn:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {manifest_table} "
+                    "(key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL)"
+                )
+        self.migrate_flat_layout()
+        if self.db is not None and not self._manifest_keys(limit=1) and any(f.is_dir() for f in os.scandir(root)):
+            # files written with another database (e.g. an in-memory one)
+            self.rebuild_manifest()
+
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn()
+
+    def get_relpath_for_key(self, key: str) -> str:
+        return os.path.join(key[:2], key[2:4], f'{key}.joblib')
     
     def get_path_for_key(self, key: str) -> str:
-        return os.path.join(self.root, f'{key}.joblib')
-    
-    def get(self, key: str) -> Any:
-        return joblib.load(self.get_path_for_key(key))
+        return os.path.join(self.root, self.get_relpath_for_key(key))
     
-    def exists(self, key: str) -> bool:
-        return os.path.exists(self.get_path_for_key(key))
+    def get(self, key: str, mmap_mode: Optional[str] = None) -> Any:
+        """
+        With `mmap_mode` (e.g. "r"), numpy arrays in the value are returned as
+        memory maps of the file instead of being read into memory (this has no
+        effect for compressed files).
+        """
+        return joblib.load(self.get_path_for_key(key), mmap_mode=mmap_mode)
     
-    def set(self, key: str, value: Any) -> None:
-        if self.exists(key):
+    def exists(self, key: str, conn: Optional[sqlite3.Connection] = None) -> bool:
+        if self.db is None:
+            return os.path.exists(self.get_path_for_key(key))
+        return self._manifest_get(key, conn=conn) is not None
+
+    def set(self, key: str, value: Any, codec: Optional[str] = None,
+            conn: Optional[sqlite3.Connection] = None) -> None:
+        if self.exists(key, conn=conn):
             return # this is a write-once storage
-        joblib.dump(value, self.get_path_for_key(key))
+        codec = self.codec if codec is None else codec
+        get_codec(codec)
+        path = self.get_path_for_key(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            joblib.dump(value, tmp_path, compress=self.JOBLIB_COMPRESS[codec])
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self.db is not None:
+            self._manifest_add([(key, self.get_relpath_for_key(key), os.path.getsize(path))], conn=conn)
     
-    def drop(self, key: str) -> None:
+    def drop(self, key: str, conn: Optional[sqlite3.Connection] = None) -> None:
+        if self.db is not None:
+            self._manifest_drop(key, conn=conn)
         os.remove(self.get_path_for_key(key))
 
+    def get_size(self, key: str, conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Size of the stored value on disk, in bytes.
+        """
+        if self.db is None:
+            return os.path.getsize(self.get_path_for_key(key))
+        row = self._manifest_get(key, conn=conn)
+        if row is None:
+            raise KeyError(f"Key {key} not found")
+        return row[1]
+
     def load_all(self) -> Dict[str, Any]:
         return {key: self.get(key) for key in self.keys()}
     
-    def keys(self) -> List[str]:
-        return [os.path.splitext(f)[0] for f in os.listdir(self.root) if f.endswith('.joblib')]
+    def keys(self, conn: Optional[sqlite3.Connection] = None) -> List[str]:
+        if self.db is None:
+            return [key for key, _ in self._scan_files()]
+        return self._manifest_keys(conn=conn)
     
     def values(self) -> List[Any]:
         return [self.get(key) for key in self.keys()]
-    
-        
+
+    ############################################################################
+    ### the manifest
+    ############################################################################
+    @transaction
+    def _manifest_get(self, key: str, conn: Optional[sqlite3.Connection] = None) -> Optional[Tuple[str, int]]:
+        return conn.execute(
+            f"SELECT path, size FROM {self.manifest_table} WHERE key = ? LIMIT 1", (key,)
+        ).fetchone()
+
+    @transaction
+    def _manifest_keys(self, limit: int = -1, conn: Optional[sqlite3.Connection] = None) -> List[str]:
+        return [row[0] for row in conn.execute(f"SELECT key FROM {self.manifest_table} LIMIT ?", (limit,))]
+
+    @transaction
+    def _manifest_add(self, rows: List[Tuple[str, str, int]], conn: Optional[sqlite3.Connection] = None):
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {self.manifest_table} (key, path, size) VALUES (?, ?, ?)", rows
+        )
+
+    @transaction
+    def _manifest_drop(self, key: str, conn: Optional[sqlite3.Connection] = None):
+        conn.execute(f"DELETE FROM {self.manifest_table} WHERE key = ?", (key,))
+
+    def _scan_files(self) -> Iterable[Tuple[str, str]]:
+        """
+        Walk the sharded directories, yielding `(key, relative path)` pairs.
+        """
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for subshard in os.scandir(shard.path):
+                if not subshard.is_dir():
+                    continue
+                for f in os.scandir(subshard.path):
+                    if f.name.endswith('.joblib'):
+                        yield f.name[:-len('.joblib')], os.path.join(shard.name, subshard.name, f.name)
+
+    def migrate_flat_layout(self, batch_size: int = 1000) -> int:
+        """
+        Move files from the flat layout used by earlier versions (all files
+        directly under `root`) into their shards, and add them to the
+        manifest. Return the number of files moved. Files moved by another
+        process migrating at the same time are skipped.
+        """
+        flat = [f.name for f in os.scandir(self.root) if f.is_file() and f.name.endswith('.joblib')]
+        if not flat:
+            return 0
+        logger.info(f"Migrating {len(flat)} files in {self.root} to the sharded layout...")
+        num_moved = 0
+        for i in range(0, len(flat), batch_size):
+            rows = []
+            for name in flat[i:i + batch_size]:
+                key = name[:-len('.joblib')]
+                path = self.get_path_for_key(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.replace(os.path.join(self.root, name), path)
+                except FileNotFoundError: # moved (and recorded) by another process
+                    continue
+                rows.append((key, self.get_relpath_for_key(key), os.path.getsize(path)))
+            if self.db is not None:
+                # record each batch as soon as it is moved, so that an
+                # interrupted migration loses nothing
+                self._manifest_add(rows)
+            num_moved += len(rows)
+        return num_moved
+
+    @transaction
+    def rebuild_manifest(self, conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+        """
+        Bring the manifest in sync with the files on disk, e.g. after files
+        were copied in by hand or a write was interrupted between the rename
+        and the manifest update. Return the number of added and removed rows.
+        """
+        on_disk = {key: relpath for key, relpath in self._scan_files()}
+        in_manifest = set(self._manifest_keys(conn=conn))
+        added = [(key, relpath, os.path.getsize(os.path.join(self.root, relpath)))
+                 for key, relpath in on_disk.items() if key not in in_manifest]
+        removed = [(key,) for key in in_manifest if key not in on_disk]
+        self._manifest_add(added, conn=conn)
+        conn.executemany(f"DELETE FROM {self.manifest_table} WHERE key = ?", removed)
+        return {"added": len(added), "removed": len(removed)}
 
 
 class SQLiteDictStorage(DictStorage):
@@ -174,18 +594,32 @@ class SQLiteDictStorage(DictStorage):
                  table: str, 
                  overflow_storage: Optional[JoblibDictStorage] = None,
                  overflow_threshold_MB: Optional[Union[int, float]] = 50,
+                 codec: str = "none",
+                 codec_min_bytes: int = 1024,
+                 overflow_arrays: bool = False,
                  ):
         """
-
+        Values are compressed with `codec` (see `CODECS`) before they are
+        written, unless they are smaller than `codec_min_bytes`; small values
+        are not worth the decompression overhead on reads.
+
+        If `overflow_arrays` is True, the values of this storage are
+        serialized objects (see `utils.serialize`), and those that are numpy
+        arrays are written to the overflow storage as arrays, so that they
+        can be memory-mapped from there.
         """
         self.db = db
         self.table = table
+        get_codec(codec)
+        self.codec = codec
+        self.codec_min_bytes = codec_min_bytes
         with self.conn() as conn:
             conn.execute(
                 f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB)"
             )
         self.overflow_storage = overflow_storage
         self.overflow_threshold_MB = overflow_threshold_MB
+        self.overflow_arrays = overflow_arrays
     
     def conn(self) -> sqlite3.Connection:
         return self.db.conn()
@@ -193,47 +627,94 @@ class SQLiteDictStorage(DictStorage):
     def load_all(self) -> Dict[str, Any]:
         with self.conn() as conn:
             cursor = conn.execute(f"SELECT key, value FROM {self.table}")
-            res = {row[0]: deserialize(row[1]) for row in cursor.fetchall()}
+            res = {row[0]: deserialize(decode_value(row[1])) for row in cursor.fetchall()}
         if self.overflow_storage is not None:
-            res.update(self.overflow_storage.load_all())
+            res.update({key: self._get_overflow(key) for key in self.overflow_storage.keys()})
         return res
 
+    def _get_overflow(self, key: str) -> Any:
+        value = self.overflow_storage.get(key)
+        if self.overflow_arrays and isinstance(value, np.ndarray):
+            value = serialize(value)
+        return value
+
     @transaction
     def get(self, key: str, conn: Optional[sqlite3.Connection] = None) -> Any:
         cursor = conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,))
         result = cursor.fetchone()
         if result is None:
             if self.overflow_storage is not None:
-                return self.overflow_storage.get(key)
+                return self._get_overflow(key)
             else:
                 raise KeyError(f"Key {key} not found")
-        return deserialize(result[0])
+        return deserialize(decode_value(result[0]))
+
+    @transaction
+    def mget(
+        self, keys: Iterable[str], batch_size: int = 10_000, conn: Optional[sqlite3.Connection] = None
+    ) -> Dict[str, Any]:
+        """
+        Get the values of many keys with one query per batch of keys. Keys
+        that are not in the table (including those in the overflow storage)
+        are left out of the result.
+        """
+        keys = list(keys)
+        res = {}
+        for i in range(0, len(keys), batch_size):
+            cursor = conn.execute(
+                f"SELECT key, value FROM {self.table} WHERE key IN (SELECT value FROM json_each(?))",
+                (json.dumps(keys[i:i + batch_size]),),
+            )
+            res.update({key: deserialize(decode_value(value)) for key, value in cursor})
+        return res
 
     @transaction
     def set(
         self, key: str, value: Any, conn: Optional[sqlite3.Connection] = None
     ) -> None:
-        serialized_value = serialize(value)
-        # compute the space this string would take up in bytes
-        size_MB = len(serialized_value) / 1024 / 1024
-        if size_MB > self.overflow_threshold_MB:
-            if self.overflow_storage is not None:
-                self.overflow_storage.set(key, value)
+        self.mset({key: value}, conn=conn)
+
+    @transaction
+    def mset(
+        self, items: Dict[str, Any], conn: Optional[sqlite3.Connection] = None,
+        codecs: Optional[Dict[str, str]] = None,
+    ) -> int:
+        """
+        Write many key-value pairs with a single `executemany`, sending values
+        that are too large to the overflow storage. Return the number of rows
+        written to the table.
+
+        `codecs` optionally overrides the codec of this storage for some keys.
+        """
+        codecs = {} if codecs is None else codecs
+        keys, serialized_values = [], []
+        for key, value in items.items():
+            codec = codecs.get(key, self.codec)
+            serialized_value = encode_value(serialize(value), codec=codec, min_bytes=self.codec_min_bytes)
+            # compute the space this string would take up in bytes
+            size_MB = len(serialized_value) / 1024 / 1024
+            if size_MB > self.overflow_threshold_MB:
+                if self.overflow_storage is not None:
+                    array = serialized_array_view(value) if self.overflow_arrays else None
+                    self.overflow_storage.set(key, value if array is None else array, codec=codec, conn=conn)
+                else:
+                    raise ValueError(
+                        f"Value for key {key} is too large ({size_MB:.2f} MB) and no overflow storage is provided"
+                    )
             else:
-                raise ValueError(
-                    f"Value for key {key} is too large ({size_MB:.2f} MB) and no overflow storage is provided"
-                )
-        else:
-            conn.execute(
-                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
-                (key, serialized_value),
-            )
+                keys.append(key)
+                serialized_values.append(serialized_value)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+            zip(keys, serialized_values),
+        )
+        return len(keys)
 
     @transaction
     def drop(self, key: str, conn: Optional[sqlite3.Connection] = None) -> None:
         conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
-        if self.overflow_storage is not None and self.overflow_storage.exists(key):
-            self.overflow_storage.drop(key)
+        if self.overflow_storage is not None and self.overflow_storage.exists(key, conn=conn):
+            self.overflow_storage.drop(key, conn=conn)
 
     @transaction
     def exists(self, key: str, conn: Optional[sqlite3.Connection] = None) -> bool:
@@ -244,7 +725,7 @@ class SQLiteDictStorage(DictStorage):
         if self.overflow_storage is None:
             return count > 0
         else:
-            return count > 0 or self.overflow_storage.exists(key)
+            return count > 0 or self.overflow_storage.exists(key, conn=conn)
 
     @transaction
     def keys(self, conn: Optional[sqlite3.Connection] = None) -> List[str]:
@@ -257,19 +738,748 @@ class SQLiteDictStorage(DictStorage):
     @transaction
     def values(self, conn: Optional[sqlite3.Connection] = None) -> List[Any]:
         cursor = conn.execute(f"SELECT value FROM {self.table}")
-        res = [deserialize(row[0]) for row in cursor.fetchall()]
+        res = [deserialize(decode_value(row[0])) for row in cursor.fetchall()]
         if self.overflow_storage is not None:
-            res.extend(self.overflow_storage.values())
+            res.extend(self._get_overflow(key) for key in self.overflow_storage.keys())
         return res
 
 
+################################################################################
+### existence filters
+################################################################################
+class BloomFilter:
+    """
+    A Bloom filter over string keys, sized to hold `capacity` keys with a
+    false positive rate of `fp_rate`. Used to answer "definitely not in the
+    database" without a query; keys can't be removed, so dropped keys only
+    cost an extra query until the filter is rebuilt.
+
+    Also counts how often it is consulted, so that the observed false
+    positive rate can be compared with the expected one.
+    """
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        self.reset(capacity=capacity, fp_rate=fp_rate)
+
+    def reset(self, capacity: int, fp_rate: float = 0.01):
+        """
+        Empty the filter in place and resize it for `capacity` keys.
+        """
+        self.capacity = max(capacity, 1)
+        self.fp_rate = fp_rate
+        self.num_bits = max(int(math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.num_items = 0
+        self.num_negatives = 0
+        self.num_false_positives = 0
+
+    def _positions(self, key: str) -> List[int]:
+        # double hashing with the two halves of a 128-bit digest
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        h1, h2 = digest & 0xFFFFFFFFFFFFFFFF, (digest >> 64) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.num_items += 1
+
+    def update(self, keys: Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def rules_out(self, key: str) -> bool:
+        """
+        Whether `key` is definitely not in the set. Counted for the stats.
+        """
+        if key in self:
+            return False
+        self.num_negatives += 1
+        return True
+
+    def record_false_positive(self):
+        self.num_false_positives += 1
+
+    def merge(self, capacity: int, fp_rate: float, num_items: int, bits: bytes) -> bool:
+        """
+        Add the keys of another filter (given by its persisted fields) to
+        this one; return `False` if the filters have different shapes.
+        """
+        if (capacity, fp_rate) != (self.capacity, self.fp_rate) or len(bits) != len(self.bits):
+            return False
+        merged = int.from_bytes(self.bits, "little") | int.from_bytes(bits, "little")
+        self.bits = bytearray(merged.to_bytes(len(self.bits), "little"))
+        self.num_items = max(self.num_items, num_items)
+        return True
+
+    @property
+    def is_full(self) -> bool:
+        return self.num_items > self.capacity
+
+    @property
+    def expected_fp_rate(self) -> float:
+        return (1 - math.exp(-self.num_hashes * self.num_items / self.num_bits)) ** self.num_hashes
+
+    @property
+    def observed_fp_rate(self) -> Optional[float]:
+        num_absent = self.num_negatives + self.num_false_positives
+        return self.num_false_positives / num_absent if num_absent > 0 else None
+
+
+class ExistenceFilters:
+    """
+    Bloom filters over the call history IDs, call content IDs and shape
+    history IDs in the database, persisted in the `bloom_filters` table.
+
+    The filters must never miss a key that is in the database, or calls
+    would be recomputed and saved twice. To detect writes they haven't seen,
+    every commit bumps the `commit_count` in the `meta` table, and the
+    filters remember the count they are up to date with. On `sync()` (at the
+    start of a top-level storage context and on commit), the filters pick up
+    the commits of other processes from the persisted ones, or are rebuilt
+    from the tables if the persisted ones are stale too (e.g. after commits
+    from a storage without filters). Writes by versions of this package that
+    don't bump the count can't be detected; use `rebuild()` after them.
+    """
+    SOURCES = {
+        "call_hids": "SELECT DISTINCT call_history_id FROM {calls}",
+        "call_cids": "SELECT DISTINCT call_content_id FROM {calls}",
+        "shape_hids": "SELECT key FROM {shapes}",
+    }
+
+    def __init__(self, db: "DBAdapter", fp_rate: float = 0.01, min_capacity: int = 100_000,
+                 calls_table: str = "calls", shapes_table: str = "shapes"):
+        self.db = db
+        self.fp_rate = fp_rate
+        self.min_capacity = min_capacity
+        self.tables = {"calls": calls_table, "shapes": shapes_table}
+        self.filters = {name: BloomFilter(capacity=min_capacity, fp_rate=fp_rate) for name in self.SOURCES}
+        # the commit count the filters are up to date with; `None` if unknown
+        self.commit_count: Optional[int] = None
+        self.sync()
+
+    def __getitem__(self, name: str) -> BloomFilter:
+        return self.filters[name]
+
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn()
+
+    @staticmethod
+    def get_commit_count(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'commit_count'").fetchone()
+        return 0 if row is None else int(row[0])
+
+    @staticmethod
+    def bump_commit_count(conn: sqlite3.Connection) -> int:
+        count = ExistenceFilters.get_commit_count(conn) + 1
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('commit_count', ?)", (str(count),))
+        return count
+
+    @transaction
+    def sync(self, conn: Optional[sqlite3.Connection] = None):
+        """
+        Bring the filters up to date with the commits made since they were
+        last synced.
+        """
+        count = self.get_commit_count(conn)
+        if count == self.commit_count:
+            return
+        rows = {row[0]: row[1:] for row in conn.execute(
+            "SELECT name, capacity, fp_rate, num_items, commit_count, bits FROM bloom_filters"
+        )}
+        for name, bloom in self.filters.items():
+            row = rows.get(name)
+            if row is None or row[3] != count:
+                self._rebuild(name, conn=conn)
+            elif self.commit_count is None:
+                # first load: take the persisted filter as is
+                capacity, fp_rate, num_items, _, bits = row
+                bloom.reset(capacity=capacity, fp_rate=fp_rate)
+                bloom.bits, bloom.num_items = bytearray(bits), num_items
+            elif not bloom.merge(*row[:3], bits=row[4]):
+                self._rebuild(name, conn=conn)
+        self.commit_count = count
+
+    def _rebuild(self, name: str, conn: sqlite3.Connection):
+        keys = [row[0] for row in conn.execute(self.SOURCES[name].format(**self.tables))]
+        self.filters[name].reset(capacity=max(self.min_capacity, 2 * len(keys)), fp_rate=self.fp_rate)
+        self.filters[name].update(keys)
+        logger.debug(f"Rebuilt the {name} Bloom filter from {len(keys)} keys.")
+
+    @transaction
+    def rebuild(self, conn: Optional[sqlite3.Connection] = None):
+        """
+        Rebuild all filters from the tables, and persist them.
+        """
+        for name in self.filters:
+            self._rebuild(name, conn=conn)
+        self.commit_count = self.get_commit_count(conn)
+        self.save(conn=conn)
+
+    @transaction
+    def save(self, conn: Optional[sqlite3.Connection] = None):
+        """
+        Persist the filters, growing the ones that are over capacity first.
+        The filters must be up to date with the current commit count.
+        """
+        for name, bloom in self.filters.items():
+            if bloom.is_full:
+                self._rebuild(name, conn=conn)
+        conn.executemany(
+            "INSERT OR REPLACE INTO bloom_filters (name, capacity, fp_rate, num_items, commit_count, bits) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(name, bloom.capacity, bloom.fp_rate, bloom.num_items, self.commit_count, bytes(bloom.bits))
+             for name, bloom in self.filters.items()],
+        )
+
+    def stats(self) -> pd.DataFrame:
+        return pd.DataFrame([{
+            "filter": name,
+            "items": bloom.num_items,
+            "capacity": bloom.capacity,
+            "KiB": len(bloom.bits) / 1024,
+            "negatives": bloom.num_negatives,
+            "false_positives": bloom.num_false_positives,
+            "expected_fp_rate": bloom.expected_fp_rate,
+            "observed_fp_rate": bloom.observed_fp_rate,
+        } for name, bloom in self.filters.items()])
+
+
+################################################################################
+### leases on calls in flight
+################################################################################
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # exists, but belongs to someone else
+        return True
+    return True
+
+
+class CallLeases:
+    """
+    Leases on the new calls a storage is computing, kept in the `call_leases`
+    table, so that processes sharing the database don't compute the same
+    call at the same time.
+
+    A lease is held from the moment the call is found to be missing until it
+    is committed (or its computation fails). While any leases are held, a
+    background thread refreshes their heartbeat every `timeout / 3` seconds.
+    A lease can be taken over if its heartbeat is older than `timeout`, or if
+    its owner was a process on this host that no longer exists.
+    """
+    def __init__(self, db: "DBAdapter", timeout: float = 60.0, poll_interval: float = 0.1):
+        self.db = db
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.host = socket.gethostname()
+        # distinguishes storages in the same process
+        self._uid = uuid.uuid4().hex
+        # the leases held by this storage, and those of them whose call is done
+        self.held: Set[str] = set()
+        self.done: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self.num_takeovers = 0
+
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn()
+
+    @property
+    def owner(self) -> str:
+        return f"{self.host}:{os.getpid()}:{self._uid}"
+
+    def _is_stale(self, host: str, pid: int, heartbeat: float) -> bool:
+        if time.time() - heartbeat > self.timeout:
+            return True
+        return host == self.host and pid != os.getpid() and not _pid_alive(pid)
+
+    @transaction
+    def acquire(self, call_hid: str, conn: Optional[sqlite3.Connection] = None) -> bool:
+        """
+        Try to take the lease on the given call. Return whether it's ours.
+        """
+        row = conn.execute(
+            "SELECT owner, host, pid, heartbeat FROM call_leases WHERE call_hid = ?", (call_hid,)
+        ).fetchone()
+        if row is not None and row[0] != self.owner:
+            if not self._is_stale(*row[1:]):
+                return False
+            logger.info(f"Taking over the stale lease of {row[0]} on call {call_hid}.")
+            self.num_takeovers += 1
+        conn.execute(
+            "INSERT OR REPLACE INTO call_leases (call_hid, owner, host, pid, heartbeat) VALUES (?, ?, ?, ?, ?)",
+            (call_hid, self.owner, self.host, os.getpid(), time.time()),
+        )
+        with self._lock:
+            self.held.add(call_hid)
+            self.done.discard(call_hid)
+        self._start_heartbeat()
+        return True
+
+    @transaction
+    def release(self, call_hids: Iterable[str], conn: Optional[sqlite3.Connection] = None):
+        call_hids = list(call_hids)
+        conn.execute(
+            "DELETE FROM call_leases WHERE call_hid IN (SELECT value FROM json_each(?)) AND owner = ?",
+            (json.dumps(call_hids), self.owner),
+        )
+        with self._lock:
+            self.held.difference_update(call_hids)
+            self.done.difference_update(call_hids)
+
+    def mark_done(self, call_hid: str):
+        """
+        Mark the call as computed; its lease is released once it's committed.
+        """
+        with self._lock:
+            self.done.add(call_hid)
+
+    def release_committed(self, dirty_hids: Set[str]):
+        """
+        Release the leases of the done calls that are not dirty anymore.
+        """
+        with self._lock:
+            committed = [hid for hid in self.done if hid not in dirty_hids]
+        if len(committed) > 0:
+            self.release(committed)
+
+    @transaction
+    def heartbeat(self, conn: Optional[sqlite3.Connection] = None):
+        with self._lock:
+            held = list(self.held)
+        conn.execute(
+            "UPDATE call_leases SET heartbeat = ? WHERE call_hid IN (SELECT value FROM json_each(?)) AND owner = ?",
+            (time.time(), json.dumps(held), self.owner),
+        )
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is not None and self._heartbeat_thread.is_alive():
+            return
+        self._stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._beat, name="mandala-leases", daemon=True)
+        self._heartbeat_thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.timeout / 3):
+            if len(self.held) == 0:
+                continue
+            try:
+                self.heartbeat()
+            except Exception as e: # keep beating; the lease may be taken over meanwhile
+                logger.warning(f"Could not refresh the leases on calls: {e}")
+
+    def close(self):
+        """
+        Stop the heartbeat and release all the leases held.
+        """
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        if len(self.held) > 0:
+            self.release(list(self.held))
+
+
+################################################################################
+### cache eviction
+################################################################################
+def estimate_size(value: Any) -> int:
+    """
+    A cheap estimate of the memory taken by a cached value, in bytes.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, "__dict__"): # e.g. the `Ref`s in the shapes cache
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in vars(value).values())
+    return sys.getsizeof(value)
+
+
+class EvictionPolicy(ABC):
+    """
+    Keeps track of the keys of a cache and their sizes, and decides which
+    ones to evict when the cache is over its budget.
+    """
+    def __init__(self):
+        self.sizes: Dict[str, int] = {}
+        self.total_size = 0
+
+    def add(self, key: str, size: int):
+        if key in self.sizes:
+            self.remove(key)
+        self.sizes[key] = size
+        self.total_size += size
+        self._on_add(key)
+
+    def remove(self, key: str):
+        self.total_size -= self.sizes.pop(key)
+        self._on_remove(key)
+
+    def clear(self):
+        self.sizes.clear()
+        self.total_size = 0
+        self._on_clear()
+
+    @abstractmethod
+    def touch(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def select_victims(self, num_bytes: int, pinned: Set[str]) -> List[str]:
+        """
+        Return keys not in `pinned`, in eviction order, whose sizes add up to
+        at least `num_bytes` (or as many as there are).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _on_add(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _on_remove(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _on_clear(self):
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evict the least recently used keys first.
+    """
+    def __init__(self):
+        super().__init__()
+        self.order: OrderedDict = OrderedDict()
+
+    def touch(self, key: str):
+        self.order.move_to_end(key)
+
+    def _on_add(self, key: str):
+        self.order[key] = None
+
+    def _on_remove(self, key: str):
+        del self.order[key]
+
+    def _on_clear(self):
+        self.order.clear()
+
+    def select_victims(self, num_bytes: int, pinned: Set[str]) -> List[str]:
+        victims, freed = [], 0
+        for key in self.order:
+            if freed >= num_bytes:
+                break
+            if key not in pinned:
+                victims.append(key)
+                freed += self.sizes[key]
+        return victims
+
+
+class _HeapPolicy(EvictionPolicy):
+    """
+    Evict the keys with the lowest priority first, using a heap with lazy
+    deletion of outdated entries.
+    """
+    def __init__(self):
+        super().__init__()
+        self.priorities: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+
+    @abstractmethod
+    def _priority(self, key: str) -> float:
+        raise NotImplementedError
+
+    def _push(self, key: str):
+        priority = self._priority(key)
+        self.priorities[key] = priority
+        heapq.heappush(self.heap, (priority, next(self._seq), key))
+        if len(self.heap) > 2 * len(self.priorities) + 1024: # drop outdated entries
+            self.heap = [(p, seq, k) for p, seq, k in self.heap if self.priorities.get(k) == p]
+            heapq.heapify(self.heap)
+
+    def touch(self, key: str):
+        self.counts[key] += 1
+        self._push(key)
+
+    def _on_add(self, key: str):
+        self.counts[key] = 1
+        self._push(key)
+
+    def _on_remove(self, key: str):
+        del self.counts[key]
+        del self.priorities[key]
+
+    def _on_clear(self):
+        self.counts.clear()
+        self.priorities.clear()
+        self.heap.clear()
+
+    def _on_evict(self, priority: float):
+        pass
+
+    def select_victims(self, num_bytes: int, pinned: Set[str]) -> List[str]:
+        victims, skipped, freed = {}, [], 0
+        while freed < num_bytes and len(self.heap) > 0:
+            entry = heapq.heappop(self.heap)
+            priority, _, key = entry
+            if self.priorities.get(key) != priority or key in victims:
+                continue # outdated entry
+            if key in pinned:
+                skipped.append(entry)
+                continue
+            victims[key] = None
+            freed += self.sizes[key]
+            self._on_evict(priority)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return list(victims)
+
+
+class LFUPolicy(_HeapPolicy):
+    """
+    Evict the least frequently used keys first.
+    """
+    def _priority(self, key: str) -> float:
+        return self.counts[key]
+
+
+class GDSFPolicy(_HeapPolicy):
+    """
+    Greedy-Dual-Size-Frequency: evict the keys with the lowest
+    `inflation + frequency / size` first, where the inflation is the
+    priority of the last evicted key. This favors keeping small, frequently
+    used values, while letting keys that were popular long ago age out.
+    """
+    def __init__(self):
+        super().__init__()
+        self.inflation = 0.0
+
+    def _priority(self, key: str) -> float:
+        return self.inflation + self.counts[key] / max(self.sizes[key], 1)
+
+    def _on_evict(self, priority: float):
+        self.inflation = max(self.inflation, priority)
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "gdsf": GDSFPolicy,
+}
+
+
+def get_eviction_policy(policy: Union[str, EvictionPolicy]) -> EvictionPolicy:
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    if policy not in EVICTION_POLICIES:
+        raise ValueError(f"Unknown eviction policy {policy}; known policies are {list(EVICTION_POLICIES)}")
+    return EVICTION_POLICIES[policy]()
+
+
+class BoundedCache(MutableMapping):
+    """
+    A dict-like cache that evicts entries according to an `EvictionPolicy`
+    when the estimated size of its values goes over `max_bytes`. Keys in
+    `pinned` (e.g. the dirty keys of a storage) are never evicted, so the
+    cache may go over budget until they are unpinned.
+    """
+    def __init__(self, max_bytes: int, policy: Union[str, EvictionPolicy] = "lru",
+                 pinned: Optional[Set[str]] = None,
+                 sizeof: Callable[[Any], int] = estimate_size):
+        self.max_bytes = max_bytes
+        self.policy = get_eviction_policy(policy)
+        self.pinned = set() if pinned is None else pinned
+        self.sizeof = sizeof
+        self.data: Dict[str, Any] = {}
+        self.num_evictions = 0
+        self.evicted_bytes = 0
+        # whether everything was pinned the last time we tried to evict;
+        # avoids rescanning the pinned keys on each write of a dirty batch
+        self._all_pinned = False
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.data[key]
+        self.policy.touch(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.data:
+            return self[key]
+        return default
+
+    def __setitem__(self, key: str, value: Any):
+        self.data[key] = value
+        self.policy.add(key, self.sizeof(value))
+        if key not in self.pinned:
+            self._all_pinned = False
+        if not self._all_pinned:
+            self.evict()
+
+    def __delitem__(self, key: str):
+        del self.data[key]
+        self.policy.remove(key)
+
+    def pop(self, key: str, *default: Any) -> Any:
+        if key in self.data:
+            self.policy.remove(key)
+        return self.data.pop(key, *default)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+        self.policy.clear()
+
+    @property
+    def size(self) -> int:
+        return self.policy.total_size
+
+    def evict(self):
+        """
+        Evict unpinned entries until the cache is within its budget.
+        """
+        excess = self.size - self.max_bytes
+        if excess <= 0:
+            return
+        victims = self.policy.select_victims(num_bytes=excess, pinned=self.pinned)
+        for key in victims:
+            self.evicted_bytes += self.policy.sizes[key]
+            del self[key]
+        self.num_evictions += len(victims)
+        self._all_pinned = self.size > self.max_bytes
+
+
+_IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, frozenset)
+
+
+def _is_immutable(obj: Any) -> bool:
+    if isinstance(obj, tuple):
+        return all(_is_immutable(elt) for elt in obj)
+    return isinstance(obj, _IMMUTABLE_TYPES)
+
+
+class ObjectCache:
+    """
+    A cache of deserialized atoms by content ID, in front of the cache of
+    serialized values in `CachedDictStorage`, so that loading the same atom
+    again doesn't pay for deserialization.
+
+    Since the same object is handed out on every read, it is protected from
+    modifications by the readers according to `mode`:
+    - "copy": mutable objects are copied on every read (still much cheaper
+    than deserializing them for large arrays and data frames);
+    - "readonly": numpy arrays are made read-only and shared, other mutable
+    objects are copied;
+    - "shared": the cached object is shared as is, and readers must not
+    modify it.
+    Immutable objects (numbers, strings, ...) are always shared.
+    """
+    MODES = ("copy", "readonly", "shared")
+
+    def __init__(self, max_bytes: int, policy: Union[str, EvictionPolicy] = "lru", mode: str = "copy"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown object cache mode {mode}; known modes are {self.MODES}")
+        self.mode = mode
+        self.cache = BoundedCache(max_bytes=max_bytes, policy=policy)
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, cid: str) -> bool:
+        return cid in self.cache
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def _protect(self, obj: Any) -> Any:
+        if self.mode == "shared" or _is_immutable(obj):
+            return obj
+        if isinstance(obj, np.ndarray):
+            return obj if self.mode == "readonly" else obj.copy()
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            return obj.copy(deep=True)
+        return copy.deepcopy(obj)
+
+    def get(self, cid: str) -> Any:
+        """
+        Return (a protected version of) the cached object; the cid must be
+        in the cache.
+        """
+        self.hits += 1
+        return self._protect(self.cache[cid])
+
+    def put(self, cid: str, obj: Any) -> Any:
+        """
+        Cache a freshly deserialized object, and return the version of it to
+        hand out to the caller.
+        """
+        self.misses += 1
+        if self.mode == "readonly" and isinstance(obj, np.ndarray) and not isinstance(obj, np.memmap):
+            obj.flags.writeable = False
+        self.cache[cid] = obj
+        # no need to protect objects that were too large to be cached
+        return self._protect(obj) if cid in self.cache else obj
+
+    def pop(self, cid: str):
+        self.cache.pop(cid, None)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "present": len(self.cache),
+            "MB": self.cache.size / 1024 ** 2,
+            "max_MB": self.cache.max_bytes / 1024 ** 2,
+            "evictions": self.cache.num_evictions,
+            "hit_rate": self.hits / total if total > 0 else None,
+        }
+
+
 class CachedDictStorage(DictStorage):
-    def __init__(self, persistent: DictStorage):
+    def __init__(self, persistent: DictStorage,
+                 max_bytes: Optional[int] = None,
+                 policy: Union[str, EvictionPolicy] = "lru",
+                 ):
+        """
+        If `max_bytes` is given, the cache is a `BoundedCache` with the given
+        eviction policy, which never evicts dirty keys.
+        """
         self.persistent = persistent
-        # keep a cache of the values for faster lookups
-        self.cache: Dict[str, Any] = {}
+        # an optional filter of the keys in the persistent storage
+        self.key_filter: Optional[BloomFilter] = None
         # keep track of keys that have been added but not yet persisted
         self.dirty_keys: Set[str] = set()
+        # keep a cache of the values for faster lookups
+        self.cache: Union[Dict[str, Any], BoundedCache] = (
+            {} if max_bytes is None else BoundedCache(max_bytes=max_bytes, policy=policy, pinned=self.dirty_keys)
+        )
+        # codecs to use for some of the dirty keys instead of the persistent
+        # storage's default
+        self.codecs: Dict[str, str] = {}
+        # the estimated size of the dirty values, in bytes
+        self.dirty_bytes = 0
     
     def load_all(self) -> Dict[str, Any]:
         return self.persistent.load_all()
@@ -285,17 +1495,82 @@ class CachedDictStorage(DictStorage):
             self.cache[key] = value
             return value
 
-    def set(self, key: str, value: Any) -> None:
+    def estimated_size(self) -> int:
+        """
+        The estimated size of the values in the cache, in bytes.
+        """
+        if isinstance(self.cache, BoundedCache):
+            return self.cache.size
+        return sum(estimate_size(value) for value in self.cache.values())
+
+    def prefetch(self, keys: Iterable[str]) -> None:
+        """
+        Load the values of the keys that are not in the cache with batched
+        queries. Keys that are not found are skipped, and will be looked up
+        (and fail) one by one on `get` as usual.
+        """
+        if not isinstance(self.persistent, SQLiteDictStorage):
+            return
+        missing = [key for key in dict.fromkeys(keys) if key not in self.cache]
+        if len(missing) > 0:
+            self.cache.update(self.persistent.mget(missing))
+
+    def set(self, key: str, value: Any, codec: Optional[str] = None) -> None:
+        if key not in self.dirty_keys:
+            self.dirty_bytes += estimate_size(value)
+        self.dirty_keys.add(key) # first, so that a bounded cache won't evict it
         self.cache[key] = value
-        self.dirty_keys.add(key)
+        if codec is not None:
+            self.codecs[key] = codec
 
-    def commit(self, conn: Optional[sqlite3.Connection] = None) -> None:
+    def dirty_items(self) -> Tuple[Dict[str, Any], Dict[str, str]]:
         """
-        Persist the values of all dirty keys and clear them
+        Return a snapshot of the values of the dirty keys and their codecs,
+        without clearing them.
         """
-        for key in self.dirty_keys:
-            self.persistent.set(key, self.cache[key], conn=conn)
-        self.dirty_keys.clear()
+        return ({key: self.cache[key] for key in self.dirty_keys},
+                {key: codec for key, codec in self.codecs.items() if key in self.dirty_keys})
+
+    def write(self, items: Dict[str, Any], codecs: Dict[str, str],
+              conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Write a snapshot returned by `dirty_items()` to the persistent storage,
+        without touching the cache. This is safe to call from another thread
+        (with that thread's connection). Return the number of keys written.
+        """
+        if isinstance(self.persistent, SQLiteDictStorage):
+            if len(items) > 0:
+                self.persistent.mset(items, conn=conn, codecs=codecs)
+        else:
+            for key, value in items.items():
+                self.persistent.set(key, value, conn=conn)
+        return len(items)
+
+    def mark_committed(self, keys: Iterable[str]) -> None:
+        """
+        Mark the given keys as persisted.
+        """
+        keys = [key for key in keys if key in self.dirty_keys]
+        if self.key_filter is not None:
+            self.key_filter.update(keys)
+        for key in keys:
+            self.dirty_bytes -= estimate_size(self.cache[key])
+            self.dirty_keys.remove(key)
+            self.codecs.pop(key, None)
+        if len(self.dirty_keys) == 0:
+            self.dirty_bytes = 0 # don't let estimation errors accumulate
+        if isinstance(self.cache, BoundedCache): # the committed keys can be evicted now
+            self.cache.evict()
+
+    def commit(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Persist the values of all dirty keys and clear them. Return the number
+        of keys persisted.
+        """
+        items, codecs = self.dirty_items()
+        num_keys = self.write(items, codecs, conn=conn)
+        self.mark_committed(items)
+        return num_keys
     
     def clear(self, allow_uncommited: bool = False) -> None:
         if len(self.dirty_keys) > 0 and not allow_uncommited:
@@ -306,23 +1581,41 @@ class CachedDictStorage(DictStorage):
             raise ValueError(msg)
         self.cache.clear()
         self.dirty_keys.clear()
+        self.codecs.clear()
+        self.dirty_bytes = 0
 
     def drop(self, key: str) -> None:
         if key in self.cache:
             del self.cache[key]
         if key in self.dirty_keys:
             self.dirty_keys.remove(key) # when we `drop`, we forget this key ever existed
+            self.codecs.pop(key, None)
+            if len(self.dirty_keys) == 0:
+                self.dirty_bytes = 0
         self.persistent.drop(key)
 
     def exists(self, key: str) -> bool:
         if key in self.cache:
             return True
+        elif self.key_filter is not None and self.key_filter.rules_out(key):
+            return False
         else:
             res = self.persistent.exists(key)
+            if not res and self.key_filter is not None:
+                self.key_filter.record_false_positive()
             return res
 
 
 class InMemCallStorage:
+    """
+    An in-memory table of calls with the same columns as the `calls` table in
+    the database, stored as append-only column lists together with hash
+    indexes by call history ID, call content ID and ref history ID.
+
+    Rows of dropped calls are only marked as dead, and are periodically
+    compacted away. A `pd.DataFrame` view of the table is built (and cached)
+    only when the `df` property is accessed.
+    """
     COLUMNS = [
         "call_history_id",
         "name",
@@ -336,91 +1629,145 @@ class InMemCallStorage:
     ]
 
     def __init__(self, df: Optional[pd.DataFrame] = None):
+        self._reset()
         if df is not None:
-            self.df = df
-            # for faster lookups
-            self.call_hids = set(df.index.levels[0].unique())
-        else:
-            self.df = pd.DataFrame(columns=InMemCallStorage.COLUMNS).set_index(
+            self.load_df(df)
+
+    def _reset(self):
+        self.columns: Dict[str, List[Any]] = {col: [] for col in InMemCallStorage.COLUMNS}
+        # whether each row is still alive (i.e., its call has not been dropped)
+        self.alive: List[bool] = []
+        self.num_dead = 0
+        ### indexes
+        # call hid -> positions of the rows of this call
+        self.rows_by_hid: Dict[str, List[int]] = {}
+        # call cid -> call hids with this cid (a dict is used as an ordered set)
+        self.hids_by_cid: Dict[str, Dict[str, None]] = {}
+        # ref hid -> positions of the rows where this ref is an input/output
+        self.rows_by_ref_hid: Dict[str, List[int]] = {}
+        # the cached DataFrame view; reset on every modification
+        self._df: Optional[pd.DataFrame] = None
+
+    def __len__(self) -> int:
+        return len(self.rows_by_hid)
+
+    @property
+    def call_hids(self) -> Iterable[str]:
+        return self.rows_by_hid.keys()
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """
+        The contents of the table as a DataFrame indexed by (call_history_id,
+        name), like the one returned by `SQLiteCallStorage.get_df()`.
+        """
+        if self._df is None:
+            data = {
+                col: [v for v, alive in zip(vals, self.alive) if alive]
+                for col, vals in self.columns.items()
+            }
+            self._df = pd.DataFrame(data, columns=InMemCallStorage.COLUMNS).set_index(
                 ["call_history_id", "name"]
             )
-            self.call_hids = set()
-        
-    def __len__(self) -> int:
-        return self.df.index.get_level_values(0).nunique()
+        return self._df
+
+    def _append_row(self, row: Tuple[Any, ...]):
+        pos = len(self.alive)
+        for col, v in zip(InMemCallStorage.COLUMNS, row):
+            self.columns[col].append(v)
+        self.alive.append(True)
+        call_hid, call_cid, ref_hid = row[0], row[3], row[5]
+        self.rows_by_hid.setdefault(call_hid, []).append(pos)
+        self.hids_by_cid.setdefault(call_cid, {})[call_hid] = None
+        self.rows_by_ref_hid.setdefault(ref_hid, []).append(pos)
+
+    def load_df(self, df: pd.DataFrame):
+        """
+        Add the calls from a DataFrame in the format of `.df` whose history IDs
+        are not already present.
+        """
+        flat = df.reset_index()
+        new_hids = set(flat["call_history_id"]) - self.rows_by_hid.keys()
+        if not new_hids:
+            return
+        flat = flat[flat["call_history_id"].isin(new_hids)]
+        for row in zip(*[flat[col].tolist() for col in InMemCallStorage.COLUMNS]):
+            self._append_row(row)
+        self._df = None
 
     def save(self, call: Call):
-        # if call.hid in self.df.index.levels[0]:
-        if call.hid in self.call_hids:
+        if call.hid in self.rows_by_hid:
             return
-        if not hasattr(sess, '_times'):
-            sess._times = []
-        start = time.time()
-        for k, v in call.inputs.items():
-            self.df.loc[(call.hid, k), :] = ("in", call.cid, v.cid, v.hid, call.op.name, call.semantic_version, call.content_version)
-        for k, v in call.outputs.items():
-            self.df.loc[(call.hid, k), :] = (
-                "out",
-                call.cid,
-                v.cid,
-                v.hid,
-                call.op.name,
-                call.semantic_version,
-                call.content_version,
-            )
-        end = time.time()
-        sess._times.append(end - start)
-        self.call_hids.add(call.hid)
+        for direction, refs in (("in", call.inputs), ("out", call.outputs)):
+            for k, v in refs.items():
+                self._append_row((
+                    call.hid, k, direction, call.cid, v.cid, v.hid,
+                    call.op.name, call.semantic_version, call.content_version,
+                ))
+        self._df = None
 
     def drop(self, hid: str):
         """
         Remove all rows referencing the call with the given history_id.
         """
-        if hid not in self.df.index.levels[0]:
+        if hid not in self.rows_by_hid:
             raise ValueError(f"Call with history_id {hid} does not exist")
-        # self.df.drop(index=hid, level=0, inplace=True)
-        self.df = self.df.drop(index=hid, level=0)
-        #! this step is crucial, because otherwise the old `hid` remains in the index
-        self.df.index = self.df.index.remove_unused_levels()
-        self.call_hids.remove(hid)
+        positions = self.rows_by_hid.pop(hid)
+        cid = self.columns["call_content_id"][positions[0]]
+        del self.hids_by_cid[cid][hid]
+        if not self.hids_by_cid[cid]:
+            del self.hids_by_cid[cid]
+        for pos in positions:
+            ref_hid = self.columns["ref_history_id"][pos]
+            self.rows_by_ref_hid[ref_hid].remove(pos)
+            if not self.rows_by_ref_hid[ref_hid]:
+                del self.rows_by_ref_hid[ref_hid]
+            self.alive[pos] = False
+        self.num_dead += len(positions)
+        self._df = None
+        if self.num_dead > len(self.alive) // 2:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rebuild the columns and indexes without the dead rows.
+        """
+        rows = [
+            row for row, alive in zip(zip(*self.columns.values()), self.alive) if alive
+        ]
+        self._reset()
+        for row in rows:
+            self._append_row(row)
 
     def exists(self, hid: str) -> bool:
-        # return call_history_id in self.df.index.levels[0]
-        return hid in self.call_hids
+        return hid in self.rows_by_hid
     
     def exists_content(self, cid: str) -> bool:
-        return cid in self.df.call_content_id.unique()
+        return cid in self.hids_by_cid
+
+    def _get_call_data(self, hid: str) -> Dict[str, Any]:
+        positions = self.rows_by_hid[hid]
+        first = positions[0]
+        res = {
+            "op_name": self.columns["op"][first],
+            "cid": self.columns["call_content_id"][first],
+            "hid": hid,
+            "input_hids": {},
+            "output_hids": {},
+            "input_cids": {},
+            "output_cids": {},
+            "semantic_version": self.columns["semantic_version"][first],
+            "content_version": self.columns["content_version"][first],
+        }
+        for pos in positions:
+            name = self.columns["name"][pos]
+            prefix = "input" if self.columns["direction"][pos] == "in" else "output"
+            res[f"{prefix}_hids"][name] = self.columns["ref_history_id"][pos]
+            res[f"{prefix}_cids"][name] = self.columns["ref_content_id"][pos]
+        return res
     
     def mget_data(self, call_hids: List[str]) -> List[Dict[str, Any]]:
-        idx = pd.IndexSlice
-        filtered_df = self.df.loc[idx[call_hids, :], :]
-        grouped = filtered_df.groupby(level=0)
-        groups = {key: value for key, value in grouped}
-        res_dict = {}
-        for hid, group_df in tqdm(groups.items(), delay=5):
-            rows = group_df.reset_index().to_dict(orient="records")
-            input_hids, output_hids = {}, {}
-            input_cids, output_cids = {}, {}
-            for row in rows:
-                if row["direction"] == "in":
-                    input_hids[row["name"]] = row["ref_history_id"]
-                    input_cids[row["name"]] = row["ref_content_id"]
-                else:
-                    output_hids[row["name"]] = row["ref_history_id"]
-                    output_cids[row["name"]] = row["ref_content_id"]
-            op_name = rows[0]["op"]
-            res_dict[hid] = {
-                "op_name": op_name,
-                "cid": rows[0]["call_content_id"],
-                "hid": hid,
-                "input_hids": input_hids,
-                "output_hids": output_hids,
-                "input_cids": input_cids,
-                "output_cids": output_cids,
-                "semantic_version": rows[0]["semantic_version"],
-                "content_version": rows[0]["content_version"],
-            }
-        return [res_dict[hid] for hid in call_hids]
+        return [self._get_call_data(hid) for hid in call_hids]
 
     def get_data(self, call_history_id: str) -> Dict[str, Any]:
         """
@@ -428,42 +1775,40 @@ class InMemCallStorage:
         """
         if not self.exists(call_history_id):
             raise ValueError(f"Call with history_id {call_history_id} does not exist")
-        return self.mget_data([call_history_id])[0]
+        return self._get_call_data(call_history_id)
     
     def get_data_content(self, cid: str) -> Dict[str, Any]:
         # find one hid associated with this cid
-        hid = self.df.query('call_content_id == @cid').index.get_level_values(0).unique()[0]
+        hid = next(iter(self.hids_by_cid[cid]))
         return self.get_data(hid)
 
+    def _get_call_hids_by_ref(self, ref_hids: Iterable[str], direction: str) -> Set[str]:
+        res = set()
+        for ref_hid in ref_hids:
+            for pos in self.rows_by_ref_hid.get(ref_hid, ()):
+                if self.columns["direction"][pos] == direction:
+                    res.add(self.columns["call_history_id"][pos])
+        return res
+
+    def _get_ref_hids_by_call(self, call_hids: Iterable[str], direction: str) -> Set[str]:
+        res = set()
+        for call_hid in call_hids:
+            for pos in self.rows_by_hid.get(call_hid, ()):
+                if self.columns["direction"][pos] == direction:
+                    res.add(self.columns["ref_history_id"][pos])
+        return res
+
     def get_creator_hids(self, ref_hids: Iterable[str]) -> Set[str]:
-        #! slow
-        call_history_ids = (
-            self.df.query('ref_history_id in @ref_hids and direction == "out"')
-            .index.get_level_values(0)
-            .unique()
-        )
-        return set(call_history_ids)
+        return self._get_call_hids_by_ref(ref_hids, direction="out")
 
     def get_consumer_hids(self, ref_hids: Iterable[str]) -> Set[str]:
-        #! slow
-        call_history_ids = (
-            self.df.query('ref_history_id in @ref_hids and direction == "in"')
-            .index.get_level_values(0)
-            .unique()
-        )
-        return set(call_history_ids)
+        return self._get_call_hids_by_ref(ref_hids, direction="in")
 
     def get_input_hids(self, call_hids: Iterable[str]) -> Set[str]:
-        ref_hids = self.df.query(
-            'call_history_id in @call_hids and direction == "in"'
-        ).ref_history_id.unique()
-        return set(ref_hids)
+        return self._get_ref_hids_by_call(call_hids, direction="in")
 
     def get_output_hids(self, call_hids: Iterable[str]) -> Set[str]:
-        ref_hids = self.df.query(
-            'call_history_id in @call_hids and direction == "out"'
-        ).ref_history_id.unique()
-        return set(ref_hids)
+        return self._get_ref_hids_by_call(call_hids, direction="out")
 
     def get_dependencies(
         self, ref_hids: Iterable[str], call_hids: Iterable[str]
@@ -540,72 +1885,117 @@ class SQLiteCallStorage:
     def save(
         self, call_data: Dict[str, Any], conn: Optional[sqlite3.Connection] = None
     ):
-        semantic_version = call_data["semantic_version"]
-        content_version = call_data["content_version"]
-        op_name = call_data["op_name"]
-        for k in call_data["input_hids"]:
-            hid = call_data["input_hids"][k]
-            cid = call_data["input_cids"][k]
-            conn.execute(
-                f"INSERT INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (call_data["hid"], k, "in", call_data["cid"], cid, hid, op_name, semantic_version, content_version),
-            )
-        for k in call_data["output_hids"]:
-            hid = call_data["output_hids"][k]
-            cid = call_data["output_cids"][k]
-            conn.execute(
-                f"INSERT INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (call_data["hid"], k, "out", call_data["cid"], cid, hid, op_name, semantic_version, content_version),
-            )
+        self.msave([call_data], conn=conn)
+
+    @transaction
+    def msave(
+        self, call_datas: List[Dict[str, Any]], conn: Optional[sqlite3.Connection] = None
+    ) -> int:
+        """
+        Save the data of many calls with a single `executemany`. Return the
+        number of rows inserted.
+        """
+        # one column per field of the table, one entry per input/output
+        columns = {col: [] for col in InMemCallStorage.COLUMNS}
+        for call_data in call_datas:
+            for direction, hids, cids in (
+                ("in", call_data["input_hids"], call_data["input_cids"]),
+                ("out", call_data["output_hids"], call_data["output_cids"]),
+            ):
+                for k in hids:
+                    columns["call_history_id"].append(call_data["hid"])
+                    columns["name"].append(k)
+                    columns["direction"].append(direction)
+                    columns["call_content_id"].append(call_data["cid"])
+                    columns["ref_content_id"].append(cids[k])
+                    columns["ref_history_id"].append(hids[k])
+                    columns["op"].append(call_data["op_name"])
+                    columns["semantic_version"].append(call_data["semantic_version"])
+                    columns["content_version"].append(call_data["content_version"])
+        # a call with the same history ID is the same call, e.g. one computed
+        # by a process that took over our lease on it
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {self.table_name} ({', '.join(InMemCallStorage.COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in InMemCallStorage.COLUMNS)})",
+            zip(*columns.values()),
+        )
+        return len(columns["call_history_id"])
 
     @transaction
     def drop(self, hid: str, conn: Optional[sqlite3.Connection] = None):
         conn.execute(f"DELETE FROM {self.table_name} WHERE call_history_id = ?", (hid,))
 
+    @transaction
+    def mdrop(self, hids: Iterable[str], conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Drop many calls at once, and return the number of calls that were
+        actually present.
+        """
+        hids = list(hids)
+        existing = conn.execute(
+            f"SELECT COUNT(DISTINCT call_history_id) FROM {self.table_name} "
+            "WHERE call_history_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(hids),),
+        ).fetchone()[0]
+        conn.executemany(
+            f"DELETE FROM {self.table_name} WHERE call_history_id = ?", [(hid,) for hid in hids]
+        )
+        return existing
+
     @transaction
     def exists(
         self, call_history_id: str, conn: Optional[sqlite3.Connection] = None
     ) -> bool:
+        # stop at the first matching row instead of counting all of them
         cursor = conn.execute(
-            f"SELECT COUNT(*) FROM {self.table_name} WHERE call_history_id = ?",
-            (call_history_id,),
+            f"SELECT 1 FROM {self.table_name} WHERE call_history_id = ? LIMIT 1", (call_history_id,)
         )
-        count = cursor.fetchone()[0]
-        return count > 0
+        return cursor.fetchone() is not None
     
     @transaction
     def exists_content(
         self, cid: str, conn: Optional[sqlite3.Connection] = None
     ) -> bool:
+        # stop at the first matching row instead of counting all of them
         cursor = conn.execute(
-            f"SELECT COUNT(*) FROM {self.table_name} WHERE call_content_id = ?", (cid,)
+            f"SELECT 1 FROM {self.table_name} WHERE call_content_id = ? LIMIT 1", (cid,)
         )
-        count = cursor.fetchone()[0]
-        return count > 0
+        return cursor.fetchone() is not None
 
     @transaction
     def exists_ref_hid(
         self, hid: str, conn: Optional[sqlite3.Connection] = None
     ) -> bool:
+        # stop at the first matching row instead of counting all of them
         cursor = conn.execute(
-            f"SELECT COUNT(*) FROM {self.table_name} WHERE ref_history_id = ?", (hid,)
+            f"SELECT 1 FROM {self.table_name} WHERE ref_history_id = ? LIMIT 1", (hid,)
         )
-        count = cursor.fetchone()[0]
-        return count > 0
+        return cursor.fetchone() is not None
     
     @transaction
     def mget_data(
-        self, call_hids: List[str], conn: Optional[sqlite3.Connection] = None
+        self, call_hids: List[str], batch_size: int = 10_000, conn: Optional[sqlite3.Connection] = None
     ) -> List[Dict[str, Any]]:
         """
         Get the data of multiple `Call` objects given their history_ids,
-        preserving order.
+        preserving order, with one query per batch of history_ids.
+        """
+        call_data = {}
+        # pass the hids as JSON to avoid SQLite's limit on the number of parameters
+        for i in range(0, len(call_hids), batch_size):
+            cursor = conn.execute(
+                f"SELECT * FROM {self.table_name} WHERE call_history_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(call_hids[i:i + batch_size]),),
+            )
+            call_data.update(self._group_rows(cursor.fetchall()))
+        return [call_data[hid] for hid in call_hids]
+
+    @staticmethod
+    def _group_rows(rows: List[Tuple[Any, ...]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Group rows of the table into the data of `Call` objects, keyed by
+        history_id.
         """
-        cursor = conn.execute(
-            f"SELECT * FROM {self.table_name} WHERE call_history_id IN ({','.join('?' for _ in call_hids)})",
-            call_hids,
-        )
-        rows = cursor.fetchall()
         call_data = {}
         for row in rows:
             hid = row[0]
@@ -620,7 +2010,7 @@ class SQLiteCallStorage:
             else:
                 call_data[hid]["output_hids"][row[1]] = row[5]
                 call_data[hid]["output_cids"][row[1]] = row[4]
-        return [call_data[hid] for hid in call_hids]
+        return call_data
 
     @transaction
     def get_data(
@@ -636,11 +2026,53 @@ class SQLiteCallStorage:
         self, cid: str, conn: Optional[sqlite3.Connection] = None
     ) -> Dict[str, Any]:
         cursor = conn.execute(
-            f"SELECT * FROM {self.table_name} WHERE call_content_id = ?", (cid,)
+            f"SELECT call_history_id FROM {self.table_name} WHERE call_content_id = ? LIMIT 1", (cid,)
+        )
+        hid = cursor.fetchone()[0]
+        return self.get_data(hid, conn=conn)
+
+    @transaction
+    def lookup(
+        self, call_history_id: str, cid: str, conn: Optional[sqlite3.Connection] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Get the data of the call with the given history_id if it exists, or
+        else of some call with the given content_id, or `None` if neither
+        exists, in a single query.
+        """
+        cursor = conn.execute(
+            f"SELECT * FROM {self.table_name} WHERE call_history_id = COALESCE("
+            f"(SELECT call_history_id FROM {self.table_name} WHERE call_history_id = ? LIMIT 1), "
+            f"(SELECT call_history_id FROM {self.table_name} WHERE call_content_id = ? LIMIT 1))",
+            (call_history_id, cid),
         )
-        rows = cursor.fetchall()
-        hid = rows[0][0]
-        return self.get_data(hid, conn)
+        call_data = self._group_rows(cursor.fetchall())
+        if len(call_data) == 0:
+            return None
+        return next(iter(call_data.values()))
+
+    @transaction
+    def mlookup(
+        self, ids: List[Tuple[str, str]], batch_size: int = 10_000,
+        conn: Optional[sqlite3.Connection] = None,
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Batched version of `lookup` for a list of (history_id, content_id)
+        pairs, with one query per batch of pairs.
+        """
+        by_hid, by_cid = {}, {}
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            cursor = conn.execute(
+                f"SELECT * FROM {self.table_name} WHERE call_history_id IN (SELECT value FROM json_each(?)) "
+                f"OR call_history_id IN (SELECT MIN(call_history_id) FROM {self.table_name} "
+                f"WHERE call_content_id IN (SELECT value FROM json_each(?)) GROUP BY call_content_id)",
+                (json.dumps([hid for hid, _ in batch]), json.dumps([cid for _, cid in batch])),
+            )
+            for hid, call_data in self._group_rows(cursor.fetchall()).items():
+                by_hid[hid] = call_data
+                by_cid.setdefault(call_data["cid"], call_data)
+        return [by_hid.get(hid, by_cid.get(cid)) for hid, cid in ids]
 
     ### provenance queries
     @transaction
@@ -649,7 +2081,7 @@ class SQLiteCallStorage:
     ) -> Set[str]:
         # cursor = conn.execute(f"SELECT DISTINCT call_history_id FROM {self.table_name} WHERE ref_history_id IN ({','.join('?' for _ in hids)})", list(hids))
         cursor = conn.execute(
-            f'SELECT DISTINCT call_history_id FROM {self.table_name} WHERE ref_history_id IN ({",".join("?" for _ in ref_hids)}) AND direction = "out"',
+            f"SELECT DISTINCT call_history_id FROM {self.table_name} WHERE ref_history_id IN ({','.join('?' for _ in ref_hids)}) AND direction = 'out'",
             list(ref_hids),
         )
         return set(row[0] for row in cursor.fetchall())
@@ -684,27 +2116,107 @@ class SQLiteCallStorage:
         )
         return set(row[0] for row in cursor.fetchall())
 
+    # for each direction of traversal, how to go from a call to refs, and from
+    # a ref to calls, in terms of the `direction` column of the `calls` table
+    _CLOSURE_DIRECTIONS = {
+        "dependents": {"call_to_refs": "out", "ref_to_calls": "in"},
+        "dependencies": {"call_to_refs": "in", "ref_to_calls": "out"},
+    }
+
+    def _get_closure_query(self, direction: str, max_depth: Optional[int]) -> str:
+        """
+        Build a recursive query for the transitive closure of a set of refs
+        and calls (given as a JSON list of `[kind, hid]` pairs) in the given
+        direction. The depth of a node is the number of calls traversed to
+        reach it from the starting nodes.
+        """
+        dirs = self._CLOSURE_DIRECTIONS[direction]
+        depth_step = "closure.depth + (closure.kind = 'ref')" if max_depth is not None else "0"
+        depth_filter = f"WHERE {depth_step} <= {int(max_depth)}" if max_depth is not None else ""
+        return f"""
+        WITH RECURSIVE closure(kind, hid, depth) AS (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), 0 FROM json_each(?)
+            UNION
+            SELECT
+                CASE closure.kind WHEN 'call' THEN 'ref' ELSE 'call' END,
+                CASE closure.kind WHEN 'call' THEN c.ref_history_id ELSE c.call_history_id END,
+                {depth_step}
+            FROM closure JOIN {self.table_name} AS c ON
+                (closure.kind = 'call' AND c.call_history_id = closure.hid AND c.direction = '{dirs["call_to_refs"]}')
+                OR (closure.kind = 'ref' AND c.ref_history_id = closure.hid AND c.direction = '{dirs["ref_to_calls"]}')
+            {depth_filter}
+        )
+        SELECT DISTINCT kind, hid FROM closure
+        """
+
+    def iter_closure(
+        self,
+        direction: Literal["dependents", "dependencies"],
+        ref_hids: Iterable[str],
+        call_hids: Iterable[str],
+        max_depth: Optional[int] = None,
+        batch_size: int = 10_000,
+        conn: Optional[sqlite3.Connection] = None,
+    ) -> Iterable[Tuple[str, str]]:
+        """
+        Stream the `(kind, hid)` pairs, where `kind` is "ref" or "call", of the
+        transitive closure of the given refs and calls, computed inside the
+        database. The starting refs and calls are included.
+        """
+        seeds = [["ref", hid] for hid in ref_hids] + [["call", hid] for hid in call_hids]
+        if conn is None:
+            conn = self.conn()
+        cursor = conn.execute(
+            self._get_closure_query(direction=direction, max_depth=max_depth),
+            (json.dumps(seeds),),
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def _get_closure(self, direction: str, ref_hids: Iterable[str],
+                     call_hids: Iterable[str], max_depth: Optional[int],
+                     conn: sqlite3.Connection) -> Tuple[Set[str], Set[str]]:
+        refs_result, calls_result = set(ref_hids), set(call_hids)
+        for kind, hid in self.iter_closure(direction=direction, ref_hids=refs_result,
+                                           call_hids=calls_result, max_depth=max_depth,
+                                           conn=conn):
+            (refs_result if kind == "ref" else calls_result).add(hid)
+        return refs_result, calls_result
+
     @transaction
     def get_dependencies(
         self,
         ref_hids: Iterable[str],
         call_hids: Iterable[str],
+        max_depth: Optional[int] = None,
         conn: Optional[sqlite3.Connection] = None,
     ) -> Tuple[Set[str], Set[str]]:
-        df = self.get_df(conn=conn)
-        x = InMemCallStorage(df)
-        return x.get_dependencies(ref_hids=ref_hids, call_hids=call_hids)
+        """
+        Return the hids of all refs and calls that the given refs and calls
+        depend on (including themselves), optionally going back at most
+        `max_depth` calls.
+        """
+        return self._get_closure("dependencies", ref_hids=ref_hids, call_hids=call_hids,
+                                 max_depth=max_depth, conn=conn)
 
     @transaction
     def get_dependents(
         self,
         ref_hids: Iterable[str],
         call_hids: Iterable[str],
+        max_depth: Optional[int] = None,
         conn: Optional[sqlite3.Connection] = None,
     ) -> Tuple[Set[str], Set[str]]:
-        df = self.get_df(conn=conn)
-        x = InMemCallStorage(df)
-        return x.get_dependents(ref_hids=ref_hids, call_hids=call_hids)
+        """
+        Return the hids of all refs and calls that depend on the given refs
+        and calls (including themselves), optionally going forward at most
+        `max_depth` calls.
+        """
+        return self._get_closure("dependents", ref_hids=ref_hids, call_hids=call_hids,
+                                 max_depth=max_depth, conn=conn)
 
 
 class CachedCallStorage:
@@ -713,38 +2225,124 @@ class CachedCallStorage:
     cache, and can commit new data to a persistent storage.
     """
 
-    def __init__(self, persistent: SQLiteCallStorage):
+    # rough size of a row of the in-memory table, in bytes
+    ROW_BYTES = 500
+
+    def __init__(self, persistent: SQLiteCallStorage,
+                 max_bytes: Optional[int] = None,
+                 policy: Union[str, EvictionPolicy] = "lru",
+                 ):
+        """
+        If `max_bytes` is given, committed calls are evicted from the cache
+        with the given eviction policy when the (estimated) size of the cache
+        goes over it. This happens on commit and on `load_df`.
+        """
         self.persistent = persistent
         self.cache = InMemCallStorage()
         self.dirty_hids: Set[str] = set()
+        self.max_bytes = max_bytes
+        self.policy = get_eviction_policy(policy) if max_bytes is not None else None
+        self.num_evictions = 0
+        self.evicted_bytes = 0
+        # history and content IDs known to be absent from the persistent
+        # storage, so that repeated lookups of new calls don't hit the DB.
+        # Cleared on commit/drop, when the persistent storage may change.
+        self.missing_hids: Set[str] = set()
+        self.missing_cids: Set[str] = set()
+        # optional filters of the history and content IDs in the persistent
+        # storage
+        self.hid_filter: Optional[BloomFilter] = None
+        self.cid_filter: Optional[BloomFilter] = None
 
     def save(self, call: Call):
         self.cache.save(call)
         self.dirty_hids.add(call.hid)
+        self.missing_hids.discard(call.hid)
+        self.missing_cids.discard(call.cid)
+        if self.policy is not None:
+            self.policy.add(call.hid, (len(call.inputs) + len(call.outputs)) * self.ROW_BYTES)
 
     def drop(self, hid: str):
         self.cache.drop(hid)
+        if self.policy is not None and hid in self.policy.sizes:
+            self.policy.remove(hid)
         if hid in self.dirty_hids:
             self.dirty_hids.remove(hid) # when we `drop`, we forget this key ever existed
+        self.clear_missing()
+
+    def load_df(self, df: pd.DataFrame):
+        """
+        Load the calls in a data frame with the columns of the table into the
+        cache.
+        """
+        self.cache.load_df(df)
+        if self.policy is not None:
+            for hid, positions in self.cache.rows_by_hid.items():
+                if hid not in self.policy.sizes:
+                    self.policy.add(hid, len(positions) * self.ROW_BYTES)
+            self.evict()
+
+    def estimated_size(self) -> int:
+        """
+        The estimated size of the calls in the cache, in bytes.
+        """
+        if self.policy is not None:
+            return self.policy.total_size
+        return sum(len(positions) for positions in self.cache.rows_by_hid.values()) * self.ROW_BYTES
+
+    def _touch(self, call_history_id: str):
+        if self.policy is not None and call_history_id in self.policy.sizes:
+            self.policy.touch(call_history_id)
+
+    def evict(self):
+        """
+        Evict committed calls until the cache is within its budget.
+        """
+        if self.policy is None or self.policy.total_size <= self.max_bytes:
+            return
+        victims = self.policy.select_victims(num_bytes=self.policy.total_size - self.max_bytes,
+                                             pinned=self.dirty_hids)
+        for hid in victims:
+            self.evicted_bytes += self.policy.sizes[hid]
+            self.policy.remove(hid)
+            self.cache.drop(hid)
+        self.num_evictions += len(victims)
+
+    def clear_missing(self):
+        """
+        Forget the negative lookup results.
+        """
+        self.missing_hids.clear()
+        self.missing_cids.clear()
 
     def exists(self, call_history_id: str) -> bool:
         if self.cache.exists(call_history_id):
+            self._touch(call_history_id)
             return True
+        elif self.hid_filter is not None and self.hid_filter.rules_out(call_history_id):
+            return False
         else:
             res = self.persistent.exists(call_history_id)
+            if not res and self.hid_filter is not None:
+                self.hid_filter.record_false_positive()
             return res
     
     def exists_content(self, cid: str) -> bool:
         if self.cache.exists_content(cid):
             return True
+        elif self.cid_filter is not None and self.cid_filter.rules_out(cid):
+            return False
         else:
-            res = self.persistent.exists_ref_hid(cid)
+            res = self.persistent.exists_content(cid)
+            if not res and self.cid_filter is not None:
+                self.cid_filter.record_false_positive()
             return res
 
     def get_data(
         self, call_history_id: str,
     ) -> Dict[str, Any]:
         if self.cache.exists(call_history_id):
+            self._touch(call_history_id)
             return self.cache.get_data(call_history_id)
         else:
             return self.persistent.get_data(call_history_id)
@@ -757,19 +2355,119 @@ class CachedCallStorage:
         else:
             return self.persistent.get_data_content(cid, conn)
 
+    def lookup(self, call_history_id: str, cid: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the data of the call with the given history_id if it exists, or
+        else of some call with the given content_id, or `None`. Makes at most
+        one query to the persistent storage, and none if both IDs are already
+        known to be missing from it.
+        """
+        if self.cache.exists(call_history_id):
+            self._touch(call_history_id)
+            return self.cache.get_data(call_history_id)
+        known_missing = call_history_id in self.missing_hids and cid in self.missing_cids
+        use_filters = not known_missing and self.hid_filter is not None and self.cid_filter is not None
+        if use_filters:
+            hid_ruled_out = self.hid_filter.rules_out(call_history_id)
+            cid_ruled_out = self.cid_filter.rules_out(cid)
+            known_missing = hid_ruled_out and cid_ruled_out
+        if not known_missing:
+            call_data = self.persistent.lookup(call_history_id, cid)
+            if call_data is not None:
+                return call_data
+            if use_filters:
+                if not hid_ruled_out:
+                    self.hid_filter.record_false_positive()
+                if not cid_ruled_out:
+                    self.cid_filter.record_false_positive()
+            self.missing_hids.add(call_history_id)
+            self.missing_cids.add(cid)
+        if self.cache.exists_content(cid):
+            return self.cache.get_data_content(cid)
+        return None
+
+    def mlookup(self, ids: List[Tuple[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Batched version of `lookup` for a list of (history_id, content_id)
+        pairs, making at most one query to the persistent storage (per batch
+        of 10,000 pairs).
+        """
+        res: List[Optional[Dict[str, Any]]] = [None] * len(ids)
+        to_query = []
+        for i, (hid, cid) in enumerate(ids):
+            if self.cache.exists(hid):
+                self._touch(hid)
+                res[i] = self.cache.get_data(hid)
+            elif hid in self.missing_hids and cid in self.missing_cids:
+                continue
+            elif (self.hid_filter is not None and self.cid_filter is not None
+                  and self.hid_filter.rules_out(hid) and self.cid_filter.rules_out(cid)):
+                self.missing_hids.add(hid)
+                self.missing_cids.add(cid)
+            else:
+                to_query.append(i)
+        if len(to_query) > 0:
+            found = self.persistent.mlookup([ids[i] for i in to_query])
+            for i, call_data in zip(to_query, found):
+                if call_data is not None:
+                    res[i] = call_data
+                else:
+                    hid, cid = ids[i]
+                    self.missing_hids.add(hid)
+                    self.missing_cids.add(cid)
+        for i, (hid, cid) in enumerate(ids):
+            if res[i] is None and self.cache.exists_content(cid):
+                res[i] = self.cache.get_data_content(cid)
+        return res
+
     def get_creator_hids(self, hids: Iterable[str]) -> Set[str]:
         raise NotImplementedError()
 
     def get_consumer_hids(self, hids: Iterable[str]) -> Set[str]:
         raise NotImplementedError()
 
-    def commit(self, conn: Optional[sqlite3.Connection] = None):
+    def dirty_data(self) -> List[Dict[str, Any]]:
+        """
+        Return a snapshot of the data of all dirty calls, without clearing them.
+        """
+        if len(self.dirty_hids) == 0:
+            return []
+        return self.cache.mget_data(call_hids=list(self.dirty_hids))
+
+    def write(self, call_datas: List[Dict[str, Any]],
+              conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Write a snapshot returned by `dirty_data()` to the persistent storage,
+        without touching the cache. Return the number of rows written.
+        """
         if conn is None:
             conn = self.persistent.conn()
-        # with conn:
-        for hid in self.dirty_hids:
-            self.persistent.save(self.cache.get_data(hid), conn=conn)
-        self.dirty_hids.clear()
+        if len(call_datas) == 0:
+            return 0
+        return self.persistent.msave(call_datas, conn=conn)
+
+    def mark_committed(self, call_datas: List[Dict[str, Any]]) -> None:
+        """
+        Mark the given calls as persisted.
+        """
+        hids = {call_data["hid"] for call_data in call_datas}
+        if self.hid_filter is not None:
+            self.hid_filter.update(hids)
+        if self.cid_filter is not None:
+            self.cid_filter.update({call_data["cid"] for call_data in call_datas})
+        self.dirty_hids.difference_update(hids)
+        self.clear_missing()
+        self.evict() # the committed calls can be evicted now
+
+    def commit(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        Persist all dirty calls in a single batch, and return the number of
+        rows written.
+        """
+        call_datas = self.dirty_data()
+        num_rows = self.write(call_datas, conn=conn)
+        self.mark_committed(call_datas)
+        return num_rows
     
     def clear(self, allow_uncommited: bool = False):
         if len(self.dirty_hids) > 0 and not allow_uncommited:
@@ -778,3 +2476,160 @@ class CachedCallStorage:
             raise ValueError(msg)
         self.cache = InMemCallStorage()
         self.dirty_hids.clear()
+        self.clear_missing()
+        if self.policy is not None:
+            self.policy.clear()
+
+
+class GarbageCollector:
+    """
+    Mark-and-sweep garbage collection of the refs in a storage, done with
+    anti-joins inside the database:
+    - the "orphaned" shapes are those whose hid is not an input/output of any
+    call;
+    - the "unreferenced" atoms (in the atoms table or the overflow storage)
+    are those whose cid is neither the cid of an input/output of any call, nor
+    the cid of a shape that will survive the sweep.
+
+    Deletions are done in batches of keys in sorted order, so a collection
+    can stop when it runs out of time, and the next one picks up where it left
+    off. Swept keys are also evicted from the given caches.
+    """
+    def __init__(self, db: DBAdapter, atoms: CachedDictStorage, shapes: CachedDictStorage,
+                 calls_table: str = "calls", objects: Optional[ObjectCache] = None):
+        self.db = db
+        self.atoms = atoms
+        self.shapes = shapes
+        self.objects = objects
+        self.calls_table = calls_table
+
+    @property
+    def overflow_storage(self) -> Optional["JoblibDictStorage"]:
+        return self.atoms.persistent.overflow_storage
+
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn()
+
+    def _orphans_query(self) -> str:
+        return (
+            f"SELECT s.key, length(s.value) FROM {self.shapes.persistent.table} AS s "
+            f"WHERE s.key > ? AND NOT EXISTS (SELECT 1 FROM {self.calls_table} AS c WHERE c.ref_history_id = s.key) "
+            "ORDER BY s.key LIMIT ?"
+        )
+
+    def _is_referenced_condition(self, cid_expr: str) -> str:
+        # whether the cid is used by a call, or by a shape that is connected
+        # to a call
+        return (
+            f"(EXISTS (SELECT 1 FROM {self.calls_table} AS c WHERE c.ref_content_id = {cid_expr}) "
+            f"OR EXISTS (SELECT 1 FROM shape_cids AS sc WHERE sc.cid = {cid_expr} "
+            f"AND EXISTS (SELECT 1 FROM {self.calls_table} AS c WHERE c.ref_history_id = sc.hid)))"
+        )
+
+    def _unreferenced_atoms_query(self) -> str:
+        return (
+            f"SELECT a.key, length(a.value) FROM {self.atoms.persistent.table} AS a "
+            f"WHERE a.key > ? AND NOT {self._is_referenced_condition('a.key')} "
+            "ORDER BY a.key LIMIT ?"
+        )
+
+    def iter_batches(self, query: str, batch_size: int, conn: sqlite3.Connection,
+                     ) -> Iterable[List[Tuple[str, int]]]:
+        """
+        Run a keyset-paginated query returning `(key, size)` rows.
+        """
+        last_key = ""
+        while True:
+            rows = conn.execute(query, (last_key, batch_size)).fetchall()
+            if not rows:
+                break
+            yield rows
+            last_key = rows[-1][0]
+
+    def _unreferenced_overflow_query(self) -> str:
+        return (
+            f"SELECT m.key, m.size FROM {self.overflow_storage.manifest_table} AS m "
+            f"WHERE m.key > ? AND NOT {self._is_referenced_condition('m.key')} "
+            "ORDER BY m.key LIMIT ?"
+        )
+
+    def iter_unreferenced_overflow(self, batch_size: int, conn: sqlite3.Connection,
+                                   ) -> Iterable[List[Tuple[str, int]]]:
+        if self.overflow_storage is None:
+            return
+        if self.overflow_storage.db is not None:
+            yield from self.iter_batches(self._unreferenced_overflow_query(), batch_size, conn)
+            return
+        keys = sorted(self.overflow_storage.keys())
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            rows = conn.execute(
+                f"SELECT value FROM json_each(?) WHERE NOT {self._is_referenced_condition('value')}",
+                (json.dumps(batch),),
+            ).fetchall()
+            yield [(row[0], self.overflow_storage.get_size(row[0])) for row in rows]
+
+    def collect(self, dry_run: bool = False, time_budget: Optional[float] = None,
+                batch_size: int = 1000) -> Dict[str, Any]:
+        """
+        Find (and unless `dry_run`, delete) the orphaned shapes and the
+        unreferenced atoms. Stop after `time_budget` seconds (checked between
+        batches) if given. Return a report of what was (or would be) deleted
+        and how many bytes this reclaims.
+        """
+        start = time.perf_counter()
+        report = {
+            "dry_run": dry_run,
+            "orphaned_shapes": 0,
+            "orphaned_shapes_bytes": 0,
+            "unreferenced_atoms": 0,
+            "unreferenced_atoms_bytes": 0,
+            "unreferenced_overflow": 0,
+            "unreferenced_overflow_bytes": 0,
+            "complete": True,
+        }
+        conn = self.conn()
+        phases = [
+            ("orphaned_shapes", lambda: self.iter_batches(self._orphans_query(), batch_size, conn), self._sweep_shapes),
+            ("unreferenced_atoms", lambda: self.iter_batches(self._unreferenced_atoms_query(), batch_size, conn), self._sweep_atoms),
+            ("unreferenced_overflow", lambda: self.iter_unreferenced_overflow(batch_size, conn), self._sweep_overflow),
+        ]
+        for name, batches, sweep in phases:
+            for batch in batches():
+                if not batch:
+                    continue
+                report[name] += len(batch)
+                report[f"{name}_bytes"] += sum(size for _, size in batch)
+                if not dry_run:
+                    sweep([key for key, _ in batch])
+                if time_budget is not None and time.perf_counter() - start > time_budget:
+                    report["complete"] = False
+                    break
+            if not report["complete"]:
+                break
+        report["reclaimable_bytes"] = sum(v for k, v in report.items() if k.endswith("_bytes"))
+        report["seconds"] = time.perf_counter() - start
+        return report
+
+    @transaction
+    def _sweep_shapes(self, hids: List[str], conn: Optional[sqlite3.Connection] = None):
+        params = [(hid,) for hid in hids]
+        conn.executemany(f"DELETE FROM {self.shapes.persistent.table} WHERE key = ?", params)
+        conn.executemany("DELETE FROM shape_cids WHERE hid = ?", params)
+        for hid in hids:
+            self.shapes.cache.pop(hid, None)
+
+    @transaction
+    def _sweep_atoms(self, cids: List[str], conn: Optional[sqlite3.Connection] = None):
+        conn.executemany(f"DELETE FROM {self.atoms.persistent.table} WHERE key = ?", [(cid,) for cid in cids])
+        for cid in cids:
+            self.atoms.cache.pop(cid, None)
+            if self.objects is not None:
+                self.objects.pop(cid)
+
+    def _sweep_overflow(self, cids: List[str]):
+        for cid in cids:
+            self.overflow_storage.drop(cid)
+            self.atoms.cache.pop(cid, None)
+            if self.objects is not None:
+                self.objects.pop(cid)
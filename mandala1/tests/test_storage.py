@@ -0,0 +1,1299 @@
+from mandala.imports import *
+from mandala.storage_utils import SchemaManager, MIGRATIONS, CODECS, encode_value, decode_value, BloomFilter, BoundedCache
+from mandala.config import Config
+from mandala.utils import hash_file, HashCache, HASH_VERSION_BLAKE2B, HASH_VERSION_XXH3, get_content_hash, serialize, deserialize, Serializer, register_serializer, SERIALIZERS_BY_TAG
+import sqlite3
+import pytest
+import struct
+import numpy as np
+import pandas as pd
+import joblib
+import io
+import os
+import sys
+import subprocess
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _index_names(db_path: str) -> set:
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='calls'").fetchall()
+    finally:
+        conn.close()
+    return {row[0] for row in rows}
+
+
+def test_schema_migrations(tmp_path):
+    db_path = str(tmp_path / "storage.db")
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    storage = Storage(db_path=db_path)
+    with storage:
+        for i in range(5):
+            inc(i)
+    assert storage.schema.get_version() == SchemaManager(db=storage.db).latest_version
+    assert "calls_call_content_id" in _index_names(db_path)
+
+    # simulate a database created before the schema was versioned
+    conn = sqlite3.connect(db_path)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'calls_%'").fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    conn.execute("DROP TABLE schema_version")
+    conn.commit()
+    conn.close()
+    assert "calls_call_content_id" not in _index_names(db_path)
+
+    # re-opening upgrades the database in place, without losing data
+    storage = Storage(db_path=db_path)
+    assert storage.schema.get_version() == max(m.version for m in MIGRATIONS)
+    assert {"calls_call_content_id", "calls_ref_history_id", "calls_ref_content_id", "calls_op"} <= _index_names(db_path)
+    assert len(storage.cf(inc).calls) == 5
+    # migrations are not re-applied
+    assert storage.schema.migrate() == []
+
+    # lookups by content ID don't scan the table
+    with storage.conn() as conn:
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT 1 FROM calls WHERE call_content_id = ? LIMIT 1", ("x",)
+        ).fetchall()
+    assert any("calls_call_content_id" in row[-1] for row in plan)
+
+
+def test_persistent_connections(tmp_path):
+    from mandala.storage_utils import DBAdapter
+    import threading
+
+    db = DBAdapter(db_path=str(tmp_path / "storage.db"), pragmas={"synchronous": "NORMAL"})
+    # the same connection is reused within a thread...
+    assert db.conn() is db.conn()
+    assert db.conn().execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert db.conn().execute("PRAGMA temp_store").fetchone()[0] == 2
+    # ...but each thread gets its own
+    other = []
+    t = threading.Thread(target=lambda: other.append(db.conn()))
+    t.start()
+    t.join()
+    assert other[0] is not db.conn()
+    db.close()
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    storage = Storage(db_path=str(tmp_path / "storage.db"))
+    with storage:
+        for i in range(5):
+            inc(i)
+    conn = storage.conn()
+    assert not conn.in_transaction
+    assert storage.call_storage.exists_content(storage.cf(inc).calls.popitem()[1].cid)
+    assert storage.conn() is conn
+    # closing is transparent
+    storage.close()
+    assert len(storage.cf(inc).calls) == 5
+
+
+def test_batched_commit(tmp_path):
+    db_path = str(tmp_path / "storage.db")
+
+    @op(output_names=["s", "d"])
+    def add(x: int, y: int):
+        return x + y, x - y
+
+    storage = Storage(db_path=db_path)
+    with storage:
+        for i in range(20):
+            add(i, 1)
+    stats = storage.last_commit_stats
+    assert stats["calls"] == 20 * 4 # 2 inputs and 2 outputs per call
+    assert stats["ops"] == 1
+    assert stats["rows_per_second"] > 0
+    assert len(storage.calls.dirty_hids) == 0 and len(storage.atoms.dirty_keys) == 0
+
+    # everything made it to the database
+    storage = Storage(db_path=db_path)
+    df = storage.cf(add).df()
+    assert len(df) == 20
+    assert (df['s'] == df['x'] + df['y']).all()
+    # committing with nothing new is a no-op
+    storage.commit()
+    assert storage.last_commit_stats["calls"] == 0
+
+
+def test_inmem_call_storage():
+    from mandala.storage_utils import InMemCallStorage
+
+    storage = Storage()
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    with storage:
+        ys = [inc(i) for i in range(10)]
+        zs = [inc(y) for y in ys]
+    calls = storage.cf(inc).calls
+    cache = InMemCallStorage()
+    for call in calls.values():
+        cache.save(call)
+        cache.save(call) # idempotent
+    assert len(cache) == 20
+    assert cache.df.shape == (40, 7)
+    call = storage.get_ref_creator(zs[0])
+    assert cache.exists(call.hid) and cache.exists_content(call.cid)
+    # `inc(1)` has the same content ID as `inc(inc(0))`
+    assert set(cache.hids_by_cid[call.cid]) == {call.hid, storage.get_ref_creator(ys[1]).hid}
+    assert cache.get_creator_hids([zs[0].hid]) == {call.hid}
+    assert cache.get_consumer_hids([ys[0].hid]) == {call.hid}
+    data = cache.get_data(call.hid)
+    assert data["input_hids"] == {"x": ys[0].hid}
+    assert data["output_hids"] == {"output_0": zs[0].hid}
+    # the first call has the second one as a dependent and vice versa
+    first = storage.get_ref_creator(ys[0])
+    assert cache.get_dependents(ref_hids=[], call_hids=[first.hid])[1] == {first.hid, call.hid}
+    assert cache.get_dependencies(ref_hids=[zs[0].hid], call_hids=[])[1] == {first.hid, call.hid}
+
+    # round trip through a DataFrame
+    other = InMemCallStorage(cache.df)
+    assert other.mget_data([call.hid]) == cache.mget_data([call.hid])
+
+    # dropping removes the call from all indexes, and eventually compacts
+    cache.drop(call.hid)
+    assert not cache.exists(call.hid)
+    assert cache.get_data_content(call.cid)["hid"] == storage.get_ref_creator(ys[1]).hid
+    assert cache.get_creator_hids([zs[0].hid]) == set()
+    assert cache.df.shape == (38, 7)
+    for hid in list(cache.call_hids)[:12]:
+        cache.drop(hid)
+    assert len(cache) == 7
+    # dead rows were compacted away at some point
+    assert len(cache.alive) < 40 and sum(cache.alive) == 14
+    assert cache.df.shape == (14, 7)
+
+
+def test_provenance_closure():
+    from mandala.storage_utils import InMemCallStorage
+
+    storage = Storage()
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    @op
+    def add(x: int, y: int) -> int:
+        return x + y
+
+    with storage:
+        chain = [inc(0)]
+        for _ in range(5):
+            chain.append(inc(chain[-1]))
+        total = add(chain[2], chain[-1])
+        other = inc(100)
+
+    creators = [storage.get_ref_creator(ref).hid for ref in chain]
+    total_creator = storage.get_ref_creator(total).hid
+    reference = InMemCallStorage(storage.call_storage.get_df())
+    for method in ("get_dependents", "get_dependencies"):
+        for start in ([creators[0]], [creators[3]], [total_creator]):
+            kwargs = dict(ref_hids=[], call_hids=start)
+            assert getattr(storage.call_storage, method)(**kwargs) == getattr(reference, method)(**kwargs)
+    refs, calls = storage.call_storage.get_dependents(ref_hids=[chain[2].hid], call_hids=[])
+    assert calls == set(creators[3:]) | {total_creator}
+
+    # depth limits count the calls traversed
+    _, calls = storage.call_storage.get_dependents(ref_hids=[], call_hids=[creators[0]], max_depth=0)
+    assert calls == {creators[0]}
+    _, calls = storage.call_storage.get_dependents(ref_hids=[], call_hids=[creators[0]], max_depth=2)
+    assert calls == set(creators[:3])
+    _, calls = storage.call_storage.get_dependencies(ref_hids=[total.hid], call_hids=[], max_depth=1)
+    assert calls == {total_creator}
+
+    # results can be streamed
+    kinds = {kind for kind, _ in storage.call_storage.iter_closure(
+        "dependents", ref_hids=[], call_hids=[creators[0]], batch_size=2)}
+    assert kinds == {"ref", "call"}
+
+    # cascading deletes
+    storage.drop_calls([creators[3]], delete_dependents=True)
+    assert len(storage.cf(inc).calls) == 4
+    assert len(storage.cf(add).calls) == 0
+    assert storage.call_storage.exists(storage.get_ref_creator(other).hid)
+
+
+def test_gc(tmp_path):
+    db_path = str(tmp_path / "storage.db")
+    storage = Storage(db_path=db_path, overflow_dir=str(tmp_path / "overflow"), overflow_threshold_MB=0.01)
+
+    @op
+    def make_array(n: int) -> np.ndarray:
+        return np.arange(n, dtype=np.float64)
+
+    @op
+    def total(x: np.ndarray) -> float:
+        return float(x.sum())
+
+    with storage:
+        small = [make_array(i) for i in range(10)]
+        big = make_array(10_000) # goes to the overflow storage
+        sums = [total(x) for x in small]
+    assert len(storage.overflow_storage.keys()) == 1
+    assert storage.get_orphans() == set() and storage.get_unreferenced_cids() == set()
+
+    storage.drop_calls([storage.get_ref_creator(ref) for ref in small[5:] + [big]], delete_dependents=True)
+    # the shapes of the dropped refs are orphaned, but their atoms are still
+    # referenced by the orphaned shapes
+    assert len(storage.get_orphans()) > 0
+    report = storage.gc(dry_run=True)
+    assert report["orphaned_shapes"] == len(storage.get_orphans())
+    assert report["unreferenced_atoms"] > 0 and report["unreferenced_overflow"] == 1
+    assert report["reclaimable_bytes"] > 10_000 * 8
+    # nothing was deleted
+    assert len(storage.get_orphans()) == report["orphaned_shapes"]
+
+    # an interrupted collection is resumed by the next one
+    partial = storage.gc(time_budget=0, batch_size=1)
+    assert not partial["complete"] and partial["orphaned_shapes"] == 1
+    full = storage.gc()
+    assert full["complete"]
+    assert storage.get_orphans() == set() and storage.get_unreferenced_cids() == set()
+    assert storage.overflow_storage.keys() == []
+    assert storage.gc(dry_run=True)["reclaimable_bytes"] == 0
+
+    # the surviving calls are intact
+    storage = Storage(db_path=db_path, overflow_dir=str(tmp_path / "overflow"))
+    df = storage.cf(total).expand_back().df()
+    assert len(df) == 5
+    assert sorted(df["var_0"]) == [float(sum(range(i))) for i in range(5)]
+
+    # the cids of shapes are backfilled for databases created before they were tracked
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM shape_cids")
+    conn.execute("DELETE FROM schema_version WHERE version >= 2")
+    conn.commit()
+    conn.close()
+    storage = Storage(db_path=db_path)
+    with storage.conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM shape_cids").fetchone()[0] == len(storage.shapes.persistent.keys())
+
+
+def test_codecs(tmp_path):
+    data = serialize(np.zeros(10_000))
+    for name, codec in CODECS.items():
+        encoded = encode_value(data, codec=name)
+        assert decode_value(encoded) == data
+        if codec.tag is not None:
+            assert encoded[0] == codec.tag and len(encoded) < len(data)
+    # small and incompressible values are stored as they are
+    assert encode_value(data, codec="zlib", min_bytes=len(data) + 1) == data
+    noise = serialize(np.random.default_rng(0).bytes(10_000))
+    assert encode_value(noise, codec="zlib") == noise
+    with pytest.raises(ValueError):
+        encode_value(data, codec="nonexistent")
+
+    db_path = str(tmp_path / "storage.db")
+
+    @op
+    def zeros(n: int) -> np.ndarray:
+        return np.zeros(n)
+
+    @op(codec="lzma")
+    def ones(n: int) -> np.ndarray:
+        return np.ones(n)
+
+    # rows written without a codec are still readable after switching codecs
+    storage = Storage(db_path=db_path)
+    with storage:
+        z = zeros(10_000)
+    storage = Storage(db_path=db_path, codec="zlib")
+    with storage:
+        z_again = zeros(10_000)
+        z_new = zeros(20_000)
+        o = ones(10_000)
+        tiny = zeros(1)
+
+    def header(cid: str) -> int:
+        with storage.conn() as conn:
+            return conn.execute("SELECT value FROM atoms WHERE key = ?", (cid,)).fetchone()[0][0]
+
+    assert header(z.cid) >= 0x80 # uncompressed
+    assert header(z_new.cid) == CODECS["zlib"].tag
+    assert header(o.cid) == CODECS["lzma"].tag
+    assert header(tiny.cid) >= 0x80
+
+    storage = Storage(db_path=db_path)
+    for ref, n in ((z, 10_000), (z_new, 20_000), (tiny, 1)):
+        assert np.array_equal(storage.unwrap(storage.load_ref(ref.hid, in_memory=False)), np.zeros(n))
+    assert np.array_equal(storage.unwrap(storage.load_ref(o.hid, in_memory=False)), np.ones(10_000))
+
+    # values in the overflow storage are compressed by joblib
+    @op
+    def digits(n: int) -> np.ndarray:
+        return np.random.default_rng(0).integers(0, 10, size=n).astype(np.float64)
+
+    storage = Storage(db_path=str(tmp_path / "overflow.db"), overflow_dir=str(tmp_path / "overflow"),
+                      overflow_threshold_MB=0.01, codec="zlib")
+    with storage:
+        big = digits(100_000)
+    assert storage.overflow_storage.get_size(big.cid) < 8 * 100_000 / 2
+    storage = Storage(db_path=str(tmp_path / "overflow.db"), overflow_dir=str(tmp_path / "overflow"))
+    assert np.array_equal(storage.unwrap(storage.load_ref(big.hid, in_memory=False)), digits.f(100_000))
+
+
+class _Point:
+    def __init__(self, x: int, y: int):
+        self.x, self.y = x, y
+
+
+def test_serializers(tmp_path):
+    values = [None, True, 0, -2**70, 2.5, "héllo", b"\x00\x01", (1, "a"), {"a": [1, 2]},
+              np.arange(12).reshape(3, 4), np.arange(12).reshape(3, 4).T, np.arange(10)[::3],
+              np.zeros(2, dtype=[("a", "<i4"), ("b", "<f8", (2,))]), np.array([1, "a"], dtype=object),
+              np.float32(1.5), pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})]
+    for value in values:
+        data = serialize(value)
+        assert data[0] in SERIALIZERS_BY_TAG
+        res = deserialize(data)
+        assert type(res) == type(value)
+        if isinstance(value, np.ndarray):
+            assert res.dtype == value.dtype and res.flags.writeable
+            assert np.array_equal(res, value) if value.dtype != object else list(res) == list(value)
+        elif isinstance(value, pd.DataFrame):
+            assert res.equals(value)
+        else:
+            assert res == value
+    assert serialize(np.arange(3))[0] == SERIALIZERS_BY_TAG[0x96].tag
+    assert serialize(np.array([None]))[0] == 0x81 # object arrays are pickled
+
+    # user types
+    register_serializer(Serializer(
+        "point", 0xc0, (_Point,),
+        encode=lambda p: struct.pack("<qq", p.x, p.y),
+        decode=lambda data: _Point(*struct.unpack("<qq", data)),
+    ))
+    data = serialize(_Point(1, 2))
+    assert data[0] == 0xc0 and len(data) == 17
+    assert vars(deserialize(data)) == {"x": 1, "y": 2}
+    with pytest.raises(ValueError):
+        register_serializer(Serializer("other", 0xc0, (), serialize, deserialize))
+    with pytest.raises(ValueError):
+        register_serializer(Serializer("other", 0x20, (), serialize, deserialize))
+
+    # values serialized with joblib are still readable
+    def joblib_dumps(obj) -> bytes:
+        buffer = io.BytesIO()
+        joblib.dump(obj, buffer)
+        return buffer.getvalue()
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    db_path = str(tmp_path / "storage.db")
+    storage = Storage(db_path=db_path)
+    with storage:
+        y = inc(23)
+    with storage.conn() as conn:
+        conn.execute("UPDATE atoms SET value = ? WHERE key = ?", (joblib_dumps(joblib_dumps(24)), y.cid))
+    storage = Storage(db_path=db_path)
+    assert storage.unwrap(storage.load_ref(y.hid, in_memory=False)) == 24
+    with storage:
+        assert storage.unwrap(inc(23)) == 24
+
+
+def test_overflow_mmap(tmp_path):
+    db_path, overflow_dir = str(tmp_path / "storage.db"), str(tmp_path / "overflow")
+
+    @op
+    def arange(n: int) -> np.ndarray:
+        return np.arange(n, dtype=np.float64)
+
+    @op
+    def total(x: np.ndarray) -> float:
+        return float(x.sum())
+
+    storage = Storage(db_path=db_path, overflow_dir=overflow_dir, overflow_threshold_MB=0.01)
+    with storage:
+        big = arange(100_000)
+        small = arange(10)
+        s = total(big)
+    # legacy overflow values are serialized objects rather than arrays
+    legacy = np.ones(100_000)
+    storage.overflow_storage.set("legacy", serialize(legacy))
+
+    storage = Storage(db_path=db_path, overflow_dir=overflow_dir, overflow_mmap="r")
+    x = storage.unwrap(storage.load_ref(big.hid, in_memory=False))
+    assert isinstance(x, np.memmap) and not x.flags.writeable
+    assert np.array_equal(x, np.arange(100_000))
+    assert big.cid not in storage.atoms.cache and len(storage.atoms.dirty_keys) == 0
+    # atoms stored in the database are loaded as usual
+    y = storage.unwrap(storage.load_ref(small.hid, in_memory=False))
+    assert not isinstance(y, np.memmap) and np.array_equal(y, np.arange(10))
+    assert np.array_equal(storage._load_atom("legacy"), legacy)
+    # memory maps hash like the arrays they map, and can be passed to ops
+    assert get_content_hash(x) == big.cid
+    with storage:
+        assert storage.unwrap(total(storage.load_ref(big.hid, in_memory=False))) == storage.unwrap(s)
+    assert len(storage.cf(total).df()) == 1
+
+    # without memory mapping, overflow arrays are read into memory
+    storage = Storage(db_path=db_path, overflow_dir=overflow_dir)
+    x = storage.unwrap(storage.load_ref(big.hid, in_memory=False))
+    assert not isinstance(x, np.memmap) and np.array_equal(x, np.arange(100_000))
+    assert np.array_equal(deserialize(storage.atoms["legacy"]), legacy)
+
+
+def test_overflow_layout(tmp_path, monkeypatch):
+    db_path, overflow_dir = str(tmp_path / "storage.db"), str(tmp_path / "overflow")
+
+    @op
+    def arange(n: int) -> np.ndarray:
+        return np.arange(n, dtype=np.float64)
+
+    # files in the flat layout of earlier versions are moved into shards
+    flat_values = {f"{i:02d}" + "ab" * 15: np.full(10, i) for i in range(3)}
+    os.makedirs(overflow_dir)
+    for key, value in flat_values.items():
+        joblib.dump(serialize(value), os.path.join(overflow_dir, f"{key}.joblib"))
+
+    storage = Storage(db_path=db_path, overflow_dir=overflow_dir, overflow_threshold_MB=0.01)
+    with storage:
+        refs = [arange(10_000 + i) for i in range(3)]
+    overflow = storage.overflow_storage
+    assert not any(f.endswith(".joblib") for f in os.listdir(overflow_dir))
+    assert sorted(overflow.keys()) == sorted(list(flat_values) + [ref.cid for ref in refs])
+    for key, value in flat_values.items():
+        assert np.array_equal(deserialize(storage.atoms[key]), value)
+    for ref in refs:
+        path = overflow.get_path_for_key(ref.cid)
+        assert path == os.path.join(overflow_dir, ref.cid[:2], ref.cid[2:4], f"{ref.cid}.joblib")
+        assert overflow.get_size(ref.cid) == os.path.getsize(path)
+    # no temporary files are left behind
+    assert not any(f.endswith(".tmp") for _, _, files in os.walk(overflow_dir) for f in files)
+
+    # `exists`, `keys` and `get_size` are served from the manifest
+    os.remove(overflow.get_path_for_key(refs[0].cid))
+    assert overflow.exists(refs[0].cid)
+    assert overflow.rebuild_manifest() == {"added": 0, "removed": 1}
+    assert not overflow.exists(refs[0].cid)
+    with storage.conn() as conn:
+        conn.execute(f"DELETE FROM {overflow.manifest_table}")
+    assert overflow.keys() == []
+    # a manifest that is empty while there are files on disk is rebuilt
+    storage = Storage(db_path=db_path, overflow_dir=overflow_dir)
+    assert sorted(storage.overflow_storage.keys()) == sorted(list(flat_values) + [ref.cid for ref in refs[1:]])
+    assert np.array_equal(storage.unwrap(storage.load_ref(refs[1].hid, in_memory=False)), np.arange(10_001))
+
+    # files moved by another process migrating at the same time are skipped
+    raced, kept = "98" + "cd" * 15, "99" + "cd" * 15
+    for key in (raced, kept):
+        joblib.dump(serialize(key), os.path.join(overflow_dir, f"{key}.joblib"))
+    replace = os.replace
+    def racing_replace(src, dst):
+        if os.path.basename(src) == f"{raced}.joblib":
+            replace(src, dst) # the other process wins
+        replace(src, dst)
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", racing_replace)
+        assert storage.overflow_storage.migrate_flat_layout() == 1
+    storage.overflow_storage.rebuild_manifest()
+    assert {raced, kept} <= set(storage.overflow_storage.keys())
+
+
+def test_content_hashing(tmp_path):
+    def h(obj):
+        return get_content_hash(obj, version=HASH_VERSION_BLAKE2B)
+
+    # distinct values of different types hash differently
+    values = [None, True, 1, 1.0, "1", b"1", [1], (1,), {1}, {1: 1}, np.array([1]), np.array([1.0]),
+              np.array([[1]]), pd.DataFrame({"a": [1]}), pd.DataFrame({"b": [1]}), ["a", "bc"], ["ab", "c"]]
+    assert len({h(v) for v in values}) == len(values)
+    # hashes don't depend on insertion order or memory layout
+    assert h({"a": 1, "b": 2}) == h({"b": 2, "a": 1})
+    assert h({3, 1, 2}) == h({1, 2, 3})
+    arr = np.arange(12).reshape(3, 4)
+    assert h(arr) == h(np.asfortranarray(arr)) == h(arr.T.copy().T)
+    assert h(arr[:, ::2]) == h(arr[:, ::2].copy())
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"], "c": pd.Categorical(["u", "v"])})
+    assert h(df) == h(df.copy())
+    assert h(df) != h(df[["b", "a", "c"]]) and h(df) != h(df.iloc[::-1])
+    # the legacy hash is unchanged
+    assert get_content_hash((1, "a")) == joblib.hash((1, "a"))
+    if not Config.has_xxhash:
+        with pytest.raises(ValueError):
+            get_content_hash(1, version=HASH_VERSION_XXH3)
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    db_path = str(tmp_path / "storage.db")
+    storage = Storage(db_path=db_path, hash_version=HASH_VERSION_BLAKE2B)
+    with storage:
+        y = inc(23)
+    assert y.cid == h(24)
+    # the version is recorded in the storage
+    storage = Storage(db_path=db_path)
+    assert storage.hash_version == HASH_VERSION_BLAKE2B
+    with storage:
+        y_again = inc(23)
+    assert y_again.hid == y.hid and len(storage.cf(inc).df()) == 1
+    with pytest.raises(ValueError):
+        Storage(db_path=db_path, hash_version=0)
+    # the storage hashes with its version outside of a block too
+    assert storage.call(inc, (23,), {}).hid == y.hid
+    with storage.hashing():
+        inputs = {"x": wrap_atom(23)}
+    assert inputs["x"].cid != wrap_atom(23).cid
+    assert storage.lookup_call(inc, inputs).hid == storage.get_creators([y.hid])[0].hid
+
+    # storages with calls from before the version was recorded use joblib
+    legacy_path = str(tmp_path / "legacy.db")
+    storage = Storage(db_path=legacy_path)
+    with storage:
+        inc(23)
+    with storage.conn() as conn:
+        conn.execute("DELETE FROM meta")
+    with pytest.raises(ValueError):
+        Storage(db_path=legacy_path, hash_version=HASH_VERSION_BLAKE2B)
+    assert Storage(db_path=legacy_path).hash_version == 0
+
+
+class _Dataset:
+    def __init__(self, data: list, version: int = 0):
+        self.data = data
+        self.__mandala_version__ = version
+
+    def __get_mandala_dict__(self) -> dict:
+        return {"data": self.data}
+
+
+def test_hash_cache(tmp_path):
+    num_hashed = 0
+
+    def hasher(obj) -> str:
+        nonlocal num_hashed
+        num_hashed += 1
+        return get_content_hash(obj)
+
+    cache = HashCache(verify="frozen")
+    frozen = np.arange(1000)
+    frozen.flags.writeable = False
+    writeable = np.arange(1000)
+    for _ in range(3):
+        assert cache.get(frozen, hasher) == get_content_hash(frozen)
+        assert cache.get(writeable, hasher) == get_content_hash(writeable)
+        assert cache.get([1, 2], hasher) == get_content_hash([1, 2])
+    assert num_hashed == 1 + 3 + 3
+    assert cache.stats()["hits"] == 2 and cache.stats()["uncacheable"] == 6
+    # read-only views of writeable memory are not safe to cache
+    view = writeable[:]
+    view.flags.writeable = False
+    cache.get(view, hasher)
+    assert cache.stats()["uncacheable"] == 7
+    # entries go away with their objects
+    del frozen
+    assert cache.stats()["entries"] == 0
+
+    # a version marker
+    ds = _Dataset([1, 2, 3])
+    h = cache.get(ds, hasher)
+    assert cache.get(ds, hasher) == h
+    ds.data.append(4)
+    ds.__mandala_version__ += 1
+    assert cache.get(ds, hasher) == get_content_hash(ds) != h
+
+    # verification by sampling
+    cache = HashCache(verify="sample")
+    num_hashed = 0
+    arr = np.zeros(10_000)
+    df = pd.DataFrame({"a": np.arange(100), "b": ["x"] * 100})
+    for _ in range(3):
+        cache.get(arr, hasher)
+        cache.get(df, hasher)
+    assert num_hashed == 2
+    arr[0] = 1
+    df.loc[99, "b"] = "y"
+    assert cache.get(arr, hasher) == get_content_hash(arr)
+    assert cache.get(df, hasher) == get_content_hash(df)
+    assert num_hashed == 4
+
+    # in a storage
+    @op
+    def total(x: np.ndarray) -> float:
+        return float(x.sum())
+
+    storage = Storage(hash_cache="frozen")
+    data = np.arange(100_000, dtype=np.float64)
+    data.flags.writeable = False
+    with storage:
+        results = [total(data) for _ in range(10)]
+    assert len({r.hid for r in results}) == 1
+    stats = storage.hash_cache.stats()
+    assert stats["hits"] == 9 and stats["misses"] == 1
+
+
+def test_file_pointer(tmp_path, monkeypatch):
+    path = tmp_path / "data.npy"
+    np.save(path, np.arange(1000))
+    # the hash only depends on the contents of the file
+    other = tmp_path / "other.npy"
+    np.save(other, np.arange(1000))
+    assert hash_file(path) == hash_file(other)
+    assert hash_file(path, chunk_size=100, max_workers=4) == hash_file(path, chunk_size=100, max_workers=1)
+
+    num_hashed = 0
+    def counting_hash_file(p):
+        nonlocal num_hashed
+        num_hashed += 1
+        return hash_file(p)
+    monkeypatch.setattr("mandala.storage.hash_file", counting_hash_file)
+    monkeypatch.setattr("mandala.model.hash_file", counting_hash_file)
+
+    num_calls = 0
+    @op
+    def load_total(path) -> int:
+        nonlocal num_calls
+        num_calls += 1
+        return int(np.load(path).sum())
+
+    db_path = str(tmp_path / "storage.db")
+    storage = Storage(db_path=db_path)
+    with storage:
+        total = load_total(FilePointer(path))
+    assert storage.unwrap(total) == sum(range(1000)) and num_calls == 1 and num_hashed == 1
+    # the file is not re-read by later sessions while it is unchanged
+    storage = Storage(db_path=db_path)
+    with storage:
+        load_total(FilePointer(str(path)))
+        load_total(FilePointer(other)) # same contents
+    assert num_calls == 1 and num_hashed == 2
+    with storage.conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0] == 2
+    # the stored input is the path
+    call = storage.get_ref_creator(total)
+    assert storage.unwrap(call.inputs["path"]).path == path
+
+    # changed files are re-hashed
+    np.save(path, np.arange(10))
+    with storage:
+        new_total = load_total(FilePointer(path))
+    assert storage.unwrap(new_total) == sum(range(10)) and num_calls == 2 and num_hashed == 3
+    # the storage's cached hashes are used outside of a block too
+    res = storage.map(load_total, [{"path": FilePointer(path)}], executor="thread")
+    assert res[0].hid == new_total.hid and num_calls == 2 and num_hashed == 3
+
+
+def test_call_plan(tmp_path):
+    @op
+    def f(x: int, *args, y: int = NewArgDefault(1), **kwargs) -> int:
+        return x + sum(args) + y + sum(kwargs.values())
+
+    storage = Storage(db_path=str(tmp_path / "calls.db"))
+    with storage:
+        a = f(1, 2, 3, z=4)
+        b = f(1, y=1)
+    plan = f.call_plan
+    # the plan is compiled once and reused by later calls
+    assert f.call_plan is plan
+    assert plan.var_positional.name == "args" and plan.var_keyword.name == "kwargs"
+    assert set(storage.get_defaults(f)) == {"y"}
+    assert storage.unwrap(a) == 11 and storage.unwrap(b) == 2
+    # the new arg default is ignored for hashing
+    with storage:
+        assert f(1).hid == b.hid
+    # the plan is not pickled with the op
+    assert "_call_plan" not in f.__getstate__()
+
+
+def test_call_lookup(tmp_path, monkeypatch):
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    storage = Storage(db_path=str(tmp_path / "calls.db"))
+    num_queries = 0
+    lookup = storage.call_storage.lookup
+    def counting_lookup(*args, **kwargs):
+        nonlocal num_queries
+        num_queries += 1
+        return lookup(*args, **kwargs)
+    monkeypatch.setattr(storage.call_storage, "lookup", counting_lookup)
+
+    # each new call makes a single query
+    with storage:
+        ys = [inc(i) for i in range(5)]
+    assert num_queries == 5
+    call = storage.get_ref_creator(ys[0])
+    storage.clear_cache()
+    assert storage.calls.exists_content(call.cid)
+    # hits by history ID and by content ID
+    assert storage.calls.lookup(call.hid, call.cid)["hid"] == call.hid
+    assert storage.calls.lookup("missing", call.cid)["cid"] == call.cid
+
+    # negative results are cached until the next commit
+    num_queries = 0
+    assert storage.calls.lookup("missing", "missing") is None
+    assert storage.calls.lookup("missing", "missing") is None
+    assert num_queries == 1
+    storage.commit()
+    assert storage.calls.lookup("missing", "missing") is None
+    assert num_queries == 2
+    # as does dropping calls
+    storage.calls.lookup("missing", "missing")
+    storage.drop_calls([call.hid], delete_dependents=False)
+    assert len(storage.calls.missing_hids) == 0
+
+
+def test_bloom_filter(tmp_path, monkeypatch):
+    bloom = BloomFilter(capacity=10_000, fp_rate=0.01)
+    bloom.update(f"key_{i}" for i in range(10_000))
+    assert all(f"key_{i}" in bloom for i in range(10_000))
+    num_fps = sum(f"other_{i}" in bloom for i in range(10_000))
+    assert num_fps < 300 and bloom.expected_fp_rate == pytest.approx(0.01, rel=0.2)
+
+    num_calls = 0
+    @op
+    def inc(x: int) -> int:
+        nonlocal num_calls
+        num_calls += 1
+        return x + 1
+
+    db_path = str(tmp_path / "calls.db")
+    storage = Storage(db_path=db_path, bloom_filter=True)
+    with storage:
+        for i in range(10):
+            inc(i)
+    with storage.conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM bloom_filters").fetchone()[0] == 3
+
+    # new calls don't query the database, and old calls are still found
+    storage = Storage(db_path=db_path, bloom_filter=True)
+    assert storage.filters["call_hids"].num_items == 10
+    num_queries = 0
+    lookup = storage.call_storage.lookup
+    def counting_lookup(*args, **kwargs):
+        nonlocal num_queries
+        num_queries += 1
+        return lookup(*args, **kwargs)
+    monkeypatch.setattr(storage.call_storage, "lookup", counting_lookup)
+    with storage:
+        for i in range(20):
+            inc(i)
+    assert num_calls == 20 and num_queries == 10
+    storage.cache_info()
+    assert Storage(**storage.dump_config()).filters is not None
+
+    # commits from a storage without filters are picked up
+    other = Storage(db_path=db_path)
+    with other:
+        inc(100)
+    storage.clear_cache()
+    with storage:
+        inc(100)
+    assert num_calls == 21
+
+
+def test_prefetch_refs(tmp_path):
+    @op
+    def make_list(x: int) -> MList[int]:
+        return [x + i for i in range(3)]
+
+    db_path = str(tmp_path / "calls.db")
+    storage = Storage(db_path=db_path)
+    with storage:
+        lsts = [make_list(i) for i in range(50)]
+    hids = [storage.get_ref_creator(lst).hid for lst in lsts]
+
+    storage = Storage(db_path=db_path)
+    queries = []
+    storage.conn().set_trace_callback(queries.append)
+    calls = storage.mget_call(hids, in_memory=False)
+    # a constant number of queries, independent of the number of calls
+    assert len(queries) < 20
+    assert [storage.unwrap(call.outputs["output_0"]) for call in calls] == [[i, i + 1, i + 2] for i in range(50)]
+    # the elements of a loaded list are loaded too
+    lst = storage.load_ref(lsts[3].hid, in_memory=False)
+    assert all(elt.in_memory for elt in lst.obj) and [elt.obj for elt in lst.obj] == [3, 4, 5]
+    # missing keys are skipped
+    storage.prefetch_refs(["missing"], in_memory=False)
+    with pytest.raises(KeyError):
+        storage.load_ref("missing")
+
+
+def test_bounded_caches(tmp_path):
+    # eviction order of the policies
+    for policy, expected in [("lru", "a"), ("lfu", "b"), ("gdsf", "c")]:
+        cache = BoundedCache(max_bytes=250, policy=policy, pinned={"d"}, sizeof=len)
+        cache["a"] = "x" * 20
+        cache["a"], cache["a"], cache["a"] # used often, but long ago
+        cache["c"] = "x" * 200
+        cache["c"] # large
+        cache["b"] = "x" * 20 # used once, recently
+        cache["d"] = "x" * 20 # over budget by 10
+        assert set(cache) == {"a", "b", "c", "d"} - {expected}, policy
+        assert cache.num_evictions == 1 and cache.size <= 250
+    # pinned keys are never evicted
+    pinned = {"a", "b"}
+    cache = BoundedCache(max_bytes=10, pinned=pinned, sizeof=len)
+    cache["a"], cache["b"], cache["c"] = "x" * 10, "x" * 10, "x" * 10
+    assert set(cache) == {"a", "b"}
+    pinned.clear()
+    cache.evict()
+    assert len(cache) == 1
+
+    @op
+    def make_array(x: int) -> np.ndarray:
+        return np.full(1000, x, dtype=np.float64)
+
+    limits = {"atoms": 50_000, "shapes": 20_000, "calls": 10_000}
+    storage = Storage(db_path=str(tmp_path / "calls.db"), cache_limits=limits, eviction_policy="gdsf")
+    with storage:
+        arrays = [make_array(i) for i in range(50)]
+        # nothing is evicted before the commit
+        assert len(storage.atoms.cache) == 100 and len(storage.calls.cache) == 50
+    assert storage.atoms.estimated_size() <= limits["atoms"]
+    assert storage.shapes.estimated_size() <= limits["shapes"]
+    assert storage.calls.estimated_size() <= limits["calls"]
+    assert storage.atoms.cache.num_evictions > 0 and storage.calls.num_evictions > 0
+    # evicted values are loaded again on demand
+    with storage:
+        assert all(storage.unwrap(make_array(i))[0] == i for i in range(50))
+    storage.preload(lazy=False)
+    assert storage.atoms.estimated_size() <= limits["atoms"]
+    storage.cache_info()
+    rebuilt = Storage(**storage.dump_config())
+    assert rebuilt.atoms.cache.max_bytes == limits["atoms"] and rebuilt.eviction_policy == "gdsf"
+    with pytest.raises(ValueError):
+        Storage(cache_limits={"ops": 1000})
+
+
+def test_object_cache(tmp_path):
+    @op
+    def make_array(x: int) -> np.ndarray:
+        return np.full(1000, x, dtype=np.float64)
+
+    db_path = str(tmp_path / "calls.db")
+    storage = Storage(db_path=db_path)
+    with storage:
+        arrays = [make_array(i) for i in range(5)]
+
+    for mode in ("copy", "readonly", "shared"):
+        storage = Storage(db_path=db_path, object_cache=10 ** 6, object_cache_mode=mode)
+        ref = storage.load_ref(arrays[0].hid, in_memory=True)
+        first, second = storage.unwrap(ref), storage.unwrap(ref)
+        assert (first == second).all() and storage.objects.hits == 1 and storage.objects.misses == 1
+        if mode == "copy":
+            first[0] = -1
+            assert storage.unwrap(ref)[0] == 0 and first is not second
+        elif mode == "readonly":
+            assert first is second and not first.flags.writeable
+            with pytest.raises(ValueError):
+                first[0] = -1
+        else:
+            assert first is second
+        # the serialized value is not kept in addition to the object
+        assert ref.cid not in storage.atoms.cache
+        # unwrapping without caching doesn't touch the caches
+        other = storage.load_ref(arrays[1].hid, in_memory=True)
+        storage.unwrap(other, cache=False)
+        assert other.cid not in storage.objects and other.cid not in storage.atoms.cache
+        rebuilt = Storage(**storage.dump_config())
+        assert rebuilt.objects.cache.max_bytes == 10 ** 6 and rebuilt.objects.mode == mode
+    storage.cache_info()
+    with pytest.raises(ValueError):
+        Storage(object_cache=10, object_cache_mode="frozen")
+
+
+def test_autocommit(tmp_path):
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    def num_calls(db_path: str) -> int:
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("SELECT COUNT(DISTINCT call_history_id) FROM calls").fetchone()[0]
+
+    for background in (False, True):
+        db_path = str(tmp_path / f"calls_{background}.db")
+        storage = Storage(db_path=db_path, commit_every_n_calls=10, background_commits=background,
+                          bloom_filter=True)
+        with storage:
+            for i in range(25):
+                inc(i)
+                if i == 9 and not background:
+                    # the first 10 calls are visible to other connections
+                    # before the end of the block
+                    assert num_calls(db_path) == 10
+                    assert len(storage.atoms.dirty_keys) == 0 and len(storage.atoms.cache) == 0
+            if background:
+                # a new batch is only written once the previous one is done
+                if storage._flush is not None:
+                    storage._finish_flush()
+                assert 10 <= num_calls(db_path) == 25 - len(storage.calls.dirty_hids)
+            else:
+                assert storage.num_autocommits == 2
+        assert num_calls(db_path) == 25 and len(storage.calls.dirty_hids) == 0
+        assert storage.atoms.dirty_bytes == 0
+        # the committed calls are found again, and the results are loaded back
+        with storage:
+            assert [storage.unwrap(inc(i)) for i in range(25)] == list(range(1, 26))
+        assert num_calls(db_path) == 25
+        storage.close()
+
+    storage = Storage(commit_max_dirty_bytes=1)
+    with storage:
+        inc(100)
+        assert storage.num_autocommits == 1 and len(storage.atoms.dirty_keys) == 0
+    # dropping the uncommitted values forgets their size too
+    storage = Storage(commit_max_dirty_bytes=10_000)
+    with storage:
+        inc(101)
+        assert storage.atoms.dirty_bytes > 0
+        storage.atoms.clear(allow_uncommited=True)
+        assert storage.atoms.dirty_bytes == 0
+    with pytest.raises(ValueError):
+        Storage(background_commits=True)
+
+
+# at the top level, so that worker processes can import it
+@op(nout=2)
+def add_sub(x: int, y: int = 1):
+    return x + y, x - y
+
+
+def test_map(tmp_path):
+    storage = Storage(db_path=str(tmp_path / "calls.db"))
+    with storage:
+        existing = add_sub(0)
+    inputs = [{"x": i} for i in range(5)] + [{"x": 2, "y": 3}, {"x": 2, "y": 3}]
+    for executor in ("thread", "process"):
+        with storage:
+            res = storage.map(add_sub, inputs, executor=executor, max_workers=2)
+            assert [(storage.unwrap(t), storage.unwrap(d)) for t, d in res] == \
+                [(i + 1, i - 1) for i in range(5)] + [(5, -1), (5, -1)]
+            # the outputs are the same refs as calling the op directly
+            assert res[0][0].hid == existing[0].hid
+            assert [t.hid for t, _ in res] == [add_sub(**kwargs)[0].hid for kwargs in inputs]
+        assert len(storage.calls.dirty_hids) == 0
+        assert storage.conn().execute(
+            "SELECT COUNT(DISTINCT call_history_id) FROM calls WHERE op = 'add_sub'"
+        ).fetchone()[0] == 6
+    # outside a block, the new calls are committed
+    res = storage.map(add_sub, [{"x": 10}], executor="thread")
+    assert storage.unwrap(res[0][0]) == 11 and len(storage.calls.dirty_hids) == 0
+
+    @op
+    def fail(x: int) -> int:
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        with storage:
+            storage.map(fail, [{"x": i} for i in range(5)], executor="thread", max_workers=1)
+    with storage:
+        assert storage.unwrap(storage.map(fail, [{"x": i} for i in range(3)], executor="thread")) == [0, 1, 2]
+
+    # ops called by the mapped function in threads are memoized, as they
+    # would be in a sequential call
+    computed = []
+
+    @op
+    def inner(x: int) -> int:
+        computed.append(x)
+        return x + 1
+
+    @op
+    def outer(x: int) -> int:
+        return inner(x)
+
+    with storage:
+        res = storage.map(outer, [{"x": i} for i in range(3)], executor="thread")
+        assert storage.unwrap(res) == [1, 2, 3]
+        assert storage.unwrap([inner(i) for i in range(3)]) == [1, 2, 3] and computed == [0, 1, 2]
+    assert len(storage.cf(inner).df()) == 3
+
+    # outside a block, the calls are hashed with the storage's hash version
+    storage = Storage(db_path=str(tmp_path / "blake2b.db"), hash_version=HASH_VERSION_BLAKE2B)
+    with storage:
+        existing = add_sub(1)
+    res = storage.map(add_sub, [{"x": 1}, {"x": 2}], executor="thread")
+    assert res[0][0].hid == existing[0].hid
+    with storage:
+        assert res[1][0].hid == add_sub(2)[0].hid
+    assert len(storage.cf(add_sub).df()) == 2
+
+
+def test_batched_op(tmp_path):
+    batch_sizes = []
+
+    @op(batched=True, batch_size=3)
+    def square(xs: MList[int], offset: int = 0) -> MList[int]:
+        batch_sizes.append(len(xs))
+        return [x ** 2 + offset for x in xs]
+
+    @op
+    def square_one(x: int, offset: int = 0) -> int:
+        return x ** 2 + offset
+
+    storage = Storage(db_path=str(tmp_path / "calls.db"))
+    with storage:
+        res = square([1, 2, 3])
+        assert storage.unwrap(res) == [1, 4, 9] and batch_sizes == [3]
+        # only the new elements are computed, in batches of at most 3
+        res = square([3, 4, 5, 6, 7, 4], offset=0)
+        assert storage.unwrap(res) == [9, 16, 25, 36, 49, 16] and batch_sizes == [3, 3, 1]
+        assert res[1].hid == res[5].hid
+        assert storage.unwrap(square([1, 2], offset=1)) == [2, 5]
+    assert square([2]) == [4] # outside of a storage
+    # each element is a call of its own, with the same IDs as a single call
+    with storage:
+        assert storage.unwrap(square([5])) == [25] and batch_sizes == [3, 3, 1, 2, 1]
+    with storage:
+        single = square_one(5)
+    assert (storage.get_ref_creator(res[2]).inputs["xs"].hid ==
+            storage.get_ref_creator(single).inputs["x"].hid)
+    cf = storage.cf(square)
+    df = cf.df()
+    assert len(df) == 9 and sorted(df["var_0"]) == [1, 2, 4, 5, 9, 16, 25, 36, 49]
+    # like other ops, the calls are only saved when asked to
+    with storage:
+        for f, args in ((square, ([5, 8],)), (square_one, (8,))):
+            storage.call(f, args, {})
+            assert len(storage.calls.dirty_hids) == 0
+    with pytest.raises(ValueError):
+        op(batched=True)(lambda *xs: xs)
+
+
+def test_async_op(tmp_path):
+    num_runs = []
+
+    @op
+    async def fetch(x: int, delay: float = 0.1) -> int:
+        num_runs.append(x)
+        await asyncio.sleep(delay)
+        return x * 10
+
+    @op
+    def inc(x: int) -> int:
+        return x + 1
+
+    storage = Storage(db_path=str(tmp_path / "calls.db"))
+
+    async def main(xs):
+        async with storage:
+            refs = await asyncio.gather(*[fetch(x) for x in xs])
+            # async and sync ops compose as usual
+            return refs, [inc(ref) for ref in refs]
+
+    start = time.perf_counter()
+    refs, incs = asyncio.run(main([1, 2, 3, 4, 5, 1, 1]))
+    # the new calls run concurrently, and identical calls only once
+    assert time.perf_counter() - start < 0.4 and sorted(num_runs) == [1, 2, 3, 4, 5]
+    assert storage.unwrap(refs) == [10, 20, 30, 40, 50, 10, 10]
+    assert storage.unwrap(incs) == [11, 21, 31, 41, 51, 11, 11]
+    assert refs[0].hid == refs[5].hid and len(storage.calls.dirty_hids) == 0
+
+    # memoized calls don't run the function
+    storage.clear_cache()
+    refs, _ = asyncio.run(main([1, 2, 6]))
+    assert storage.unwrap(refs) == [10, 20, 60] and sorted(num_runs) == [1, 2, 3, 4, 5, 6]
+    assert len(storage.cf(fetch).df()) == 6
+
+    # outside of a storage context, and in noop mode
+    assert asyncio.run(fetch(7, delay=0)) == 70
+
+    async def noop_call():
+        with storage(mode="noop"):
+            return await fetch(8, delay=0)
+    assert asyncio.run(noop_call()) == 80
+
+    @op
+    async def fail(x: int) -> int:
+        raise ValueError(x)
+
+    async def failing():
+        async with storage:
+            return await asyncio.gather(fail(1), fail(1))
+    with pytest.raises(ValueError):
+        asyncio.run(failing())
+    assert storage._inflight == {}
+
+    # event loops in different threads share the computation of a call
+    num_runs.clear()
+
+    def run_in_thread(_) -> list:
+        return storage.unwrap(asyncio.run(main([9, 9]))[0])
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert list(pool.map(run_in_thread, range(2))) == [[90, 90], [90, 90]]
+    assert num_runs == [9] and storage._inflight == {}
+
+    # and so do storages sharing a database, with `dedup_calls`
+    num_runs.clear()
+    db_path = str(tmp_path / "shared.db")
+    storages = [Storage(db_path=db_path, dedup_calls=True) for _ in range(2)]
+
+    async def fetch_with(storage: Storage) -> int:
+        async with storage:
+            return storage.unwrap(await fetch(11))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert list(pool.map(lambda s: asyncio.run(fetch_with(s)), storages)) == [110, 110]
+    assert num_runs == [11]
+    for s in storages:
+        s.close()
+
+
+def test_threads(tmp_path):
+    @op
+    def slow_inc(x: int) -> int:
+        time.sleep(0.05)
+        return x + 1
+
+    @op
+    def double(x: int) -> int:
+        return 2 * x
+
+    for db_path in (":memory:", str(tmp_path / "calls.db")):
+        storage = Storage(db_path=db_path)
+        num_threads, calls_per_thread = 8, 4
+
+        def work(t: int) -> list:
+            # each thread has its own context
+            with storage:
+                return [storage.unwrap(double(slow_inc(t * calls_per_thread + i)))
+                        for i in range(calls_per_thread)]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            results = list(pool.map(work, range(num_threads)))
+        elapsed = time.perf_counter() - start
+        # the (sleeping) functions run concurrently
+        assert elapsed < 0.5 * num_threads * calls_per_thread * 0.05
+        assert results == [[2 * (t * calls_per_thread + i + 1) for i in range(calls_per_thread)]
+                           for t in range(num_threads)]
+        assert len(storage.calls.dirty_hids) == 0 and len(storage.cf(slow_inc).df()) == 32
+
+        # the context of a thread doesn't leak into others
+        with storage:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                assert pool.submit(double, 21).result() == 42 # not a ref
+                # unless it's passed on explicitly
+                ref = pool.submit(contextvars.copy_context().run, double, 21).result()
+            assert storage.unwrap(ref) == 42 and storage.mode == "run"
+        assert storage._mode_stack == ()
+        storage.close()
+
+
+def test_call_dedup(tmp_path):
+    computed = []
+
+    @op
+    def slow_inc(x: int) -> int:
+        computed.append(x)
+        time.sleep(0.2)
+        return x + 1
+
+    # threads making the same call wait for the first one to compute it
+    for db_path in (":memory:", str(tmp_path / "threads.db")):
+        computed.clear()
+        storage = Storage(db_path=db_path, dedup_calls=True)
+
+        def work(_) -> int:
+            with storage:
+                return storage.unwrap(slow_inc(1))
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            assert list(pool.map(work, range(4))) == [2] * 4
+        assert computed == [1] and len(storage.cf(slow_inc).df()) == 1
+        assert storage._inflight == {}
+        storage.close()
+
+    # storages sharing a database wait for each other's calls to be committed
+    computed.clear()
+    db_path = str(tmp_path / "shared.db")
+    first, second = Storage(db_path=db_path, dedup_calls=True), Storage(db_path=db_path, dedup_calls=True)
+
+    def work(storage: Storage, x: int = 1) -> int:
+        with storage:
+            return storage.unwrap(slow_inc(x))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first_result = pool.submit(work, first)
+        time.sleep(0.05)
+        assert pool.submit(work, second).result() == 2 and first_result.result() == 2
+    assert computed == [1]
+    assert first.leases.held == set() and second.leases.held == set()
+    # leases are taken without blocking the other threads of the storage
+    acquire, locked = first.leases.acquire, []
+    first.leases.acquire = lambda call_hid: locked.append(first._lock._is_owned()) or acquire(call_hid)
+    assert work(first, 3) == 4 and locked == [False]
+    first.close()
+    second.close()
+
+    # storages making the same calls in opposite orders don't wait for each
+    # other forever
+    computed.clear()
+    first, second = Storage(db_path=db_path, dedup_calls=True), Storage(db_path=db_path, dedup_calls=True)
+
+    def sweep(storage: Storage, xs: list) -> list:
+        with storage:
+            return [storage.unwrap(slow_inc(x)) for x in xs]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = [pool.submit(sweep, first, [10, 11]), pool.submit(sweep, second, [11, 10])]
+        assert [r.result(timeout=10) for r in results] == [[11, 12], [12, 11]]
+    assert sorted(computed) == [10, 11] and time.perf_counter() - start < 5
+    first.close()
+    second.close()
+
+    # a stale lease is taken over
+    computed.clear()
+    owner, other = (Storage(db_path=db_path, dedup_calls=True, lease_timeout=0.3) for _ in range(2))
+    with owner:
+        slow_inc(2)
+        # the owner stops refreshing its lease before committing the call
+        owner.leases._stop.set()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            assert pool.submit(work, other, 2).result() == 3
+    assert computed == [2, 2] and other.leases.num_takeovers == 1
+    # so is the lease of a process that no longer exists
+    proc = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                          capture_output=True, text=True)
+    dead_pid = int(proc.stdout)
+    assert other.leases._is_stale(other.leases.host, dead_pid, time.time())
+    assert not other.leases._is_stale(other.leases.host, os.getpid(), time.time())
+    owner.close()
+    other.close()
+
+    # a call committed by another process after it was looked up (here, by a
+    # Bloom filter synced before the commit) is not computed again
+    computed.clear()
+    late = Storage(db_path=db_path, dedup_calls=True, bloom_filter=True)
+    script = (
+        "import sys; from mandala.imports import *\n"
+        "@op\n"
+        "def slow_inc(x: int) -> int:\n"
+        "    return x + 1\n"
+        "storage = Storage(db_path=sys.argv[1], dedup_calls=True)\n"
+        "with storage:\n"
+        "    slow_inc(7)\n"
+        "storage.close()\n"
+    )
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(sys.modules["mandala"].__file__))}
+    with late:
+        assert late.lookup_call(slow_inc, {"x": wrap_atom(7)}) is None
+        subprocess.run([sys.executable, "-c", script, db_path], check=True, env=env)
+        assert late.unwrap(slow_inc(7)) == 8
+    assert computed == [] and late.leases.held == set()
+    late.close()
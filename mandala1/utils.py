@@ -1,6 +1,11 @@
 from .common_imports import *
 import joblib
 import io
+import json
+import pickle
+import struct
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import inspect
 from inspect import Parameter
 import sqlite3
@@ -31,21 +36,182 @@ def dataframe_to_prettytable(df: pd.DataFrame) -> str:
     return table.get_string()
 
 
+################################################################################
+### serialization
+################################################################################
+class Serializer:
+    """
+    Converts objects of given types to bytes and back. The serialized value
+    starts with the `tag` byte of the serializer that produced it, which is
+    used to pick the serializer when deserializing.
+
+    Tags are >= 0x81: values serialized with `joblib` before the registry
+    existed are pickle streams, which start with 0x80, and tags below 0x80
+    are used by the compression codecs of the storage backend.
+    """
+    def __init__(self, name: str, tag: int, types: Tuple[type, ...],
+                 encode: Callable[[Any], Union[bytes, List[Any]]],
+                 decode: Callable[[memoryview], Any],
+                 can_encode: Optional[Callable[[Any], bool]] = None,
+                 ):
+        """
+        - `encode` returns the serialized value (without the tag), or a list
+        of buffers to concatenate.
+        - `decode` is given a `memoryview` of the serialized value (without
+        the tag).
+        - `can_encode`, if given, can reject some objects of the given types,
+        which are then serialized with the fallback serializer.
+        """
+        self.name = name
+        self.tag = tag
+        self.types = types
+        self.encode = encode
+        self.decode = decode
+        self.can_encode = can_encode
+
+    def __repr__(self) -> str:
+        return f"Serializer({self.name}, tag={self.tag:#04x})"
+
+
+LEGACY_JOBLIB_TAG = 0x80
+SERIALIZERS_BY_TAG: Dict[int, Serializer] = {}
+# dispatch is on the exact type of the object, not on subclasses
+SERIALIZERS_BY_TYPE: Dict[type, Serializer] = {}
+
+
+def register_serializer(serializer: Serializer, overwrite: bool = False):
+    """
+    Register a serializer for the types in `serializer.types`. Tags
+    0x81-0xbf are reserved for the serializers that come with mandala; use
+    tags 0xc0-0xff for your own.
+
+    NOTE: the tag is stored with every value, so it must never be reused for
+    a different format.
+    """
+    if not 0x80 < serializer.tag <= 0xff:
+        raise ValueError(f"Serializer tags must be in the range 0x81-0xff, got {serializer.tag:#04x}")
+    existing = SERIALIZERS_BY_TAG.get(serializer.tag)
+    if existing is not None and existing.name != serializer.name and not overwrite:
+        raise ValueError(f"Tag {serializer.tag:#04x} is already used by {existing}")
+    SERIALIZERS_BY_TAG[serializer.tag] = serializer
+    for t in serializer.types:
+        SERIALIZERS_BY_TYPE[t] = serializer
+
+
+def _encode_int(obj: int) -> bytes:
+    return obj.to_bytes(obj.bit_length() // 8 + 1, "little", signed=True)
+
+
+def _encode_ndarray(obj: np.ndarray) -> List[Any]:
+    # store the raw buffer in C or Fortran order (whichever avoids a copy)
+    # after a small header with the dtype and shape
+    if obj.flags.c_contiguous or not obj.flags.f_contiguous:
+        order, buf = "C", np.ascontiguousarray(obj)
+    else:
+        order, buf = "F", obj.T
+    header = json.dumps({
+        "descr": np.lib.format.dtype_to_descr(obj.dtype),
+        "shape": obj.shape,
+        "order": order,
+    }).encode()
+    return [len(header).to_bytes(4, "little"), header, buf.reshape(-1).view(np.uint8)]
+
+
+def _decode_ndarray(data: memoryview, copy: bool = True) -> np.ndarray:
+    header_len = int.from_bytes(data[:4], "little")
+    header = json.loads(bytes(data[4:4 + header_len]))
+    dtype = np.lib.format.descr_to_dtype(header["descr"])
+    shape = tuple(header["shape"])
+    arr = np.frombuffer(data, dtype=dtype, offset=4 + header_len)
+    if header["order"] == "C":
+        arr = arr.reshape(shape)
+    else:
+        arr = arr.reshape(shape[::-1]).T
+    if not copy:
+        return arr
+    # the buffer is read-only; copy it (once) to return a writable array
+    return arr.copy(order="K")
+
+
+def _encode_pickle(obj: Any) -> List[Any]:
+    # pickle protocol 5 passes large buffers (e.g. of numpy arrays inside
+    # data frames) out of band, so they are not copied into the pickle stream
+    buffers = []
+    stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+    lengths = [len(stream)] + [r.nbytes for r in raws]
+    header = len(lengths).to_bytes(4, "little") + b"".join(n.to_bytes(8, "little") for n in lengths)
+    return [header, stream] + raws
+
+
+def _decode_pickle(data: memoryview) -> Any:
+    num_lengths = int.from_bytes(data[:4], "little")
+    lengths = [int.from_bytes(data[4 + 8 * i:12 + 8 * i], "little") for i in range(num_lengths)]
+    offset = 4 + 8 * num_lengths
+    chunks = []
+    for n in lengths:
+        chunks.append(data[offset:offset + n])
+        offset += n
+    stream, buffers = chunks[0], chunks[1:]
+    # out-of-band buffers are copied so that the objects using them are writable
+    return pickle.loads(stream, buffers=[bytearray(b) for b in buffers])
+
+
+PICKLE_SERIALIZER = Serializer("pickle", 0x81, (), _encode_pickle, _decode_pickle)
+
+for _serializer in (
+    PICKLE_SERIALIZER,
+    Serializer("none", 0x90, (type(None),), lambda obj: b"", lambda data: None),
+    Serializer("bool", 0x91, (bool,), lambda obj: b"\x01" if obj else b"\x00", lambda data: data[0] == 1),
+    Serializer("int", 0x92, (int,), _encode_int, lambda data: int.from_bytes(data, "little", signed=True)),
+    Serializer("float", 0x93, (float,), lambda obj: struct.pack("<d", obj), lambda data: struct.unpack("<d", data)[0]),
+    Serializer("str", 0x94, (str,), lambda obj: obj.encode("utf-8", "surrogatepass"),
+               lambda data: str(data, "utf-8", "surrogatepass")),
+    Serializer("bytes", 0x95, (bytes,), lambda obj: obj, bytes),
+    Serializer("ndarray", 0x96, (np.ndarray,), _encode_ndarray, _decode_ndarray,
+               # object arrays hold python objects, not raw data
+               can_encode=lambda obj: not obj.dtype.hasobject),
+):
+    register_serializer(_serializer)
+
+
 def serialize(obj: Any) -> bytes:
     """
+    Serialize `obj` with the serializer registered for its type, falling back
+    to pickle (protocol 5) for all other types.
+
     ! this may lead to different serializations for objects x, y such that x
     ! == y in Python. This is because of things like set ordering, which is not
     ! determined by the contents of the set. For example, {1, 2} and {2, 1} would
     ! `serialize()` to different things, but they would be equal in Python.
     """
-    buffer = io.BytesIO()
-    joblib.dump(obj, buffer)
-    return buffer.getvalue()
+    serializer = SERIALIZERS_BY_TYPE.get(type(obj))
+    if serializer is None or (serializer.can_encode is not None and not serializer.can_encode(obj)):
+        serializer = PICKLE_SERIALIZER
+    encoded = serializer.encode(obj)
+    if isinstance(encoded, bytes):
+        return bytes([serializer.tag]) + encoded
+    return b"".join([bytes([serializer.tag])] + encoded)
+
+
+def serialized_array_view(value: bytes) -> Optional[np.ndarray]:
+    """
+    If `value` is a serialized numpy array, return a read-only view of the
+    array into `value` (without copying the data); otherwise, return None.
+    """
+    if len(value) == 0 or value[0] != SERIALIZERS_BY_TYPE[np.ndarray].tag:
+        return None
+    return _decode_ndarray(memoryview(value)[1:], copy=False)
 
 
 def deserialize(value: bytes) -> Any:
-    buffer = io.BytesIO(value)
-    return joblib.load(buffer)
+    tag = value[0]
+    if tag == LEGACY_JOBLIB_TAG:
+        buffer = io.BytesIO(value)
+        return joblib.load(buffer)
+    if tag not in SERIALIZERS_BY_TAG:
+        raise ValueError(f"No serializer registered for tag {tag:#04x}")
+    return SERIALIZERS_BY_TAG[tag].decode(memoryview(value)[1:])
 
 
 def _conservative_equality_check(safe_value: Any, unknown_value: Any) -> bool:
@@ -68,13 +234,151 @@ def _conservative_equality_check(safe_value: Any, unknown_value: Any) -> bool:
         return safe_value == unknown_value
 
 
-def get_content_hash(obj: Any) -> str:
+################################################################################
+### content hashing
+################################################################################
+# Versions of the content hash. The version is recorded in each storage, and
+# existing versions must never change, as this would make existing storages
+# stop matching their calls.
+HASH_VERSION_JOBLIB = 0 # `joblib.hash` (md5 of the pickled object)
+HASH_VERSION_BLAKE2B = 1 # `ContentHasher` with blake2b
+HASH_VERSION_XXH3 = 2 # `ContentHasher` with xxh3_128 (needs `xxhash`)
+HASH_VERSIONS = (HASH_VERSION_JOBLIB, HASH_VERSION_BLAKE2B, HASH_VERSION_XXH3)
+
+if Config.has_xxhash:
+    import xxhash
+
+
+def _preprocess_for_hashing(obj: Any) -> Any:
     if hasattr(obj, "__get_mandala_dict__"):
         obj = obj.__get_mandala_dict__()
     if Config.has_torch:
         # TODO: ideally, should add a label to distinguish this from a numpy
         # array with the same contents!
         obj = tensor_to_numpy(obj) 
+    if isinstance(obj, np.memmap):
+        # joblib hashes memory maps differently from the arrays they map
+        obj = np.asarray(obj)
+    return obj
+
+
+class ContentHasher:
+    """
+    Hashes objects by feeding a type-tagged, length-prefixed encoding of them
+    into a hash function, without pickling them in the common cases:
+
+    - scalars, strings and bytes are encoded directly;
+    - lists and tuples are hashed element by element, and dicts and sets
+    via the sorted digests of their items, so that (like `joblib.hash`) the
+    hash does not depend on insertion order;
+    - contiguous numpy buffers are hashed in place, and data frames column
+    by column;
+    - everything else is hashed with `joblib.hash`.
+    """
+    def __init__(self, version: int):
+        if version == HASH_VERSION_BLAKE2B:
+            self.new = lambda: hashlib.blake2b(digest_size=16)
+        elif version == HASH_VERSION_XXH3:
+            if not Config.has_xxhash:
+                raise ValueError("Hash version 2 requires the `xxhash` package")
+            self.new = xxhash.xxh3_128
+        else:
+            raise ValueError(f"Hash version {version} is not supported by {type(self).__name__}")
+        self.version = version
+
+    def hash(self, obj: Any) -> str:
+        h = self.new()
+        self.update(h, obj)
+        return h.hexdigest()
+
+    def _digest(self, obj: Any) -> bytes:
+        h = self.new()
+        self.update(h, obj)
+        return h.digest()
+
+    @staticmethod
+    def _update_sized(h: Any, tag: bytes, data: Union[bytes, memoryview]):
+        h.update(tag)
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+
+    def update(self, h: Any, obj: Any):
+        obj = _preprocess_for_hashing(obj)
+        tp = type(obj)
+        if obj is None:
+            h.update(b"N")
+        elif tp is bool:
+            h.update(b"T" if obj else b"F")
+        elif tp is int:
+            self._update_sized(h, b"i", _encode_int(obj))
+        elif tp is float:
+            h.update(b"f" + struct.pack("<d", obj))
+        elif tp is str:
+            self._update_sized(h, b"s", obj.encode("utf-8", "surrogatepass"))
+        elif tp is bytes:
+            self._update_sized(h, b"b", obj)
+        elif tp is list or tp is tuple:
+            h.update((b"l" if tp is list else b"t") + len(obj).to_bytes(8, "little"))
+            for elt in obj:
+                self.update(h, elt)
+        elif tp is dict:
+            h.update(b"d" + len(obj).to_bytes(8, "little"))
+            for item in sorted(self._digest(k) + self._digest(v) for k, v in obj.items()):
+                h.update(item)
+        elif tp is set or tp is frozenset:
+            h.update(b"S" + len(obj).to_bytes(8, "little"))
+            for item in sorted(self._digest(elt) for elt in obj):
+                h.update(item)
+        elif tp is np.ndarray and not obj.dtype.hasobject:
+            self._update_array(h, obj)
+        elif tp is pd.DataFrame:
+            self._update_df(h, obj)
+        else:
+            self._update_sized(h, b"j", joblib.hash(obj).encode())
+
+    def _update_array(self, h: Any, arr: np.ndarray):
+        h.update(b"a")
+        self.update(h, np.lib.format.dtype_to_descr(arr.dtype))
+        self.update(h, arr.shape)
+        # the same array contents hash the same regardless of memory layout
+        h.update(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+
+    def _update_index(self, h: Any, index: pd.Index):
+        if type(index) is pd.RangeIndex:
+            h.update(b"r")
+            self.update(h, (index.start, index.stop, index.step))
+        elif type(index) is pd.Index and not index.dtype.hasobject and isinstance(index.dtype, np.dtype):
+            h.update(b"x")
+            self._update_array(h, index.to_numpy())
+        else:
+            self._update_sized(h, b"j", joblib.hash(index).encode())
+
+    def _update_df(self, h: Any, df: pd.DataFrame):
+        h.update(b"D" + len(df.columns).to_bytes(8, "little"))
+        self._update_index(h, df.columns)
+        self._update_index(h, df.index)
+        for i in range(len(df.columns)):
+            col = df.iloc[:, i]
+            if isinstance(col.dtype, np.dtype) and not col.dtype.hasobject:
+                self._update_array(h, col.to_numpy())
+            else:
+                # object and extension dtypes (categoricals, strings, ...)
+                self._update_sized(h, b"j", joblib.hash(col).encode())
+
+
+_CONTENT_HASHERS: Dict[int, ContentHasher] = {}
+
+
+def get_content_hash(obj: Any, version: int = HASH_VERSION_JOBLIB) -> str:
+    """
+    Return the content hash of the object, using the given version of the
+    hash (see `HASH_VERSIONS`).
+    """
+    if version != HASH_VERSION_JOBLIB:
+        if version not in _CONTENT_HASHERS:
+            _CONTENT_HASHERS[version] = ContentHasher(version)
+        return _CONTENT_HASHERS[version].hash(obj)
+    obj = _preprocess_for_hashing(obj)
     if isinstance(obj, pd.DataFrame):
         # DataFrames cause collisions for joblib hashing for some reason
         # TODO: the below may be incomplete
@@ -89,6 +393,163 @@ def get_content_hash(obj: Any) -> str:
     return result
 
 
+def hash_file(path: Union[str, Path], chunk_size: int = 64 * 1024 * 1024,
+              max_workers: Optional[int] = None) -> str:
+    """
+    Hash the contents of a file with blake2b. Large files are split in
+    chunks of `chunk_size` bytes that are hashed in parallel threads (hashlib
+    releases the GIL), and the hash is computed from the chunks' digests.
+
+    NOTE: the hash depends on `chunk_size`, so the default must not change.
+    """
+    size = os.path.getsize(path)
+
+    def hash_chunk(offset: int) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            remaining = min(chunk_size, size - offset)
+            while remaining > 0:
+                buf = f.read(min(remaining, 1024 * 1024))
+                if not buf:
+                    break
+                h.update(buf)
+                remaining -= len(buf)
+        return h.digest()
+
+    offsets = list(range(0, size, chunk_size)) or [0]
+    if len(offsets) == 1:
+        digests = [hash_chunk(0)]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = list(executor.map(hash_chunk, offsets))
+    h = hashlib.blake2b(digest_size=16)
+    h.update(size.to_bytes(8, "little"))
+    for digest in digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+class HashCache:
+    """
+    A cache of content hashes keyed by object identity, so that passing the
+    same large object to ops over and over does not re-hash it every time.
+
+    An entry is reused only while the object is alive (it is held through a
+    weak reference, so objects that don't support weak references are never
+    cached) and is known not to have changed since it was hashed:
+
+    - objects with a truthy `__mandala_frozen__` attribute are trusted to be
+    immutable;
+    - objects with a `__mandala_version__` attribute are re-hashed whenever
+    its value changes;
+    - numpy arrays that are read-only all the way down to their memory are
+    immutable;
+    - with `verify="sample"`, other numpy arrays and data frames are cached
+    too, and re-hashed when a fingerprint of their metadata and of a sample
+    of their elements changes. This catches most, but not all, mutations.
+
+    All other objects are hashed every time.
+    """
+    VERIFY_MODES = ("frozen", "sample")
+
+    def __init__(self, verify: str = "frozen", num_samples: int = 64):
+        if verify not in self.VERIFY_MODES:
+            raise ValueError(f"`verify` must be one of {self.VERIFY_MODES}, got {verify}")
+        self.verify = verify
+        self.num_samples = num_samples
+        # id(obj) -> (weak reference to obj, token, hash)
+        self.entries: Dict[int, Tuple[weakref.ref, Any, str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def __repr__(self) -> str:
+        return f"HashCache(verify={self.verify}, {self.stats()})"
+
+    @staticmethod
+    def _is_frozen_array(arr: np.ndarray) -> bool:
+        while isinstance(arr, np.ndarray):
+            if arr.flags.writeable:
+                return False
+            arr = arr.base
+        if arr is None:
+            return True
+        # the array is a view of some other buffer (e.g. bytes or a memory
+        # map), which must itself be read-only
+        try:
+            return memoryview(arr).readonly
+        except TypeError:
+            return False
+
+    def _sample_indices(self, n: int) -> np.ndarray:
+        return np.unique(np.linspace(0, n - 1, num=min(n, self.num_samples), dtype=np.int64))
+
+    def _get_token(self, obj: Any) -> Tuple[bool, Any]:
+        """
+        Return (whether the object can be cached, a token that changes when
+        the object changes).
+        """
+        if getattr(obj, "__mandala_frozen__", False) is True:
+            return True, None
+        if hasattr(obj, "__mandala_version__"):
+            return True, ("version", obj.__mandala_version__)
+        if isinstance(obj, np.ndarray) and self._is_frozen_array(obj):
+            return True, None
+        if self.verify == "sample":
+            if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+                sample = obj.flat[self._sample_indices(obj.size)] if obj.size > 0 else obj.reshape(-1)
+                return True, (obj.shape, obj.dtype.str, obj.strides,
+                              obj.__array_interface__["data"][0], sample.tobytes())
+            if isinstance(obj, pd.DataFrame):
+                sample = obj.iloc[self._sample_indices(len(obj))] if len(obj) > 0 else obj
+                return True, (obj.shape, tuple(obj.columns), tuple(str(dtype) for dtype in obj.dtypes),
+                              pd.util.hash_pandas_object(sample).values.tobytes())
+        return False, None
+
+    def get(self, obj: Any, hasher: Callable[[Any], str]) -> str:
+        """
+        Return the hash of `obj`, computing it with `hasher` if it is not in
+        the cache (or the cached hash may be stale).
+        """
+        cacheable, token = self._get_token(obj)
+        if not cacheable:
+            self.uncacheable += 1
+            return hasher(obj)
+        key = id(obj)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is obj and entry[1] == token:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        result = hasher(obj)
+        try:
+            ref = weakref.ref(obj, lambda _, key=key: self._evict(key))
+        except TypeError: # doesn't support weak references
+            return result
+        self.entries[key] = (ref, token, result)
+        return result
+
+    def _evict(self, key: int):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is None:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.uncacheable = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.uncacheable
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "uncacheable": self.uncacheable,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": len(self.entries),
+        }
+
+
 def dump_output_name(index: int, output_names: Optional[List[str]] = None) -> str:
     if output_names is not None and index < len(output_names):
         return output_names[index]